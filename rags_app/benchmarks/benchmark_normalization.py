@@ -0,0 +1,180 @@
+"""
+Benchmarks for RAGs normalization and builder processing, run against the local mock normalization service
+so results are comparable between runs.
+
+Run from the rags_app directory (inside the rags_app container or with RAGS_HOME set):
+
+    python -m benchmarks.benchmark_normalization --latency 0.05 --num_curies 20000
+
+End to end trait and metabolite processing also writes to the graph, those benchmarks are skipped
+if Neo4j is not available.
+"""
+from dataclasses import dataclass, field
+from threading import Thread
+import argparse
+import os
+import time
+
+from test.mock_normalization_service import MockNormalizationService
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    seconds: float
+    items: int
+    requests: int
+    details: dict = field(default_factory=dict)
+
+    @property
+    def items_per_second(self):
+        return self.items / self.seconds if self.seconds else 0.0
+
+    def to_string(self):
+        details = ', '.join([f'{key}: {value}' for key, value in self.details.items()])
+        return (f'{self.name:<32} {self.items:>8} items {self.seconds:>9.3f}s {self.items_per_second:>11.1f} items/s '
+                f'{self.requests:>6} requests  {details}')
+
+
+def synthetic_curies(start: int, count: int):
+    return [f'SYNTHETIC:{i}' for i in range(start, start + count)]
+
+
+def benchmark_node_normalization(mock_service: MockNormalizationService, num_curies: int):
+    from rags_src.rags_normalizer import RagsNormalizer
+
+    mock_service.reset_counters()
+    normalizer = RagsNormalizer()
+    curies = synthetic_curies(0, num_curies)
+    start_time = time.time()
+    normalizer.get_normalized_nodes(curies)
+    return BenchmarkResult('node normalization (cold)', time.time() - start_time, num_curies, mock_service.request_count)
+
+
+def benchmark_normalization_cache(mock_service: MockNormalizationService, num_curies: int, overlap: float):
+    from rags_src.rags_normalizer import RagsNormalizer
+
+    normalizer = RagsNormalizer()
+    normalizer.get_normalized_nodes(synthetic_curies(0, num_curies))
+
+    # a second build with overlapping ids, only the new ones should be requested
+    mock_service.reset_counters()
+    overlap_count = int(num_curies * overlap)
+    curies = synthetic_curies(num_curies - overlap_count, num_curies)
+    start_time = time.time()
+    normalizer.get_normalized_nodes(curies)
+    elapsed_time = time.time() - start_time
+    cache_hits = len(curies) - mock_service.curies_requested
+    return BenchmarkResult('node normalization (overlap)', elapsed_time, len(curies), mock_service.request_count,
+                           {'cache hit rate': f'{cache_hits / len(curies):.1%}'})
+
+
+def benchmark_concurrent_normalization(mock_service: MockNormalizationService, num_curies: int, num_builds: int):
+    from rags_src.rags_normalizer import RagsNormalizer
+
+    mock_service.reset_counters()
+    curies = synthetic_curies(10 * num_curies, num_curies)
+    threads = [Thread(target=RagsNormalizer().get_normalized_nodes, args=(curies,)) for i in range(num_builds)]
+    start_time = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return BenchmarkResult(f'concurrent normalization (x{num_builds})', time.time() - start_time,
+                           num_curies * num_builds, mock_service.request_count,
+                           {'curies requested': mock_service.curies_requested})
+
+
+def benchmark_metabolite_processing(mock_service: MockNormalizationService, num_metabolites: int):
+    from rags_src.rags_core import MWASHit
+    from rags_src.rags_graph_builder import RAGsGraphBuilder
+    from rags_src.rags_graph_db import RagsGraphDB
+
+    builder = RAGsGraphBuilder(project_id=0,
+                               project_name='Normalization Benchmark',
+                               rags_data_directory=os.environ.get("RAGS_DATA_DIR", ''),
+                               graph_db=RagsGraphDB())
+    mwas_hits = [MWASHit(id=i, original_id=curie, original_name=curie)
+                 for i, curie in enumerate(synthetic_curies(20 * num_metabolites, num_metabolites))]
+    mock_service.reset_counters()
+    start_time = time.time()
+    builder.process_mwas_metabolites(mwas_hits)
+    return BenchmarkResult('metabolite processing', time.time() - start_time, num_metabolites, mock_service.request_count)
+
+
+def benchmark_trait_processing(mock_service: MockNormalizationService, num_traits: int):
+    from app_database import TestSessionLocal, test_database_engine
+    import rags_src.rags_project_db_models as rags_db_models
+    from rags_src.rags_core import MWAS, CHEMICAL_SUBSTANCE
+    from rags_src.rags_project import RagsProjectManager
+    from rags_src.rags_project_db import RagsProjectDB
+
+    rags_db_models.Base.metadata.create_all(bind=test_database_engine)
+
+    rags_db_models.add_missing_columns(test_database_engine)
+    db_session = TestSessionLocal()
+    try:
+        project_db = RagsProjectDB(db_session)
+        project_name = f'Normalization Benchmark {int(time.time())}'
+        project_db.create_project(project_name)
+        project = project_db.get_project_by_name(project_name)
+        for i, curie in enumerate(synthetic_curies(30 * num_traits, num_traits)):
+            project_db.create_study(project_id=project.id,
+                                    file_path='sample_mwas',
+                                    study_name=f'Benchmark Study {i}',
+                                    study_type=MWAS,
+                                    original_trait_id=curie,
+                                    original_trait_type=CHEMICAL_SUBSTANCE,
+                                    original_trait_label=curie,
+                                    p_value_cutoff=0.005,
+                                    max_p_value=1)
+        project_manager = RagsProjectManager(project.id, project.name, project_db)
+        mock_service.reset_counters()
+        start_time = time.time()
+        project_manager.process_traits()
+        result = BenchmarkResult('trait processing', time.time() - start_time, num_traits, mock_service.request_count)
+        project_db.delete_project(project.id)
+        return result
+    finally:
+        db_session.close()
+
+
+def run_benchmarks(args):
+    mock_service = MockNormalizationService(latency=args.latency,
+                                            latency_jitter=args.latency_jitter,
+                                            error_rate=args.error_rate)
+    with mock_service:
+        os.environ["NODE_NORMALIZATION_ENDPOINT"] = mock_service.node_normalization_url
+        os.environ["EDGE_NORMALIZATION_ENDPOINT"] = mock_service.edge_normalization_url
+
+        results = [benchmark_node_normalization(mock_service, args.num_curies),
+                   benchmark_normalization_cache(mock_service, args.num_curies, args.overlap),
+                   benchmark_concurrent_normalization(mock_service, args.num_curies, args.concurrent_builds)]
+
+        if not args.skip_graph:
+            from rags_src.rags_graph_db import RagsGraphDBConnectionError
+            try:
+                results.append(benchmark_trait_processing(mock_service, args.num_traits))
+                results.append(benchmark_metabolite_processing(mock_service, args.num_metabolites))
+            except RagsGraphDBConnectionError as e:
+                print(f'Skipping end to end benchmarks, the graph database is not available: {e}')
+
+    print(f'Mock normalization service latency: {args.latency}s (+{args.latency_jitter}s jitter), '
+          f'error rate: {args.error_rate}')
+    for result in results:
+        print(result.to_string())
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark RAGs normalization against a local mock normalization service.')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds of latency added to every request')
+    parser.add_argument('--latency_jitter', type=float, default=0.0, help='up to this many extra seconds per request')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='fraction of requests that return a 500')
+    parser.add_argument('--num_curies', type=int, default=10000)
+    parser.add_argument('--overlap', type=float, default=0.5, help='fraction of ids shared between repeated builds')
+    parser.add_argument('--concurrent_builds', type=int, default=4)
+    parser.add_argument('--num_traits', type=int, default=200)
+    parser.add_argument('--num_metabolites', type=int, default=5000)
+    parser.add_argument('--skip_graph', action='store_true', help='skip the end to end benchmarks that need Neo4j')
+    run_benchmarks(parser.parse_args())
@@ -1,27 +1,127 @@
-from fastapi import Depends, FastAPI, HTTPException, Form, UploadFile, File
+from fastapi import BackgroundTasks, Depends, FastAPI, HTTPException, Form, UploadFile, File
 from fastapi.requests import Request
+from fastapi.responses import StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from neo4j.exceptions import Neo4jError
+import asyncio
+import csv
+import functools
+import io
+import json
+import logging
 import os
+import threading
+import uuid
 import pandas as pd
 
 from app_database import SessionLocal, engine
 
 import rags_src.rags_project_db_models as rags_db_models
-from rags_src.rags_core import RAGS_TRAIT_TYPES, RAGS_STUDY_TYPES, GWAS, MWAS, SEQUENCE_VARIANT, DISEASE_OR_PHENOTYPIC_FEATURE, CHEMICAL_SUBSTANCE
+from rags_src.rags_core import RAGS_TRAIT_TYPES, RAGS_STUDY_TYPES, GWAS, MWAS
 from rags_src.rags_project import RagsProjectManager, RagsProjectResults
-from rags_src.rags_project_db import RagsProjectDB
-from rags_src.rags_graph_db import RagsGraphDB, RagsGraphDBConnectionError
+from rags_src.rags_project_db import RagsProjectDB, TRIANGLE_SORT_COLUMNS
+from rags_src.rags_graph_db import RagsGraphDB, RagsGraphDBConnectionError, RagsGraphSchemaError, RagsGraphDeleteProgress, \
+    RagsGraphQueryCancelled, open_shared_driver, close_shared_driver, get_shared_driver_stats, get_graph_query_stats, \
+    get_query_tag_metadata
+from rags_src.rags_graph_queries import get_graph_query_text, PROJECT_VARIANTS_QUERY, PROJECT_METABOLITES_QUERY, \
+    VARIANT_CHEMICAL_GENE_BRIDGES_QUERY, PROJECT_VARIANT_ASSOCIATIONS_QUERY, PROJECT_METABOLITE_ASSOCIATIONS_QUERY, \
+    DEFAULT_ASSOCIATION_PREDICATE
 from rags_src.rags_normalizer import RagsNormalizationError
+from rags_src.rags_query_cache import RagsQueryCache
+from rags_src.rags_annotation_store import get_shared_annotation_store
+from rags_src.rags_node_registry import get_shared_node_registry, SEED_REGISTRY_TASK, RECONCILE_REGISTRY_TASK
+from rags_src.util import LoggingUtil
+
+logger = LoggingUtil.init_logging("rags.main", logging.INFO, format='medium', logFilePath=f'{os.environ["RAGS_HOME"]}/logs/')
 
 # create the DB tables if needed
 rags_db_models.Base.metadata.create_all(bind=engine)
+rags_db_models.add_missing_columns(engine)
 
 app = FastAPI()
 app.mount("/static", StaticFiles(directory=f'{os.environ["RAGS_HOME"]}/rags_app/static'), name="static")
 
 templates = Jinja2Templates(directory=f'{os.environ["RAGS_HOME"]}/rags_app/templates')
 
+# project query id -> result headers
+PROJECT_QUERY_HEADERS = {
+    1: ["Variant ID", "Original ID", "Association Study", "Associated with", "p-value"],
+    2: ["Metabolite ID", "Original ID", "Association Study", "Associated with", "p-value"],
+    3: ["Variant", "Var-Pheno p-value", "Phenotype", "Pheno-Chemical p-value", "Chemical", "Chemical-Var p-value"],
+    4: ["Variant", "Var-Pheno p-value", "Phenotype", "Pheno-Chemical p-value", "Chemical", "Chem-Gene relationship", "Gene", "Gene-Variant relationship"]
+}
+# project query id -> named graph query, the other queries are answered from the associations in the project db
+PROJECT_GRAPH_QUERIES = {
+    1: PROJECT_VARIANTS_QUERY,
+    2: PROJECT_METABOLITES_QUERY
+}
+TRIANGLE_QUERY_ID = 3
+GENE_BRIDGE_QUERY_ID = 4
+GENE_BRIDGE_P_VALUE_CUTOFF = 1e-5
+PROJECT_QUERY_LIMIT = 150
+
+# project query id -> the paged graph query that exports all of its results
+PROJECT_EXPORT_QUERIES = {
+    1: PROJECT_VARIANT_ASSOCIATIONS_QUERY,
+    2: PROJECT_METABOLITE_ASSOCIATIONS_QUERY
+}
+EXPORT_FORMATS = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+
+# graph reads for async endpoints run in their own pool, so slow ones can't hold up the rest of the app
+graph_read_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("RAGS_GRAPH_READ_THREADS", 16)),
+                                         thread_name_prefix="rags_graph_read")
+GRAPH_READ_TIMEOUT = float(os.environ.get("RAGS_GRAPH_READ_TIMEOUT", 120))
+GRAPH_READ_POLL_SECONDS = 0.5
+# an export transaction stays open while the client downloads it
+EXPORT_TIMEOUT = float(os.environ.get("RAGS_EXPORT_TIMEOUT", 1800))
+
+# (project id, query id, build generation, page, sort column) -> project query results
+project_query_cache = RagsQueryCache(int(os.environ.get("RAGS_QUERY_CACHE_SIZE", 256)))
+
+
+@app.on_event("startup")
+def start_graph_db():
+    # open the shared graph db driver and create any missing graph indexes,
+    # a graph that isn't up yet shouldn't stop the app from starting (the driver is created on first use instead)
+    try:
+        open_shared_driver()
+        rags_graph_db = RagsGraphDB()
+        rags_graph_db.ensure_schema(relationship_types=[DEFAULT_ASSOCIATION_PREDICATE])
+    except RagsGraphDBConnectionError as e:
+        logger.warning(f'Could not connect to the graph at startup: {e.message}')
+    except Neo4jError as e:
+        logger.warning(f'Checking the graph schema at startup failed: {e}')
+    else:
+        # marking the annotation state of older variants reads every variant, the app doesn't wait for it
+        threading.Thread(target=backfill_annotation_state, name="rags_annotation_backfill", daemon=True).start()
+
+    # seeding the node registry reads every node id in the graph, builds write every node until it's done
+    if os.environ.get("RAGS_NODE_REGISTRY_PATH"):
+        node_registry = get_shared_node_registry(os.environ["RAGS_NODE_REGISTRY_PATH"])
+        if not node_registry.is_seeded() and node_registry.start_maintenance(SEED_REGISTRY_TASK):
+            threading.Thread(target=maintain_node_registry,
+                             args=(SEED_REGISTRY_TASK,),
+                             name="rags_node_registry",
+                             daemon=True).start()
+
+
+@app.on_event("shutdown")
+def stop_graph_db():
+    graph_read_executor.shutdown(wait=False)
+    close_shared_driver()
+
+
+def backfill_annotation_state():
+    try:
+        RagsGraphDB().backfill_annotation_state()
+    except RagsGraphDBConnectionError as e:
+        logger.warning(f'Backfilling the variant annotation state failed: {e.message}')
+    except Neo4jError as e:
+        logger.warning(f'Backfilling the variant annotation state failed: {e}')
+
 
 # DB dependency
 def get_db():
@@ -63,9 +163,15 @@ def add_project(request: Request,
     return templates.TemplateResponse("projects.html.jinja", template_context)
 
 
+# project id -> RagsGraphDeleteProgress for project deletes that are running or finished
+project_delete_progress = {}
+
+
 @app.post("/delete_project/")
 def delete_project(request: Request,
+                   background_tasks: BackgroundTasks,
                    project_id: int = Form(...),
+                   background: bool = Form(False),
                    rags_project_db: RagsProjectDB = Depends(get_db)):
     template_context = init_template_context(request)
     if not rags_project_db.project_exists_by_id(project_id):
@@ -73,20 +179,85 @@ def delete_project(request: Request,
         show_error_message(template_context, error_message)
         return templates.TemplateResponse("error.html.jinja", template_context)
 
+    delete_progress = project_delete_progress.get(project_id)
+    if delete_progress and not delete_progress.finished and not delete_progress.error_message:
+        show_warning_message(template_context, f'That project is already being deleted '
+                                               f'({delete_progress.deleted_count} edges deleted so far).')
+        set_up_projects_for_display(template_context, rags_project_db)
+        return templates.TemplateResponse("projects.html.jinja", template_context)
+
+    delete_progress = RagsGraphDeleteProgress(project_id)
+    project_delete_progress[project_id] = delete_progress
+    study_trait_ids = get_study_trait_ids(rags_project_db, project_id)
+    if background:
+        # results cached while the delete runs are dropped when it finishes
+        rags_project_db.bump_build_generation(project_id)
+        # the request's db session is closed once the response is sent, the task opens its own
+        background_tasks.add_task(delete_project_in_background, project_id, study_trait_ids, delete_progress)
+        show_success_message(template_context, f'Project deletion started, progress: /delete_project_progress/{project_id}')
+        set_up_projects_for_display(template_context, rags_project_db)
+        return templates.TemplateResponse("projects.html.jinja", template_context)
+
     try:
         rags_graph_db = RagsGraphDB()
-        rags_graph_db.delete_project(project_id)
-    except RagsGraphDBConnectionError:
-        show_graph_db_connection_error(template_context)
+        rags_graph_db.delete_project(project_id, study_trait_ids=study_trait_ids, progress=delete_progress)
+    except RagsGraphDBConnectionError as e:
+        # some of the project may have been deleted already
+        rags_project_db.bump_build_generation(project_id)
+        project_query_cache.invalidate_project(project_id)
+        show_graph_db_connection_error(template_context, e)
+        return templates.TemplateResponse("error.html.jinja", template_context)
+    except Neo4jError:
+        # delete_project recorded the error, deleting the project again picks up from there
+        logger.exception(f'Deleting project {project_id} failed.')
+        rags_project_db.bump_build_generation(project_id)
+        project_query_cache.invalidate_project(project_id)
+        show_error_message(template_context, delete_progress.error_message)
         return templates.TemplateResponse("error.html.jinja", template_context)
 
     rags_project_db.delete_project(project_id)
+    project_query_cache.invalidate_project(project_id)
     show_success_message(template_context, f'Project deleted successfully.')
 
     set_up_projects_for_display(template_context, rags_project_db)
     return templates.TemplateResponse("projects.html.jinja", template_context)
 
 
+@app.get("/delete_project_progress/{project_id}")
+def view_delete_project_progress(project_id: int):
+    delete_progress = project_delete_progress.get(project_id)
+    if not delete_progress:
+        raise HTTPException(status_code=404, detail="No delete has been started for that project.")
+    return {"project_id": project_id,
+            "deleted_count": delete_progress.deleted_count,
+            "current_namespace": delete_progress.current_namespace,
+            "finished": delete_progress.finished,
+            "error_message": delete_progress.error_message}
+
+
+def get_study_trait_ids(rags_project_db: RagsProjectDB, project_id: int):
+    project = rags_project_db.get_project_by_id(project_id)
+    return {study.study_name: study.normalized_trait_id if study.normalized_trait_id else study.original_trait_id
+            for study in project.studies}
+
+
+def delete_project_in_background(project_id: int, study_trait_ids: dict, delete_progress: RagsGraphDeleteProgress):
+    try:
+        RagsGraphDB().delete_project(project_id, study_trait_ids=study_trait_ids, progress=delete_progress)
+        db = SessionLocal()
+        try:
+            RagsProjectDB(db).delete_project(project_id)
+        finally:
+            db.close()
+    except Exception as e:
+        # the graph edges deleted so far stay deleted, deleting the project again picks up from there
+        if not delete_progress.error_message:
+            delete_progress.error_message = f'Deleting the project failed: {e}'
+        logger.exception(f'Deleting project {project_id} failed: {delete_progress.error_message}')
+    finally:
+        project_query_cache.invalidate_project(project_id)
+
+
 def set_up_projects_for_display(template_context: dict, rags_project_db: RagsProjectDB):
     # here we are dynamically adding some properties jinja expects to the project objects
     # this is pretty inefficient, these could be stored in the DB
@@ -109,6 +280,93 @@ def set_up_projects_for_display(template_context: dict, rags_project_db: RagsPro
             project.num_errors += len(study.errors)
 
 
+@app.get("/graph_db_stats/")
+def view_graph_db_stats():
+    return get_shared_driver_stats()
+
+
+@app.get("/graph_query_stats/")
+def view_graph_query_stats():
+    return get_graph_query_stats()
+
+
+@app.get("/graph_schema/")
+def view_graph_schema(predicate: str = DEFAULT_ASSOCIATION_PREDICATE):
+    try:
+        schema_report = RagsGraphDB().get_schema_report(relationship_types=[predicate])
+    except RagsGraphDBConnectionError as e:
+        raise HTTPException(status_code=503, detail=f'Error connecting to the Neo4j database: {e.message}')
+    return format_schema_report(schema_report)
+
+
+@app.post("/graph_schema/")
+def create_graph_schema(background_tasks: BackgroundTasks, predicate: str = DEFAULT_ASSOCIATION_PREDICATE):
+    """
+    Create any missing graph indexes in the background, for an association predicate the startup check didn't know.
+    Builds don't create indexes themselves, so they never wait for one to come online.
+    """
+    try:
+        schema_report = RagsGraphDB().get_schema_report(relationship_types=[predicate])
+    except RagsGraphDBConnectionError as e:
+        raise HTTPException(status_code=503, detail=f'Error connecting to the Neo4j database: {e.message}')
+    background_tasks.add_task(ensure_graph_schema, predicate)
+    return format_schema_report(schema_report)
+
+
+def ensure_graph_schema(predicate: str):
+    try:
+        RagsGraphDB().ensure_schema(relationship_types=[predicate])
+    except RagsGraphDBConnectionError as e:
+        logger.warning(f'Creating the graph schema failed: {e.message}')
+    except Neo4jError as e:
+        logger.warning(f'Creating the graph schema failed: {e}')
+
+
+def format_schema_report(schema_report: list):
+    return [{"name": index.name,
+             "label": index.label,
+             "property": index.property,
+             "relationship": index.relationship,
+             "unique": index.unique,
+             "state": state} for (index, state) in schema_report]
+
+
+@app.get("/node_registry/")
+def view_node_registry():
+    return get_node_registry().get_status()
+
+
+@app.post("/node_registry/{task}/")
+def start_node_registry_maintenance(task: str, background_tasks: BackgroundTasks):
+    """
+    Seed the node registry from the graph, or reconcile it with a graph that was reloaded, in the background.
+    """
+    if task not in (SEED_REGISTRY_TASK, RECONCILE_REGISTRY_TASK):
+        raise HTTPException(status_code=404, detail=f'Unknown node registry task: {task}')
+    node_registry = get_node_registry()
+    if not node_registry.start_maintenance(task):
+        raise HTTPException(status_code=409,
+                            detail=f'The node registry is busy ({node_registry.maintenance_task}), try again later.')
+    background_tasks.add_task(maintain_node_registry, task)
+    return node_registry.get_status()
+
+
+def get_node_registry():
+    if not os.environ.get("RAGS_NODE_REGISTRY_PATH"):
+        raise HTTPException(status_code=404, detail='The node registry is not enabled (RAGS_NODE_REGISTRY_PATH).')
+    return get_shared_node_registry(os.environ["RAGS_NODE_REGISTRY_PATH"])
+
+
+def maintain_node_registry(task: str):
+    node_registry = get_shared_node_registry(os.environ["RAGS_NODE_REGISTRY_PATH"])
+    logger.info(f'Node registry {task} started.')
+    try:
+        node_registry.run_maintenance(task, RagsGraphDB())
+        logger.info(f'Node registry {task} finished, {node_registry.get_node_count()} node ids.')
+    except Exception:
+        logger.exception(f'Node registry {task} failed.')
+
+
 @app.get("/project/{project_id}")
 def manage_project(project_id: int,
                    request: Request,
@@ -255,12 +513,15 @@ def build_rags(request: Request,
         if not results.success:
             return templates.TemplateResponse("error.html.jinja", template_context)
 
-    except RagsGraphDBConnectionError:
-        show_graph_db_connection_error(template_context)
+    except RagsGraphDBConnectionError as e:
+        show_graph_db_connection_error(template_context, e)
         return templates.TemplateResponse("error.html.jinja", template_context)
     except RagsNormalizationError as e:
         show_error_message(template_context, e.message)
         return templates.TemplateResponse("error.html.jinja", template_context)
+    except RagsGraphSchemaError as e:
+        show_error_message(template_context, e.message)
+        return templates.TemplateResponse("error.html.jinja", template_context)
 
     return get_manage_project_view_template(rags_project_db, project_id, template_context)
 
@@ -276,8 +537,37 @@ def annotate_rags(request: Request,
     try:
         results = project_manager.annotate_hits()
         update_template_context_with_results(results, template_context)
-    except RagsGraphDBConnectionError:
-        show_graph_db_connection_error(template_context)
+    except RagsGraphDBConnectionError as e:
+        show_graph_db_connection_error(template_context, e)
+        return templates.TemplateResponse("error.html.jinja", template_context)
+    except RagsNormalizationError as e:
+        show_error_message(template_context, e.message)
+        return templates.TemplateResponse("error.html.jinja", template_context)
+    except RagsGraphSchemaError as e:
+        show_error_message(template_context, e.message)
+        return templates.TemplateResponse("error.html.jinja", template_context)
+
+    return get_manage_project_view_template(rags_project_db, project_id, template_context)
+
+
+@app.post("/validate/")
+async def validate_rags(request: Request,
+                        project_id: int = Form(...),
+                        rags_project_db: RagsProjectDB = Depends(get_db)):
+    template_context = init_template_context(request)
+    if not rags_project_db.project_exists_by_id(project_id):
+        return get_missing_project_view_template(template_context)
+
+    try:
+        results = await run_graph_read(request, validate_project, project_id)
+        # validation saved its errors through its own session
+        rags_project_db.expire_orm_objects()
+        update_template_context_with_results(results, template_context)
+    except RagsGraphDBConnectionError as e:
+        show_graph_db_connection_error(template_context, e)
+        return templates.TemplateResponse("error.html.jinja", template_context)
+    except RagsGraphQueryCancelled as e:
+        show_error_message(template_context, f'Validation was stopped before it finished. {e.message}')
         return templates.TemplateResponse("error.html.jinja", template_context)
     except RagsNormalizationError as e:
         show_error_message(template_context, e.message)
@@ -286,6 +576,12 @@ def annotate_rags(request: Request,
     return get_manage_project_view_template(rags_project_db, project_id, template_context)
 
 
+def validate_project(rags_graph_db: RagsGraphDB, rags_project_db: RagsProjectDB, project_id: int):
+    db_project = rags_project_db.get_project_by_id(project_id)
+    project_manager = RagsProjectManager(db_project.id, db_project.name, rags_project_db, rags_graph_db=rags_graph_db)
+    return project_manager.validate_project()
+
+
 def get_missing_project_view_template(template_context: dict):
     template_context["error_message"] = f"Oh No. Project not found."
     return templates.TemplateResponse("error.html.jinja", template_context)
@@ -311,51 +607,275 @@ def project_query_view(project_id: int, request: Request, rags_project_db: RagsP
 
 
 @app.get("/project_query/{project_id}/{query_id}")
-def project_query_view(project_id: int,
+async def project_query_view(project_id: int,
                        query_id: int,
                        request: Request,
+                       page: int = 0,
+                       sort_by: str = TRIANGLE_SORT_COLUMNS[0],
+                       after: str = "",
                        rags_project_db: RagsProjectDB = Depends(get_db)):
     template_context = init_template_context(request)
     if not rags_project_db.project_exists_by_id(project_id):
         show_error_message(template_context, f"Oh No. That project seems to be missing from the database.")
         return templates.TemplateResponse("error.html.jinja", template_context)
 
+    if query_id not in PROJECT_QUERY_HEADERS:
+        return get_project_query_view(rags_project_db, project_id, template_context)
+    if sort_by not in TRIANGLE_SORT_COLUMNS:
+        sort_by = TRIANGLE_SORT_COLUMNS[0]
+    page = max(page, 0)
+    after_path_key = parse_path_key(after) if query_id == GENE_BRIDGE_QUERY_ID else None
     try:
-        rags_graph_db = RagsGraphDB()
-        normalized_association_predicate = "biolink:correlated_with"
-        if query_id == 1:
-            custom_query = f"match (s:`{SEQUENCE_VARIANT}`)<-[r:`{normalized_association_predicate}` {{project_id: {project_id}}}]-(b) return distinct s.id, r.input_id, r.namespace, b.id, r.p_value ORDER BY r.p_value"
-            results = rags_graph_db.custom_read_query(custom_query, limit=150)
-            template_context["project_query"] = custom_query + " (limited to 150 results)"
-            template_context["project_query_results"] = results
-            template_context["project_query_headers"] = ["Variant ID", "Original ID", "Association Study", "Associated with", "p-value"]
-        elif query_id == 2:
-            custom_query = f"match (c:`{CHEMICAL_SUBSTANCE}`)<-[r:`{normalized_association_predicate}` {{project_id: {project_id}}}]-(b) return distinct c.id, r.input_id, r.namespace, b.id, r.p_value ORDER BY r.p_value"
-            results = rags_graph_db.custom_read_query(custom_query, limit=150)
-            template_context["project_query"] = custom_query + " (limited to 150 results)"
-            template_context["project_query_results"] = results
-            template_context["project_query_headers"] = ["Metabolite ID", "Original ID", "Association Study", "Associated with", "p-value"]
-        elif query_id == 3:
-            custom_query = f"MATCH (s:`{SEQUENCE_VARIANT}`)<-[r1:`{normalized_association_predicate}` {{project_id: {project_id}}}]-(d:`{DISEASE_OR_PHENOTYPIC_FEATURE}`)-[r2:`{normalized_association_predicate}` {{project_id: {project_id}}}]-(c:`{CHEMICAL_SUBSTANCE}`)-[r3:`{normalized_association_predicate}` {{project_id: {project_id}}}]-(s) return s.id, r1.p_value, d.id, r2.p_value, c.id, r3.p_value ORDER BY r1.p_value"
-            results = rags_graph_db.custom_read_query(custom_query, limit=150)
-            template_context["project_query"] = custom_query + " (limited to 150 results)"
-            template_context["project_query_results"] = results
-            template_context["project_query_headers"] = ["Variant", "Var-Pheno p-value", "Phenotype", "Pheno-Chemical p-value", "Chemical", "Chemical-Var p-value"]
-        elif query_id == 4:
-            custom_query = f"MATCH (s:`{SEQUENCE_VARIANT}`)-[r1:`{normalized_association_predicate}` {{project_id: {project_id}}}]-(d:`{DISEASE_OR_PHENOTYPIC_FEATURE}`)-[r2:`{normalized_association_predicate}` {{project_id: {project_id}}}]-(c:`{CHEMICAL_SUBSTANCE}`)-[r3]-(g:gene)-[r4]-(s) WHERE r1.p_value < 1e-5 AND r2.p_value < 1e-5 RETURN s.id, r1.p_value, d.id, r2.p_value, c.id, type(r3), g.id, type(r4)"
-            results = rags_graph_db.custom_read_query(custom_query, limit=150)
-            template_context["project_query"] = custom_query + " (limited to 150 results)"
-            template_context["project_query_results"] = results
-            template_context["project_query_headers"] = ["Variant", "Var-Pheno p-value", "Phenotype", "Pheno-Chemical p-value", "Chemical", "Chem-Gene relationship", "Gene", "Gene-Variant relationship"]
-        elif query_id == 5:
-            pass
-    except RagsGraphDBConnectionError:
-        show_graph_db_connection_error(template_context)
+        results, next_path_key = await run_graph_read(request, get_project_query_results,
+                                                      project_id, query_id, page, sort_by, after_path_key)
+    except RagsGraphDBConnectionError as e:
+        show_graph_db_connection_error(template_context, e)
+        return templates.TemplateResponse("error.html.jinja", template_context)
+    except RagsGraphQueryCancelled as e:
+        show_error_message(template_context, f'The query was stopped before it finished. {e.message}')
         return templates.TemplateResponse("error.html.jinja", template_context)
 
+    if query_id in PROJECT_GRAPH_QUERIES:
+        template_context["project_query"] = get_graph_query_text(PROJECT_GRAPH_QUERIES[query_id])
+    elif query_id == TRIANGLE_QUERY_ID:
+        template_context["project_query"] = f'Association triangles for the project, sorted by {sort_by}'
+        template_context["project_query_sort_columns"] = TRIANGLE_SORT_COLUMNS
+        template_context["project_query_sort_by"] = sort_by
+    else:
+        template_context["project_query"] = f'Variants and chemicals associated with the same phenotype ' \
+                                            f'(p < {GENE_BRIDGE_P_VALUE_CUTOFF}) that are linked by a gene: ' \
+                                            f'{get_graph_query_text(VARIANT_CHEMICAL_GENE_BRIDGES_QUERY)}'
+    if query_id not in PROJECT_GRAPH_QUERIES and not rags_project_db.has_associations(project_id):
+        show_warning_message(template_context, "No associations have been recorded for this project, "
+                                               "projects built before this query was added need to be rebuilt.")
+    template_context["project_query_results"] = results
+    template_context["project_query_headers"] = PROJECT_QUERY_HEADERS[query_id]
+    template_context["project_query_id"] = query_id
+    if query_id == GENE_BRIDGE_QUERY_ID:
+        # gene bridged paths page by path key instead of by page number
+        template_context["project_query_page"] = 0
+        template_context["project_query_has_next_page"] = False
+        template_context["project_query_after"] = format_path_key(after_path_key) if after_path_key else ""
+        template_context["project_query_next_after"] = format_path_key(next_path_key) if next_path_key else ""
+    else:
+        template_context["project_query_page"] = page
+        template_context["project_query_has_next_page"] = len(results) == PROJECT_QUERY_LIMIT
+
     return get_project_query_view(rags_project_db, project_id, template_context)
 
 
+async def run_graph_read(request: Request, read_function, *args):
+    """
+    Run a blocking graph read in the graph read pool, leaving the event loop free for other requests.
+
+    read_function gets a RagsGraphDB (with the query timeout and a query tag) and a RagsProjectDB followed by args.
+    The project db has its own session, the read can outlive the request's session when it's cancelled.
+    If the client disconnects or the read runs past the timeout, the tagged queries are stopped in Neo4j
+    and the read can't start any more of them.
+    """
+    loop = asyncio.get_event_loop()
+    query_tag = uuid.uuid4().hex
+    rags_graph_db = RagsGraphDB(query_timeout=GRAPH_READ_TIMEOUT, query_metadata=get_query_tag_metadata(query_tag))
+    read_future = loop.run_in_executor(graph_read_executor,
+                                       functools.partial(run_with_project_db, read_function, rags_graph_db, *args))
+    deadline = loop.time() + GRAPH_READ_TIMEOUT
+    while True:
+        done, pending = await asyncio.wait([read_future], timeout=GRAPH_READ_POLL_SECONDS)
+        if done:
+            return read_future.result()
+        if await request.is_disconnected():
+            reason = "The client disconnected."
+        elif loop.time() > deadline:
+            reason = f"It took longer than {GRAPH_READ_TIMEOUT} seconds."
+        else:
+            continue
+        # the read only stops once its current query does, it finishes in the background
+        rags_graph_db.cancel()
+        try:
+            await loop.run_in_executor(None, rags_graph_db.kill_queries, query_tag)
+        except (RagsGraphDBConnectionError, Neo4jError) as e:
+            logger.warning(f'Stopping graph queries for a cancelled read failed: {e}')
+        logger.info(f'Cancelled a graph read: {reason}')
+        raise RagsGraphQueryCancelled(reason)
+
+
+def run_with_project_db(read_function, rags_graph_db: RagsGraphDB, *args):
+    db = SessionLocal()
+    try:
+        return read_function(rags_graph_db, RagsProjectDB(db), *args)
+    finally:
+        db.close()
+
+
+def get_project_query_results(rags_graph_db: RagsGraphDB,
+                              rags_project_db: RagsProjectDB,
+                              project_id: int,
+                              query_id: int,
+                              page: int,
+                              sort_by: str,
+                              after_path_key: tuple = None):
+    """
+    :return: the results, and the path key the next page starts after (gene bridged paths only, otherwise None)
+    """
+    # the results only change when the build generation does, until then they can be reused
+    cache_key = (project_id, query_id, rags_project_db.get_build_generation(project_id), page, sort_by, after_path_key)
+    results = project_query_cache.get(cache_key)
+    if results is None:
+        if query_id == GENE_BRIDGE_QUERY_ID:
+            results = get_gene_bridged_paths(rags_graph_db, rags_project_db, project_id, after_path_key, PROJECT_QUERY_LIMIT)
+        else:
+            results = (run_project_query(rags_graph_db, rags_project_db, project_id, query_id, page, sort_by), None)
+        project_query_cache.put(cache_key, results)
+    return results
+
+
+def run_project_query(rags_graph_db: RagsGraphDB,
+                      rags_project_db: RagsProjectDB,
+                      project_id: int,
+                      query_id: int,
+                      page: int,
+                      sort_by: str):
+    skip = page * PROJECT_QUERY_LIMIT
+    if query_id in PROJECT_GRAPH_QUERIES:
+        query_parameters = {"project_id": project_id, "skip": skip, "limit": PROJECT_QUERY_LIMIT}
+        return [tuple(record.values()) for record in rags_graph_db.run_named_query(PROJECT_GRAPH_QUERIES[query_id],
+                                                                                   query_parameters)]
+    return [tuple(row) for row in rags_project_db.get_association_triangles(project_id,
+                                                                            sort_by=sort_by,
+                                                                            skip=skip,
+                                                                            limit=PROJECT_QUERY_LIMIT)]
+
+
+def get_gene_bridged_paths(rags_graph_db: RagsGraphDB,
+                           rags_project_db: RagsProjectDB,
+                           project_id: int,
+                           after_path_key: tuple,
+                           limit: int):
+    """
+    The variant - phenotype - chemical part comes from the project db, only the gene links are looked up in the graph.
+
+    A page starts after after_path_key and ends with the first path that reaches the limit, so it can run a few rows
+    over when that path has more than one gene.
+    :return: the results, and the path key the next page starts after (None on the last page)
+    """
+    results = []
+    for phenotype_paths in rags_project_db.iterate_phenotype_paths(project_id,
+                                                                   GENE_BRIDGE_P_VALUE_CUTOFF,
+                                                                   after_path_key=after_path_key):
+        pairs = {(variant_id, chemical_id) for (variant_id, _, _, _, chemical_id, _, _) in phenotype_paths}
+        gene_bridges = defaultdict(list)
+        for record in rags_graph_db.run_named_query(VARIANT_CHEMICAL_GENE_BRIDGES_QUERY,
+                                                    {"pairs": [list(pair) for pair in pairs]}):
+            gene_bridges[(record["variant_id"], record["chemical_id"])].append(
+                (record["chemical_gene_relationship"], record["gene_id"], record["gene_variant_relationship"]))
+        for (variant_id, variant_p_value, phenotype_id, chemical_p_value, chemical_id, *path_key) in phenotype_paths:
+            if len(results) >= limit:
+                return results, after_path_key
+            for (chemical_gene_relationship, gene_id, gene_variant_relationship) in gene_bridges[(variant_id, chemical_id)]:
+                results.append((variant_id, variant_p_value, phenotype_id, chemical_p_value, chemical_id,
+                                chemical_gene_relationship, gene_id, gene_variant_relationship))
+            after_path_key = tuple(path_key)
+    return results, None
+
+
+def parse_path_key(path_key: str):
+    # a path key that doesn't parse starts from the first page
+    try:
+        variant_phenotype_id, phenotype_chemical_id = path_key.split("-")
+        return int(variant_phenotype_id), int(phenotype_chemical_id)
+    except ValueError:
+        return None
+
+
+def format_path_key(path_key: tuple):
+    return f'{path_key[0]}-{path_key[1]}'
+
+
+@app.get("/project_query_cache_stats/")
+def view_project_query_cache_stats():
+    return project_query_cache.get_stats()
+
+
+@app.get("/annotation_store_stats/")
+def view_annotation_store_stats():
+    if not os.environ.get("RAGS_ANNOTATION_STORE_PATH"):
+        raise HTTPException(status_code=404, detail='The annotation store is not enabled (RAGS_ANNOTATION_STORE_PATH).')
+    return get_shared_annotation_store(os.environ["RAGS_ANNOTATION_STORE_PATH"]).get_stats()
+
+
+@app.post("/annotation_store/purge/")
+def purge_annotation_store():
+    """
+    Remove the expired annotations and the ones from older annotation versions.
+    """
+    if not os.environ.get("RAGS_ANNOTATION_STORE_PATH"):
+        raise HTTPException(status_code=404, detail='The annotation store is not enabled (RAGS_ANNOTATION_STORE_PATH).')
+    annotation_store = get_shared_annotation_store(os.environ["RAGS_ANNOTATION_STORE_PATH"])
+    purged_count = annotation_store.purge()
+    logger.info(f'Purged {purged_count} annotations from the annotation store.')
+    return {"purged": purged_count, **annotation_store.get_stats()}
+
+
+@app.get("/project_export/{project_id}/{query_id}")
+def export_project_query(project_id: int,
+                         query_id: int,
+                         export_format: str = "csv",
+                         rags_project_db: RagsProjectDB = Depends(get_db)):
+    # streams every result of a project query, instead of the first 150 shown on the query page
+    if not rags_project_db.project_exists_by_id(project_id):
+        raise HTTPException(status_code=404, detail=f'Project {project_id} not found.')
+    if query_id not in PROJECT_EXPORT_QUERIES:
+        raise HTTPException(status_code=404, detail=f'Query {query_id} can not be exported.')
+    if export_format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f'Export format not supported: {export_format}')
+    try:
+        rags_graph_db = RagsGraphDB(query_timeout=EXPORT_TIMEOUT)
+    except RagsGraphDBConnectionError as e:
+        raise HTTPException(status_code=503, detail=f'Error connecting to the Neo4j database: {e.message}')
+
+    records = rags_graph_db.stream_named_query(PROJECT_EXPORT_QUERIES[query_id], {"project_id": project_id})
+    export_rows = stream_csv_rows(records) if export_format == "csv" else stream_jsonl_rows(records)
+    export_rows = end_export_on_error(export_rows, export_format, f'project {project_id} query {query_id}')
+    file_name = f'project_{project_id}_query_{query_id}.{export_format}'
+    return StreamingResponse(export_rows,
+                             media_type=EXPORT_FORMATS[export_format],
+                             headers={"Content-Disposition": f'attachment; filename="{file_name}"'})
+
+
+def stream_csv_rows(records, rows_per_chunk: int = 1000):
+    csv_buffer = io.StringIO()
+    csv_writer = csv.writer(csv_buffer)
+    row_count = 0
+    for record in records:
+        if not row_count:
+            csv_writer.writerow(record.keys())
+        csv_writer.writerow(record.values())
+        row_count += 1
+        if row_count % rows_per_chunk == 0:
+            yield csv_buffer.getvalue()
+            csv_buffer.seek(0)
+            csv_buffer.truncate()
+    yield csv_buffer.getvalue()
+
+
+def stream_jsonl_rows(records):
+    for record in records:
+        yield json.dumps(record.data()) + "\n"
+
+
+def end_export_on_error(export_rows, export_format: str, export_name: str):
+    # the response status went out with the first row, so a failed export ends with an error line instead
+    try:
+        yield from export_rows
+    except (RagsGraphDBConnectionError, Neo4jError) as e:
+        logger.error(f'Export of {export_name} failed: {e}')
+        error_message = f'Export incomplete, reading from the graph failed: {e}'
+        if export_format == "csv":
+            yield f'# {error_message}\n'
+        else:
+            yield json.dumps({"error": error_message}) + "\n"
+
+
 def get_project_query_view(rags_project_db: RagsProjectDB, project_id: int, template_context: dict):
     project = rags_project_db.get_project_by_id(project_id)
     template_context["project"] = project
@@ -378,8 +898,8 @@ def show_error_message(template_context: dict, message: str):
     template_context["error_messages"].append(message)
 
 
-def show_graph_db_connection_error(template_context: dict):
-    error_message = f"Service Unavailable: Error connecting to the Neo4j database: {e}.\n"
+def show_graph_db_connection_error(template_context: dict, e: RagsGraphDBConnectionError):
+    error_message = f"Service Unavailable: Error connecting to the Neo4j database: {e.message}.\n"
     error_message += "Make sure the neo4j docker container is configured and running properly and try again."
     template_context["error_messages"].append(error_message)
 
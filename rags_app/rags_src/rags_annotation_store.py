@@ -0,0 +1,137 @@
+from rags_src.rags_genetics_cache import encode_service_results, decode_service_results, select_by_ids
+from rags_src.util import LoggingUtil
+
+from robokop_genetics.genetics_services import ALL_VARIANT_TO_GENE_SERVICES
+
+from importlib.metadata import version, PackageNotFoundError
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = LoggingUtil.init_logging("rags.annotation_store", logging.INFO, format='medium', logFilePath=f'{os.environ["RAGS_HOME"]}/logs/')
+
+# stored annotations older than this are looked up again
+DEFAULT_ANNOTATION_MAX_AGE_DAYS = 90
+
+
+class RagsAnnotationStore(object):
+    """
+    A persistent store of variant to gene annotations, shared by every project and stored in SQLite.
+
+    Annotations are keyed by normalized variant id and annotation version, and hold the combined (edge, gene) results
+    of every variant to gene service, including variants with no genes. A variant annotated for one project is written
+    to the graph for any later project straight from the store.
+
+    Annotations older than max_age_seconds count as expired and are looked up again, set_results replaces them.
+    A new annotation version (see get_annotation_version) starts over with an empty store.
+    purge() removes expired annotations and the ones from older versions.
+
+    When the store is enabled it takes the place of the genetics cache for variant to gene results,
+    the genetics cache then only keeps variant normalizations.
+    """
+    def __init__(self, store_path: str, annotation_version: str = None, max_age_seconds: float = None):
+        self.store_path = store_path
+        self.annotation_version = annotation_version if annotation_version else get_annotation_version()
+        self.max_age_seconds = max_age_seconds if max_age_seconds is not None else DEFAULT_ANNOTATION_MAX_AGE_DAYS * 86400
+        self.connection = sqlite3.connect(store_path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS annotations '
+                                    '(variant_id TEXT NOT NULL, annotation_version TEXT NOT NULL, results TEXT NOT NULL, '
+                                    'annotated_time REAL NOT NULL, PRIMARY KEY (variant_id, annotation_version)) WITHOUT ROWID')
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def get_results(self, variant_ids: list):
+        """
+        :return: a dictionary of variant id -> list of (edge, gene node) for the variants with a current annotation
+        """
+        stored_results = {}
+        expired_count = 0
+        oldest_time = time.time() - self.max_age_seconds
+        with self.lock:
+            rows = select_by_ids(self.connection,
+                                 'SELECT variant_id, results, annotated_time FROM annotations '
+                                 'WHERE annotation_version = ? AND variant_id IN ({ids})',
+                                 variant_ids,
+                                 (self.annotation_version,))
+            for (variant_id, results, annotated_time) in rows:
+                if annotated_time < oldest_time:
+                    expired_count += 1
+                    continue
+                stored_results[variant_id] = decode_service_results(results)
+            self.hits += len(stored_results)
+            self.misses += len(variant_ids) - len(stored_results)
+            self.expired += expired_count
+        return stored_results
+
+    def set_results(self, results_dict: dict):
+        """
+        :param results_dict: a dictionary of variant id -> list of (edge, gene node), an empty list for no genes
+        """
+        annotated_time = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO annotations '
+                                        '(variant_id, annotation_version, results, annotated_time) VALUES (?, ?, ?, ?)',
+                                        [(variant_id, self.annotation_version, encode_service_results(results), annotated_time)
+                                         for variant_id, results in results_dict.items()])
+
+    def purge(self):
+        """
+        Remove the annotations that are expired or from other annotation versions.
+        :return: the number of annotations removed
+        """
+        with self.lock, self.connection:
+            return self.connection.execute('DELETE FROM annotations WHERE annotation_version != ? OR annotated_time < ?',
+                                           (self.annotation_version, time.time() - self.max_age_seconds)).rowcount
+
+    def get_stats(self):
+        with self.lock:
+            annotation_count = self.connection.execute('SELECT count(*) FROM annotations WHERE annotation_version = ?',
+                                                       (self.annotation_version,)).fetchone()[0]
+            lookups = self.hits + self.misses
+            return {'annotation_version': self.annotation_version,
+                    'annotations': annotation_count,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'expired': self.expired,
+                    'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    def log_stats(self):
+        stats = self.get_stats()
+        logger.info(f'Annotation store: {stats["hits"]} hits, {stats["misses"]} misses ({stats["expired"]} expired), '
+                    f'{stats["hit_rate"]:.1%} hit rate.')
+
+    def close(self):
+        self.connection.close()
+
+
+def get_annotation_version(services: list = ALL_VARIANT_TO_GENE_SERVICES):
+    """
+    The robokop-genetics version and the variant to gene services, or RAGS_ANNOTATION_VERSION if it's set,
+    change it to start over when the upstream annotation data changes.
+    """
+    annotation_version = os.environ.get("RAGS_ANNOTATION_VERSION")
+    if not annotation_version:
+        try:
+            annotation_version = f'robokop-genetics {version("robokop-genetics")}'
+        except PackageNotFoundError:
+            annotation_version = 'robokop-genetics'
+    return f'{annotation_version} ({", ".join(sorted(services))})'
+
+
+# one store per file is shared by every builder in the process
+shared_annotation_stores = {}
+
+
+def get_shared_annotation_store(store_path: str):
+    if store_path not in shared_annotation_stores:
+        max_age_days = float(os.environ.get("RAGS_ANNOTATION_MAX_AGE_DAYS", DEFAULT_ANNOTATION_MAX_AGE_DAYS))
+        shared_annotation_stores[store_path] = RagsAnnotationStore(store_path, max_age_seconds=max_age_days * 86400)
+        logger.info(f'Using annotation store: {store_path}')
+    return shared_annotation_stores[store_path]
@@ -12,6 +12,9 @@ DISEASE_OR_PHENOTYPIC_FEATURE = 'biolink:DiseaseOrPhenotypicFeature'
 ROOT_ENTITY = 'biolink:NamedThing'
 SEQUENCE_VARIANT = 'biolink:SequenceVariant'
 
+# sequence variant node property, false until add_genes_to_variants has looked for the variant's genes
+RAGS_ANNOTATED_PROPERTY = 'rags_annotated'
+
 # valid trait types for RAGs studies
 RAGS_TRAIT_TYPES = [
     CHEMICAL_SUBSTANCE,
@@ -33,6 +36,7 @@ RAGS_STUDY_TYPES = [
 RAGS_ERROR_SEARCHING = 40001
 RAGS_ERROR_BUILDING = 40002
 RAGS_ERROR_NORMALIZATION = 40003
+RAGS_ERROR_VALIDATION = 40004
 
 
 @dataclass
@@ -71,11 +75,13 @@ class RAGsEdge:
     project_name: str = None
     properties: dict = field(default_factory=dict)
 
-    def __key(self):
-        return self.subject_id, self.object_id, self.original_object_id, self.predicate, self.namespace
+    def identity_key(self):
+        # the same relationship from different sources (variant to gene services) is kept as separate edges
+        return self.subject_id, self.object_id, self.original_object_id, self.predicate, self.namespace, self.project_id, \
+            self.provided_by, self.relation
 
     def __hash__(self):
-        return hash(self.__key())
+        return hash(self.identity_key())
 
 
 @dataclass
@@ -0,0 +1,85 @@
+from rags_src.rags_core import RAGsEdge
+
+from hashlib import blake2b
+import math
+
+# edge deduplication modes for the BufferedWriter
+EXACT_EDGE_DEDUP = 'exact'
+BLOOM_EDGE_DEDUP = 'bloom'
+
+
+def get_edge_fingerprint(edge: RAGsEdge):
+    """
+    A compact fixed width (64 bit) fingerprint of an edge's identity key.
+    """
+    return get_key_fingerprint(*edge.identity_key())
+
+
+def get_key_fingerprint(*key_parts):
+    key = '\x1f'.join([str(part) for part in key_parts])
+    return int.from_bytes(blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class EdgeFingerprintSet(object):
+    """
+    Exact edge deduplication that only holds a 64 bit fingerprint per edge instead of the edge itself.
+    """
+    def __init__(self):
+        self.fingerprints = set()
+
+    def add(self, edge: RAGsEdge):
+        """
+        :return: True if the edge was new, False if it was seen before
+        """
+        fingerprint = get_edge_fingerprint(edge)
+        if fingerprint in self.fingerprints:
+            return False
+        self.fingerprints.add(fingerprint)
+        return True
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+
+class EdgeBloomFilter(object):
+    """
+    Bounded probabilistic edge deduplication for very large builds.
+
+    Memory is fixed up front by the expected number of edges and the false positive rate.
+    A false positive means a new edge is treated as a duplicate and skipped, so keep the rate low.
+    """
+    def __init__(self, expected_edges: int, false_positive_rate: float = 0.0001):
+        self.num_bits = max(8, int(-expected_edges * math.log(false_positive_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, round(self.num_bits / expected_edges * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def add(self, edge: RAGsEdge):
+        """
+        :return: True if the edge was (probably) new, False if it was (probably) seen before
+        """
+        fingerprint = get_edge_fingerprint(edge)
+        # derive the bit positions from the two halves of the fingerprint (double hashing)
+        hash_1 = fingerprint & 0xFFFFFFFF
+        hash_2 = fingerprint >> 32
+        new_edge = False
+        for i in range(self.num_hashes):
+            bit = (hash_1 + i * hash_2) % self.num_bits
+            byte_index, bit_mask = bit >> 3, 1 << (bit & 7)
+            if not self.bits[byte_index] & bit_mask:
+                self.bits[byte_index] |= bit_mask
+                new_edge = True
+        if new_edge:
+            self.count += 1
+        return new_edge
+
+    def __len__(self):
+        return self.count
+
+
+def create_edge_dedup(edge_dedup: str, expected_edges: int = None, false_positive_rate: float = 0.0001):
+    if edge_dedup == BLOOM_EDGE_DEDUP:
+        return EdgeBloomFilter(expected_edges if expected_edges else 10000000, false_positive_rate)
+    elif edge_dedup == EXACT_EDGE_DEDUP:
+        return EdgeFingerprintSet()
+    raise ValueError(f'Edge deduplication mode not supported: {edge_dedup}')
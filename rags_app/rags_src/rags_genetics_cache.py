@@ -0,0 +1,171 @@
+from rags_src.util import LoggingUtil
+
+from robokop_genetics.simple_graph_components import SimpleEdge, SimpleNode
+
+from collections import defaultdict
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+logger = LoggingUtil.init_logging("rags.genetics_cache", logging.INFO, format='medium', logFilePath=f'{os.environ["RAGS_HOME"]}/logs/')
+
+NORMALIZATION_CACHE_KEY = 'normalization'
+
+# ids per SELECT .. IN (..) lookup, SQLite allows 999 parameters per statement in older versions
+SQLITE_LOOKUP_BATCH_SIZE = 500
+
+
+class RagsGeneticsCache(object):
+    """
+    A local on-disk cache for robokop_genetics, stored in SQLite.
+
+    It implements the same interface as robokop_genetics.genetics_cache.GeneticsCache, so it can be attached to
+    a GeneticsNormalizer or GeneticsServices in place of the redis cache:
+
+    genetics_normalizer = GeneticsNormalizer(use_cache=False)
+    genetics_normalizer.cache = RagsGeneticsCache(cache_path)
+
+    Variant normalizations are keyed by the variant curie (HGVS, CAID..),
+    variant to gene results are keyed by the service key and the variant curie.
+
+    Hits and misses are counted per key type so hit rates can be reported after a build.
+    """
+    def __init__(self, cache_path: str):
+        self.cache_path = cache_path
+        self.connection = sqlite3.connect(cache_path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS normalizations '
+                                    '(variant_id TEXT PRIMARY KEY, normalization TEXT NOT NULL) WITHOUT ROWID')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS service_results '
+                                    '(service_key TEXT NOT NULL, variant_id TEXT NOT NULL, results TEXT NOT NULL, '
+                                    'PRIMARY KEY (service_key, variant_id)) WITHOUT ROWID')
+        self.lock = threading.Lock()
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+
+    def set_batch_normalization(self, normalization_map: dict):
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO normalizations (variant_id, normalization) VALUES (?, ?)',
+                                        [(variant_id, json.dumps(normalization))
+                                         for variant_id, normalization in normalization_map.items()])
+
+    def get_batch_normalization(self, node_ids: list):
+        normalization_map = {}
+        with self.lock:
+            for (variant_id, normalization) in select_by_ids(self.connection,
+                                                             'SELECT variant_id, normalization FROM normalizations '
+                                                             'WHERE variant_id IN ({ids})',
+                                                             node_ids):
+                normalization_map[variant_id] = json.loads(normalization)
+        self.record_lookups(NORMALIZATION_CACHE_KEY, len(normalization_map), len(node_ids) - len(normalization_map))
+        return normalization_map
+
+    def set_service_results(self, service_key: str, results_dict: dict):
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO service_results (service_key, variant_id, results) '
+                                        'VALUES (?, ?, ?)',
+                                        [(service_key, node_id, encode_service_results(results))
+                                         for node_id, results in results_dict.items()])
+
+    def get_service_results(self, service_key: str, node_ids: list):
+        with self.lock:
+            encoded_results = dict(select_by_ids(self.connection,
+                                                 'SELECT variant_id, results FROM service_results '
+                                                 'WHERE service_key = ? AND variant_id IN ({ids})',
+                                                 node_ids,
+                                                 (service_key,)))
+        decoded_results = [decode_service_results(encoded_results[node_id]) if node_id in encoded_results else None
+                           for node_id in node_ids]
+        hit_count = len([result for result in decoded_results if result is not None])
+        self.record_lookups(service_key, hit_count, len(node_ids) - hit_count)
+        return decoded_results
+
+    def record_lookups(self, key_type: str, hit_count: int, miss_count: int):
+        with self.lock:
+            self.hits[key_type] += hit_count
+            self.misses[key_type] += miss_count
+
+    def get_hit_rates(self):
+        """
+        :return: a dictionary of key type -> (hits, misses, hit rate) for every key type looked up so far
+        """
+        hit_rates = {}
+        with self.lock:
+            for key_type in set(self.hits) | set(self.misses):
+                hits = self.hits[key_type]
+                misses = self.misses[key_type]
+                total = hits + misses
+                hit_rates[key_type] = (hits, misses, hits / total if total else 0.0)
+        return hit_rates
+
+    def log_hit_rates(self):
+        for key_type, (hits, misses, hit_rate) in sorted(self.get_hit_rates().items()):
+            logger.info(f'Genetics cache {key_type}: {hits} hits, {misses} misses ({hit_rate:.1%} hit rate).')
+
+    def close(self):
+        self.connection.close()
+
+
+def select_by_ids(connection: sqlite3.Connection, query: str, ids: list, parameters: tuple = ()):
+    """
+    Run a query with an IN ({ids}) placeholder for a batch of ids at a time.
+    :return: the rows for every batch, parameters come before the ids
+    """
+    ids = list(ids)
+    rows = []
+    for batch_start in range(0, len(ids), SQLITE_LOOKUP_BATCH_SIZE):
+        batch_ids = ids[batch_start:batch_start + SQLITE_LOOKUP_BATCH_SIZE]
+        rows.extend(connection.execute(query.format(ids=', '.join(['?'] * len(batch_ids))),
+                                       (*parameters, *batch_ids)).fetchall())
+    return rows
+
+
+def encode_service_results(service_results: list):
+    encoded_results = []
+    for (edge, node) in service_results:
+        json_node = {"id": node.id, "type": node.type, "name": node.name}
+        json_edge = {"source_id": edge.source_id,
+                     "target_id": edge.target_id,
+                     "provided_by": edge.provided_by,
+                     "input_id": edge.input_id,
+                     "predicate_id": edge.predicate_id,
+                     "predicate_label": edge.predicate_label,
+                     "ctime": edge.ctime,
+                     "properties": edge.properties}
+        encoded_results.append({"edge": json_edge, "node": json_node})
+    return json.dumps(encoded_results)
+
+
+def decode_service_results(encoded_results: str):
+    decoded_results = []
+    for result in json.loads(encoded_results):
+        edge_json = result["edge"]
+        edge = SimpleEdge(source_id=edge_json['source_id'],
+                          target_id=edge_json['target_id'],
+                          provided_by=edge_json['provided_by'],
+                          input_id=edge_json['input_id'],
+                          predicate_id=edge_json['predicate_id'],
+                          predicate_label=edge_json['predicate_label'],
+                          ctime=edge_json['ctime'],
+                          properties=edge_json['properties'])
+        node_json = result["node"]
+        node = SimpleNode(id=node_json["id"],
+                          type=node_json["type"],
+                          name=node_json["name"])
+        decoded_results.append((edge, node))
+    return decoded_results
+
+
+# one cache per file is shared by every builder in the process
+shared_genetics_caches = {}
+
+
+def get_shared_genetics_cache(cache_path: str):
+    if cache_path not in shared_genetics_caches:
+        shared_genetics_caches[cache_path] = RagsGeneticsCache(cache_path)
+        logger.info(f'Using local genetics cache: {cache_path}')
+    return shared_genetics_caches[cache_path]
@@ -1,18 +1,25 @@
 import logging
 import os
 import time
-from itertools import chain
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import chain, islice
 from typing import List
 from dataclasses import dataclass, field
 
 from rags_src.rags_core import *
 from rags_src.rags_file_tools import GWASFileReader, MWASFileReader
-from rags_src.rags_graph_writer import BufferedWriter
-from rags_src.rags_graph_db import RagsGraphDB
+from rags_src.rags_graph_writer import BufferedWriter, OBJECT_PARTITION_KEY
+from rags_src.rags_import_writer import ImportFileWriter
+from rags_src.rags_edge_dedup import EXACT_EDGE_DEDUP
+from rags_src.rags_graph_db import RagsGraphDB, RagsGraphSchemaError
+from rags_src.rags_graph_queries import MARK_VARIANTS_ANNOTATED_QUERY
 from rags_src.rags_project_db_models import RAGsStudy
 from rags_src.rags_file_tools import GWASFile, MWASFile
 from rags_src.util import LoggingUtil
 from rags_src.rags_normalizer import RagsNormalizer
+from rags_src.rags_genetics_cache import get_shared_genetics_cache
+from rags_src.rags_annotation_store import get_shared_annotation_store
+from rags_src.rags_node_registry import get_shared_node_registry
 
 import rags_src.rags_core as rags_core
 
@@ -20,9 +27,22 @@ from robokop_genetics.genetics_services import GeneticsServices, ALL_VARIANT_TO_
 from robokop_genetics.genetics_normalization import GeneticsNormalizer
 
 
+# graph writer modes
+GRAPH_WRITER_MODE = 'graph'
+EXPORT_WRITER_MODE = 'export'
+
 logger = LoggingUtil.init_logging("rags.rags_graph_builder", logging.INFO, format='medium', logFilePath=f'{os.environ["RAGS_HOME"]}/logs/')
 
 
+@dataclass
+class RagsVariantNormalizationProgress:
+    variant_count: int = 0
+    chunk_count: int = 0
+    chunks_done: int = 0
+    variants_normalized: int = 0
+    failed_chunks: int = 0
+
+
 @dataclass
 class RagsGraphBuilderResults:
     warning_messages: list = field(default_factory=list)
@@ -38,19 +58,106 @@ class RAGsGraphBuilder(object):
                  project_name: str,
                  rags_data_directory: str,
                  graph_db: RagsGraphDB,
-                 rags_normalizer: RagsNormalizer = None):
+                 rags_normalizer: RagsNormalizer = None,
+                 variant_normalization_chunk_size: int = 5000,
+                 variant_normalization_workers: int = 4,
+                 genetics_normalizer: GeneticsNormalizer = None):
         self.project_id = project_id
         self.project_name = project_name
-        self.genetics_normalizer = GeneticsNormalizer(use_cache=False)
+        self.genetics_normalizer = genetics_normalizer if genetics_normalizer else GeneticsNormalizer(use_cache=False)
         self.genetics_services = GeneticsServices(use_cache=False)
-        self.writer = BufferedWriter(graph_db)
+        # optionally keep variant to gene annotations for later projects
+        if os.environ.get("RAGS_ANNOTATION_STORE_PATH"):
+            self.annotation_store = get_shared_annotation_store(os.environ["RAGS_ANNOTATION_STORE_PATH"])
+        else:
+            self.annotation_store = None
+        # optionally attach a local on-disk cache for variant normalization and variant to gene results,
+        # the annotation store keeps variant to gene results instead when there is one
+        if os.environ.get("RAGS_GENETICS_CACHE_PATH"):
+            self.genetics_cache = get_shared_genetics_cache(os.environ["RAGS_GENETICS_CACHE_PATH"])
+            self.genetics_normalizer.cache = self.genetics_cache
+            if not self.annotation_store:
+                self.genetics_services.cache = self.genetics_cache
+        else:
+            self.genetics_cache = None
+        self.graph_db = graph_db
+        self.graph_schema_checked = False
+        # (trait id, hit id, p value) for the association edges written since pop_written_associations was last called
+        self.written_associations = []
+        # optionally skip writing nodes that earlier builds already wrote
+        if os.environ.get("RAGS_NODE_REGISTRY_PATH"):
+            self.node_registry = get_shared_node_registry(os.environ["RAGS_NODE_REGISTRY_PATH"])
+        else:
+            self.node_registry = None
+        self.node_registry_checked = False
+        if os.environ.get("RAGS_GRAPH_WRITER", GRAPH_WRITER_MODE) == EXPORT_WRITER_MODE:
+            # write neo4j-admin import files instead of writing to the graph, for first time builds of large projects
+            self.writer = ImportFileWriter(os.path.join(os.environ["RAGS_EXPORT_DIR"], f'project_{project_id}'),
+                                           edge_dedup=os.environ.get("RAGS_EDGE_DEDUP", EXACT_EDGE_DEDUP),
+                                           expected_edges=int(os.environ.get("RAGS_EXPECTED_EDGES", 10000000)))
+        else:
+            self.writer = BufferedWriter(graph_db,
+                                         edge_dedup=os.environ.get("RAGS_EDGE_DEDUP", EXACT_EDGE_DEDUP),
+                                         expected_edges=int(os.environ.get("RAGS_EXPECTED_EDGES", 10000000)),
+                                         background_writers=int(os.environ.get("RAGS_GRAPH_WRITER_THREADS", 1)),
+                                         write_partitions=int(os.environ.get("RAGS_GRAPH_WRITER_PARTITIONS", 1)),
+                                         # every association of a study has the trait as its subject
+                                         edge_partition_key=OBJECT_PARTITION_KEY,
+                                         edge_sync=os.environ.get("RAGS_EDGE_SYNC", "true").lower() == "true",
+                                         node_registry=self.node_registry)
         self.rags_data_directory = rags_data_directory
         self.rags_normalizer = rags_normalizer if rags_normalizer else RagsNormalizer()
+        self.variant_normalization_chunk_size = variant_normalization_chunk_size
+        self.variant_normalization_workers = variant_normalization_workers
         self.association_relation = 'RO:0002610'
         self.normalized_association_predicate = self.fetch_normalized_association_predicate()
 
+    def prepare_graph_writes(self):
+        self.check_graph_schema()
+        self.check_node_registry()
+
+    def check_node_registry(self):
+        """
+        Only use the node registry if it's seeded and a sample of it is in the graph.
+        Otherwise the build writes every node, seeding and reconciling are left to the app (see /node_registry/).
+        """
+        if not self.node_registry or self.node_registry_checked or isinstance(self.writer, ImportFileWriter):
+            return
+        if not self.node_registry.is_seeded():
+            logger.warning(f'The node registry is not seeded yet, writing every node.')
+            self.writer.node_registry = None
+        elif self.node_registry.maintenance_task:
+            logger.warning(f'The node registry is being updated ({self.node_registry.maintenance_task}), writing every node.')
+            self.writer.node_registry = None
+        elif self.node_registry.check_sample(self.graph_db):
+            logger.warning(f'Node registry ids are missing from the graph, the graph was probably reloaded. '
+                           f'Writing every node, reconcile the registry to use it again.')
+            self.writer.node_registry = None
+        self.node_registry_checked = True
+
+    def check_graph_schema(self):
+        """
+        Bulk writes look nodes up by id, without the indexes every lookup is a label scan.
+        Warn about the indexes that aren't online, or refuse to write if RAGS_REQUIRE_GRAPH_SCHEMA is set.
+        Indexes are only created at startup or with POST /graph_schema/, a build doesn't wait for them.
+        """
+        if self.graph_schema_checked or isinstance(self.writer, ImportFileWriter):
+            return
+        relationship_types = [self.normalized_association_predicate]
+        missing_indexes = self.graph_db.get_missing_indexes(relationship_types=relationship_types)
+        if missing_indexes:
+            missing_index_names = ", ".join([f'{index.name} ({state})' for (index, state) in missing_indexes])
+            error_message = f'The graph is missing indexes needed for writing: {missing_index_names}, ' \
+                            f'they can be created with POST /graph_schema/?predicate={self.normalized_association_predicate}'
+            if os.environ.get("RAGS_REQUIRE_GRAPH_SCHEMA", "false").lower() == "true":
+                logger.error(error_message)
+                raise RagsGraphSchemaError(error_message)
+            logger.warning(error_message)
+        self.graph_schema_checked = True
+
     def write_nodes(self,
                     nodes: list):
+        self.prepare_graph_writes()
         for node in nodes:
             self.writer.write_node(node)
         self.writer.flush()
@@ -74,49 +181,141 @@ class RAGsGraphBuilder(object):
 
         return results
 
-    def process_gwas_variants(self, gwas_hits: List[GWASHit]):
+    def process_gwas_variants(self, gwas_hits: List[GWASHit], progress: RagsVariantNormalizationProgress = None):
+        """
+        Normalize the variants of the hits a chunk at a time and write a node for each normalized variant.
+
+        A chunk that fails to normalize doesn't stop the others, the error is returned in the results and its hits
+        are left unnormalized with no nodes written, so the next build tries them again.
+
+        :param progress: a RagsVariantNormalizationProgress that is updated as chunks finish
+        """
+        self.prepare_graph_writes()
+
+        results = RagsGraphBuilderResults()
+        if progress is None:
+            progress = RagsVariantNormalizationProgress()
+
+        # original id -> original name, used for variants that fail normalization
+        variant_names = {}
+        for hit in gwas_hits:
+            if hit.original_id not in variant_names:
+                variant_names[hit.original_id] = hit.original_name
+        variant_ids = list(variant_names.keys())
+        chunk_size = self.variant_normalization_chunk_size
+        variant_id_chunks = [variant_ids[i: i + chunk_size] for i in range(0, len(variant_ids), chunk_size)]
+        progress.variant_count = len(variant_ids)
+        progress.chunk_count = len(variant_id_chunks)
+        logger.info(f'Found {len(variant_ids)} sequence variant nodes to normalize. '
+                    f'Normalizing in {len(variant_id_chunks)} chunks...')
 
-        variant_ids = list(set([hit.original_id for hit in gwas_hits]))
-        logger.info(f'Found {len(variant_ids)} sequence variant nodes to normalize. Normalizing...')
         variant_norm_failures = []
+        failed_chunk_variant_ids = set()
         variant_node_types = frozenset(self.genetics_normalizer.get_sequence_variant_node_types())
-        sequence_variant_normalizations = self.genetics_normalizer.normalize_variants(variant_ids)
-        normalized_variant_nodes = []
-        for gwas_hit in gwas_hits:
-            gwas_hit.normalized = True
-            original_id = gwas_hit.original_id
-            normalized_info = sequence_variant_normalizations[original_id]
-            if normalized_info:
+        # original id -> (normalized id, normalized name), only for successful normalizations
+        variant_normalizations = {}
+        variant_node_ids = set()
+        start_time = time.time()
+        for variant_id_chunk, chunk_normalizations, chunk_error in self.normalize_variant_chunks(variant_id_chunks):
+            if chunk_error is not None:
+                error_message = f'Normalizing a chunk of {len(variant_id_chunk)} variants failed: {chunk_error}'
+                logger.error(error_message)
+                results.error_messages.append(error_message)
+                progress.failed_chunks += 1
+                failed_chunk_variant_ids.update(variant_id_chunk)
+                chunk_normalizations = {}
+            for original_id, normalized_info in chunk_normalizations.items():
                 # sequence variant normalization returns a list of results but assume there is only one item or nothing
                 # this is because we always start with unambiguous IDs for RAGs GWAS variants
-                normalized_id = normalized_info[0]["id"]
-                gwas_hit.normalized_id = normalized_id
-                normalized_name = normalized_info[0]["name"]
-                gwas_hit.normalized_name = normalized_name
-                equivalent_identifiers = normalized_info[0]["equivalent_identifiers"]
-            else:
-                variant_norm_failures.append(original_id)
-                normalized_id = original_id
-                normalized_name = gwas_hit.original_name
-                equivalent_identifiers = set()
-
-            variant_node = RAGsNode(normalized_id,
-                                    type=SEQUENCE_VARIANT,
-                                    name=normalized_name,
-                                    all_types=variant_node_types,
-                                    synonyms=equivalent_identifiers)
-            normalized_variant_nodes.append(variant_node)
-
-        self.write_nodes(normalized_variant_nodes)
+                if normalized_info and "id" in normalized_info[0]:
+                    normalized_id = normalized_info[0]["id"]
+                    normalized_name = normalized_info[0]["name"]
+                    equivalent_identifiers = normalized_info[0]["equivalent_identifiers"]
+                    variant_normalizations[original_id] = (normalized_id, normalized_name)
+                else:
+                    variant_norm_failures.append(original_id)
+                    normalized_id = original_id
+                    normalized_name = variant_names[original_id]
+                    equivalent_identifiers = set()
+
+                # create exactly one node per normalized variant
+                if normalized_id not in variant_node_ids:
+                    variant_node_ids.add(normalized_id)
+                    # only set when the node is created, variants from earlier builds keep their annotation state
+                    self.writer.write_node(RAGsNode(normalized_id,
+                                                    type=SEQUENCE_VARIANT,
+                                                    name=normalized_name,
+                                                    properties={RAGS_ANNOTATED_PROPERTY: False},
+                                                    all_types=variant_node_types,
+                                                    synonyms=equivalent_identifiers))
+
+            progress.chunks_done += 1
+            progress.variants_normalized += len(variant_id_chunk)
+            elapsed_time = time.time() - start_time
+            logger.info(f'Normalized variant chunk {progress.chunks_done} of {progress.chunk_count} '
+                        f'({progress.variants_normalized}/{progress.variant_count} variants, '
+                        f'{progress.variants_normalized / elapsed_time if elapsed_time else 0:.1f} variants/s).')
+        self.writer.flush()
+
+        for gwas_hit in gwas_hits:
+            if gwas_hit.original_id in failed_chunk_variant_ids:
+                continue
+            gwas_hit.normalized = True
+            if gwas_hit.original_id in variant_normalizations:
+                gwas_hit.normalized_id, gwas_hit.normalized_name = variant_normalizations[gwas_hit.original_id]
+
+        if self.genetics_cache:
+            self.genetics_cache.log_hit_rates()
         if variant_norm_failures:
             logger.warning(f'Processing GWAS variants, these failed normalization: {", ".join(variant_norm_failures)}')
-        logger.info(f'Writing variant nodes complete.')
+        logger.info(f'Writing {len(variant_node_ids)} variant nodes complete.')
+
+        results.success = True
+        results.success_message = f'Wrote {len(variant_node_ids)} variant nodes for {len(gwas_hits)} hits.'
+        return results
 
-        return len(gwas_hits)
+    def normalize_variant_chunks(self, variant_id_chunks: list):
+        """
+        Normalize chunks of variant ids on a pool of workers, yielding (chunk, normalizations, error) as each completes.
+        A chunk that failed has no normalizations and the exception as its error.
+
+        Only a bounded number of chunks are in flight at a time so results don't pile up in memory
+        faster than the caller can write them.
+        """
+        max_in_flight = self.variant_normalization_workers * 2
+        chunk_iterator = iter(variant_id_chunks)
+        # future -> chunk of variant ids
+        pending = {}
+        with ThreadPoolExecutor(max_workers=self.variant_normalization_workers) as executor:
+            try:
+                for chunk in islice(chunk_iterator, max_in_flight):
+                    pending[executor.submit(self.genetics_normalizer.normalize_variants, chunk)] = chunk
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for chunk_future in done:
+                        for chunk in islice(chunk_iterator, 1):
+                            pending[executor.submit(self.genetics_normalizer.normalize_variants, chunk)] = chunk
+                        chunk = pending.pop(chunk_future)
+                        try:
+                            chunk_normalizations = chunk_future.result()
+                        except Exception as e:
+                            yield chunk, None, e
+                        else:
+                            yield chunk, chunk_normalizations, None
+            except BaseException:
+                for chunk_future in pending:
+                    chunk_future.cancel()
+                raise
 
     def process_gwas_associations(self,
                                   gwas_study: RAGsStudy,
-                                  gwas_hits: List[GWASHit]):
+                                  gwas_hits: List[GWASHit],
+                                  full_rewrite: bool = False):
+        """
+        Write the associations for a study. With full_rewrite the hits are all of the study's associations,
+        any association edges previously written for the study that aren't among them are removed.
+        """
+        self.prepare_graph_writes()
 
         associations_written_count = 0
         missing_variants_count = 0
@@ -137,6 +336,9 @@ class RAGsGraphBuilder(object):
                 unique_gwas_hits.append(hit)
                 already_added.add(hit.original_id)
 
+        if full_rewrite:
+            self.writer.start_edge_sync(predicate, self.project_id, gwas_study.study_name)
+
         with GWASFileReader(gwas_file, use_tabix=gwas_file.has_tabix) as gwas_file_reader:
             creation_time = int(time.time())
             logger.info(f'Reading {len(unique_gwas_hits)} GWAS associations from file!')
@@ -162,13 +364,15 @@ class RAGsGraphBuilder(object):
                                             project_name=self.project_name,
                                             properties=properties)
 
-                        self.writer.write_edge(new_edge)
-                        associations_written_count += 1
+                        # a duplicate association (the same hit more than once in a study) is only written once
+                        if self.writer.write_edge(new_edge):
+                            self.written_associations.append((normalized_trait_id, new_edge.object_id, association.p_value))
+                            associations_written_count += 1
                     else:
                         p_value_too_high += 1
                 else:
                     missing_variants_count += 1
-            if not gwas_study.num_associations:
+            if full_rewrite or not gwas_study.num_associations:
                 gwas_study.num_associations = associations_written_count
             else:
                 gwas_study.num_associations += associations_written_count
@@ -182,17 +386,38 @@ class RAGsGraphBuilder(object):
         else:
             logger.debug(f'{gwas_study.study_name} failed to find any new valid associations.')
 
-        self.writer.flush()
+        if full_rewrite:
+            self.writer.finish_edge_sync(predicate, self.project_id, gwas_study.study_name)
+        else:
+            self.writer.flush()
 
         return True
 
     def add_genes_to_variants(self, variants: list):
+        self.prepare_graph_writes()
 
         logger.info(f'Finding gene relationships.')
 
         variant_nodes = [RAGsNode(v["id"], SEQUENCE_VARIANT, None, synonyms=v["equivalent_identifiers"]) for v in variants]
 
-        v_to_gene_results = self.genetics_services.get_variant_to_gene(ALL_VARIANT_TO_GENE_SERVICES, variant_nodes)
+        if self.annotation_store:
+            v_to_gene_results = self.annotation_store.get_results([node.id for node in variant_nodes])
+            variant_nodes_to_look_up = [node for node in variant_nodes if node.id not in v_to_gene_results]
+        else:
+            v_to_gene_results = {}
+            variant_nodes_to_look_up = variant_nodes
+        if variant_nodes_to_look_up:
+            service_results = self.genetics_services.get_variant_to_gene(ALL_VARIANT_TO_GENE_SERVICES,
+                                                                         variant_nodes_to_look_up)
+            v_to_gene_results.update(service_results)
+            if self.annotation_store:
+                # variants without genes are stored too, so they aren't looked up again
+                self.annotation_store.set_results({node.id: service_results.get(node.id, [])
+                                                   for node in variant_nodes_to_look_up})
+        if self.genetics_cache:
+            self.genetics_cache.log_hit_rates()
+        if self.annotation_store:
+            self.annotation_store.log_stats()
 
         logger.info(f'Normalizing genes.')
         gene_node_ids = [node.id for (edge, node) in chain.from_iterable(v_to_gene_results.values())]
@@ -233,9 +458,25 @@ class RAGsGraphBuilder(object):
             logger.error(f'Variant to gene annotations had these predicates that failed normalization: {failed_predicates}')
 
         self.writer.flush()
+        # including the variants that have no genes, so they aren't looked up again
+        if isinstance(self.writer, ImportFileWriter):
+            variant_node_types = frozenset(self.genetics_normalizer.get_sequence_variant_node_types())
+            for variant in variants:
+                self.writer.write_node_update(RAGsNode(variant["id"],
+                                                       type=SEQUENCE_VARIANT,
+                                                       name=variant["name"],
+                                                       properties={RAGS_ANNOTATED_PROPERTY: True},
+                                                       all_types=variant_node_types,
+                                                       synonyms=variant["equivalent_identifiers"]))
+            self.writer.flush()
+        else:
+            self.graph_db.run_named_query(MARK_VARIANTS_ANNOTATED_QUERY,
+                                          {'variant_ids': [variant_node.id for variant_node in variant_nodes]},
+                                          write=True)
         logger.info(f'Writing variant to gene relationships complete.')
 
     def process_mwas_metabolites(self, mwas_hits: List[MWASHit]):
+        self.prepare_graph_writes()
 
         results = RagsGraphBuilderResults()
 
@@ -274,7 +515,13 @@ class RAGsGraphBuilder(object):
 
     def process_mwas_associations(self,
                                   mwas_study: RAGsStudy,
-                                  mwas_hits: List[MWASHit]):
+                                  mwas_hits: List[MWASHit],
+                                  full_rewrite: bool = False):
+        """
+        Write the associations for a study. With full_rewrite the hits are all of the study's associations,
+        any association edges previously written for the study that aren't among them are removed.
+        """
+        self.prepare_graph_writes()
 
         associations_written_count = 0
         missing_metabolites_count = 0
@@ -290,6 +537,9 @@ class RAGsGraphBuilder(object):
             if hit.original_id not in unique_mwas_hits:
                 unique_mwas_hits.append(hit)
 
+        if full_rewrite:
+            self.writer.start_edge_sync(predicate, self.project_id, mwas_study.study_name)
+
         with MWASFileReader(mwas_file) as mwas_file_reader:
             creation_time = int(time.time())
             for mwas_hit in unique_mwas_hits:
@@ -314,13 +564,15 @@ class RAGsGraphBuilder(object):
                                             project_name=self.project_name,
                                             properties=properties)
 
-                        self.writer.write_edge(new_edge)
-                        associations_written_count += 1
+                        # a duplicate association (the same hit more than once in a study) is only written once
+                        if self.writer.write_edge(new_edge):
+                            self.written_associations.append((normalized_trait_id, new_edge.object_id, association.p_value))
+                            associations_written_count += 1
                     elif mwas_study.max_p_value:
                         p_value_too_high += 1
                 else:
                     missing_metabolites_count += 1
-            if not mwas_study.num_associations:
+            if full_rewrite or not mwas_study.num_associations:
                 mwas_study.num_associations = associations_written_count
             else:
                 mwas_study.num_associations += associations_written_count
@@ -334,10 +586,18 @@ class RAGsGraphBuilder(object):
         else:
             logger.info(f'{mwas_study.study_name} failed to find any new valid associations.')
 
-        self.writer.flush()
+        if full_rewrite:
+            self.writer.finish_edge_sync(predicate, self.project_id, mwas_study.study_name)
+        else:
+            self.writer.flush()
 
         return True
 
+    def pop_written_associations(self):
+        written_associations = self.written_associations
+        self.written_associations = []
+        return written_associations
+
     def get_real_file_path(self, study: RAGsStudy):
         return f'{self.rags_data_directory}/{study.file_path}'
 
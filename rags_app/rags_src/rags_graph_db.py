@@ -1,10 +1,21 @@
 import os
 import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from hashlib import blake2b
 
-from neo4j import GraphDatabase
-from neo4j.exceptions import ServiceUnavailable
+from neo4j import GraphDatabase, unit_of_work, READ_ACCESS, WRITE_ACCESS
+from neo4j.exceptions import Neo4jError, ServiceUnavailable
 
 from rags_src.util import LoggingUtil
+from rags_src.rags_graph_queries import get_graph_query, get_graph_query_text, DEFAULT_ASSOCIATION_PREDICATE, \
+    DELETE_NAMESPACE_EDGES_QUERY, DELETE_PROJECT_EDGES_QUERY, KILL_TAGGED_QUERIES_QUERY, CUSTOM_QUERY, QUERY_TAG_METADATA_KEY, \
+    BACKFILL_ANNOTATION_STATE_QUERY
+from rags_src.rags_graph_schema import get_required_indexes, get_index_states, parse_index_records, \
+    parse_neo4j_version, INDEX_MISSING, INDEX_ONLINE, INDEX_UNSUPPORTED, INDEX_NOT_UNIQUE
 
 
 logger = LoggingUtil.init_logging("rags.rags_graph_db", logging.INFO,
@@ -17,20 +28,46 @@ class RagsGraphDBConnectionError(Exception):
         self.message = error_message
 
 
+class RagsGraphSchemaError(Exception):
+    def __init__(self, error_message: str):
+        self.message = error_message
+
+
+class RagsGraphQueryCancelled(Exception):
+    def __init__(self, error_message: str):
+        self.message = error_message
+
+
+@dataclass
+class RagsGraphDeleteProgress:
+    project_id: int
+    deleted_count: int = 0
+    current_namespace: str = None
+    finished: bool = False
+    error_message: str = None
+
+
 class RagsGraphDB(object):
     """
     This is just a wrapper for the graph db driver.
 
-    For now that means the official Neo4j driver.
+    For now that means the official Neo4j driver. One driver, and with it one connection pool,
+    is shared by the whole process (see open_shared_driver), so creating a RagsGraphDB is cheap.
+
+    query_timeout (seconds) and query_metadata apply to every query run through run_named_query and the custom
+    queries. Neo4j stops transactions that run past the timeout, and queries tagged with metadata can be
+    stopped early with kill_queries. After cancel(), any further query raises RagsGraphQueryCancelled instead of running.
+
+    A driver can be passed in instead of the shared one, for tests or a separate database.
     """
-    def __init__(self):
-        try:
-            self.graph_db_driver = GraphDatabase.driver(f"bolt://{os.environ['NEO4J_HOST']}:{os.environ['NEO4J_BOLT_PORT']}",
-                                                        auth=("neo4j", os.environ['NEO4J_PASSWORD']))
-        except ServiceUnavailable as e:
-            raise RagsGraphDBConnectionError(e)
-        except ValueError as e:
-            raise RagsGraphDBConnectionError(e)
+    def __init__(self, query_timeout: float = None, query_metadata: dict = None, driver=None):
+        self.graph_db_driver = driver if driver else get_shared_driver()
+        self.query_timeout = query_timeout
+        self.query_metadata = query_metadata
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
 
     """
     Retrieve a session from the driver, this should be used as a context manager.
@@ -40,46 +77,397 @@ class RagsGraphDB(object):
         session.write_transaction()
         ...
     """
-    def get_session(self):
-        return self.graph_db_driver.session()
+    @contextmanager
+    def get_session(self, access_mode: str = WRITE_ACCESS):
+        # a session holds at most one pooled connection at a time, counting open sessions shows how busy the pool is
+        shared_driver_stats.session_opened()
+        try:
+            with self.graph_db_driver.session(default_access_mode=access_mode) as session:
+                yield session
+        finally:
+            shared_driver_stats.session_closed()
+
+    def get_pool_stats(self):
+        return get_shared_driver_stats()
 
-    def custom_read_query(self, query: str, limit: int = None) -> list:
+    def custom_read_query(self, query: str, limit: int = None, parameters: dict = None) -> list:
 
+        parameters = dict(parameters) if parameters else {}
         if limit is not None:
-            query += f' limit {limit}'
-        logger.debug(f'graph db query: {query}')
+            # the limit is a parameter too, so the query text (and its plan) is the same for any limit
+            query += ' LIMIT $limit'
+            parameters['limit'] = limit
+        return self.run_query_text(CUSTOM_QUERY, query, parameters)
+
+    def custom_write_query(self, query: str, parameters: dict = None) -> bool:
+
+        self.run_query_text(CUSTOM_QUERY, query, parameters if parameters else {}, write=True)
+        return True
+
+    def run_named_query(self,
+                        query_name: str,
+                        parameters: dict = None,
+                        predicate: str = DEFAULT_ASSOCIATION_PREDICATE,
+                        write: bool = False) -> list:
+        """
+        Run a query from the named query registry (see rags_graph_queries), values go in parameters.
+        """
+        return self.run_query_text(query_name, get_graph_query_text(query_name, predicate), parameters if parameters else {}, write)
+
+    def run_query_text(self, query_name: str, query: str, parameters: dict, write: bool = False) -> list:
+        if self.cancelled.is_set():
+            # a read made of several queries stops between them
+            raise RagsGraphQueryCancelled(f'Graph query {query_name} was not run, the read was cancelled.')
+        logger.debug(f'graph db query: {query} {parameters}')
+        transaction_function = run_timed_query
+        if self.query_timeout or self.query_metadata:
+            transaction_function = unit_of_work(metadata=self.query_metadata, timeout=self.query_timeout)(run_timed_query)
         try:
             with self.get_session() as session:
-                results = session.read_transaction(run_query, query)
+                if write:
+                    results = session.write_transaction(transaction_function, query_name, query, parameters)
+                else:
+                    results = session.read_transaction(transaction_function, query_name, query, parameters)
                 logger.debug(f'graph db response: {results}')
         except ServiceUnavailable as e:
             raise RagsGraphDBConnectionError(e)
         except ValueError as e:
             raise RagsGraphDBConnectionError(e)
+        except Neo4jError as e:
+            # the transaction timed out or was killed
+            if e.code and ('TimedOut' in e.code or 'Terminated' in e.code):
+                raise RagsGraphQueryCancelled(f'Graph query {query_name} was stopped: {e.message}')
+            raise
 
         return results
 
-    def custom_write_query(self, query: str) -> bool:
+    def kill_queries(self, query_tag: str):
+        """
+        Stop the running queries that were tagged with query_tag in their metadata (see get_query_tag_metadata).
+        :return: the number of queries stopped
+        """
+        # without this graph db's tag and timeout, or the listQueries query would find (and kill) itself
+        untagged_graph_db = RagsGraphDB(driver=self.graph_db_driver)
+        killed_counts = untagged_graph_db.run_named_query(KILL_TAGGED_QUERIES_QUERY, {'query_tag': query_tag}, write=True)
+        killed_count = killed_counts[0]['killed_count'] if killed_counts else 0
+        if killed_count:
+            logger.info(f'Stopped {killed_count} graph queries tagged {query_tag}.')
+        return killed_count
+
+    def stream_named_query(self,
+                           query_name: str,
+                           parameters: dict = None,
+                           predicate: str = DEFAULT_ASSOCIATION_PREDICATE):
+        """
+        Yield every result of a query without holding them all in memory.
+
+        The query runs once, in a single read transaction with the query_timeout and query_metadata,
+        and records are read from the driver's cursor (a fetch at a time) as the caller asks for them.
+        The transaction stays open until the last record is read, the timeout has to allow for a slow reader.
+        """
+        if self.cancelled.is_set():
+            raise RagsGraphQueryCancelled(f'Graph query {query_name} was not run, the read was cancelled.')
+        query = get_graph_query_text(query_name, predicate)
+        try:
+            with self.get_session(access_mode=READ_ACCESS) as session:
+                with session.begin_transaction(metadata=self.query_metadata, timeout=self.query_timeout) as tx:
+                    start_time = time.time()
+                    result = tx.run(query, parameters if parameters else {})
+                    for record in result:
+                        yield record
+                    summary = result.consume()
+                    graph_query_stats.record(query_name, query, time.time() - start_time,
+                                             summary.result_available_after, summary.result_consumed_after)
+        except ServiceUnavailable as e:
+            raise RagsGraphDBConnectionError(e)
+
+    def get_query_stats(self):
+        return get_graph_query_stats()
 
-        logger.debug(f'graph db query: {query}')
+    def get_neo4j_version(self):
+        with self.get_session() as session:
+            components = session.read_transaction(run_query, 'CALL dbms.components() YIELD name, versions')
+        for component in components:
+            if component['name'] == 'Neo4j Kernel':
+                return parse_neo4j_version(component['versions'][0])
+        return parse_neo4j_version(components[0]['versions'][0]) if components else (0, 0)
+
+    def get_schema_report(self, relationship_types: list = ()):
+        """
+        :return: a list of (RagsGraphIndex, state) for every index RAGs needs
+        """
         try:
+            neo4j_version = self.get_neo4j_version()
             with self.get_session() as session:
-                results = session.write_transaction(run_query, query)
-                logger.debug(f'graph db response: {results}')
+                index_records = session.read_transaction(run_query, 'CALL db.indexes()')
         except ServiceUnavailable as e:
             raise RagsGraphDBConnectionError(e)
-        except ValueError as e:
+        existing_index_states = parse_index_records([index_record.data() for index_record in index_records])
+        return get_index_states(get_required_indexes(relationship_types), existing_index_states, neo4j_version)
+
+    def get_missing_indexes(self, relationship_types: list = ()):
+        """
+        :return: a list of (RagsGraphIndex, state) for the required indexes that aren't online, not counting unsupported ones
+        """
+        return [(index, state) for (index, state) in self.get_schema_report(relationship_types)
+                if state not in (INDEX_ONLINE, INDEX_UNSUPPORTED, INDEX_NOT_UNIQUE)]
+
+    def ensure_schema(self, relationship_types: list = (), timeout_seconds: int = 300):
+        """
+        Create any missing indexes and wait for them to come online.
+        :return: the schema report after waiting
+        """
+        try:
+            neo4j_version = self.get_neo4j_version()
+            for (index, state) in self.get_schema_report(relationship_types):
+                if state == INDEX_MISSING:
+                    logger.info(f'Creating graph {"constraint" if index.unique else "index"} {index.name}.')
+                    try:
+                        with self.get_session() as session:
+                            session.run(index.get_create_query(neo4j_version)).consume()
+                    except Neo4jError as e:
+                        # a uniqueness constraint can't be created while there are duplicates
+                        logger.warning(f'Creating graph index {index.name} failed: {e}')
+            with self.get_session() as session:
+                session.run(f'CALL db.awaitIndexes({timeout_seconds})').consume()
+        except Neo4jError as e:
+            # a failed index or a timeout, the report below shows which
+            logger.warning(f'Waiting for graph indexes failed: {e}')
+        except ServiceUnavailable as e:
             raise RagsGraphDBConnectionError(e)
 
-        return True
+        schema_report = self.get_schema_report(relationship_types)
+        for (index, state) in schema_report:
+            if state == INDEX_ONLINE:
+                logger.info(f'Graph index {index.name}: {state}')
+            elif state == INDEX_NOT_UNIQUE:
+                # the existing index has to be dropped before the constraint can be created, that's left to an admin
+                logger.warning(f'Graph index {index.name}: {state}, drop the index and restart to create the constraint')
+            else:
+                logger.warning(f'Graph index {index.name}: {state}')
+        return schema_report
 
-    def delete_project(self, project_id: int):
-        with self.get_session() as session:
-            session.run(f'match (a)-[r{{project_id:{project_id}}}]-(b) delete r')
+    def backfill_annotation_state(self, predicate: str = DEFAULT_ASSOCIATION_PREDICATE, batch_size: int = 10000):
+        """
+        Set the annotation state of variants that were written before it was tracked, batch_size variants per transaction.
+        Only variants with a RAGs association (predicate) are marked, the ones that already have nearby genes
+        as annotated and the rest are left for the next annotation.
+
+        Every variant is checked once, in id order, so this reads the whole graph's variants and can take a while.
+        :return: the number of variants updated
+        """
+        updated_count = 0
+        checked_count = 0
+        # every id sorts after this
+        last_id = ''
+        while True:
+            records = self.run_named_query(BACKFILL_ANNOTATION_STATE_QUERY,
+                                           {'last_id': last_id, 'batch_size': batch_size},
+                                           predicate=predicate,
+                                           write=True)
+            batch_checked_count = records[0]['checked_count'] if records else 0
+            if batch_checked_count:
+                checked_count += batch_checked_count
+                updated_count += records[0]['updated_count']
+                last_id = records[0]['last_id']
+            if batch_checked_count < batch_size:
+                break
+            logger.info(f'Backfilling variant annotation state: {checked_count} variants checked, {updated_count} updated.')
+        logger.info(f'Backfilled variant annotation state: {checked_count} variants checked, {updated_count} updated.')
+        return updated_count
+
+    def delete_project(self,
+                       project_id: int,
+                       study_trait_ids: dict = None,
+                       batch_size: int = 10000,
+                       progress: RagsGraphDeleteProgress = None,
+                       predicate: str = DEFAULT_ASSOCIATION_PREDICATE):
+        """
+        Delete a project's edges from the graph, batch_size edges per transaction.
+
+        Every batch is committed on its own, so an interrupted delete can simply be run again.
+        If the delete fails for any reason, progress.error_message says why.
 
-    def __del__(self):
-        if self.graph_db_driver:
-            self.graph_db_driver.close()
+        :param study_trait_ids: a dictionary of namespace (study name) -> trait node id,
+        deleting from the trait node out uses the id index instead of scanning every relationship
+        :param progress: a RagsGraphDeleteProgress that is updated as batches are deleted
+        :param predicate: the association predicate, project edges that weren't reached from a trait are only
+        looked for among relationships of this type
+        :return: the number of edges deleted
+        """
+        if progress is None:
+            progress = RagsGraphDeleteProgress(project_id)
+        try:
+            for namespace, trait_id in (study_trait_ids or {}).items():
+                progress.current_namespace = namespace
+                self.delete_in_batches(DELETE_NAMESPACE_EDGES_QUERY,
+                                       {'trait_id': trait_id, 'project_id': project_id, 'namespace': namespace},
+                                       batch_size,
+                                       progress)
+            # anything left that wasn't reached from a trait
+            progress.current_namespace = None
+            self.delete_in_batches(DELETE_PROJECT_EDGES_QUERY, {'project_id': project_id}, batch_size, progress, predicate)
+        except ServiceUnavailable as e:
+            progress.error_message = f'Error connecting to the graph database: {e}'
+            raise RagsGraphDBConnectionError(e)
+        except Exception as e:
+            # a deadlock, a transient error that outlasted the retries, running out of memory..
+            progress.error_message = f'Deleting from the graph failed: {e}'
+            raise
+
+        progress.finished = True
+        logger.info(f'Deleting project {project_id} from the graph complete, {progress.deleted_count} edges deleted.')
+        return progress.deleted_count
+
+    def delete_in_batches(self,
+                          query_name: str,
+                          parameters: dict,
+                          batch_size: int,
+                          progress: RagsGraphDeleteProgress,
+                          predicate: str = DEFAULT_ASSOCIATION_PREDICATE):
+        delete_query = get_graph_query_text(query_name, predicate)
+        parameters = {**parameters, 'batch_size': batch_size}
+        while True:
+            with self.get_session() as session:
+                deleted_count = session.write_transaction(run_delete_query, query_name, delete_query, parameters)
+            if not deleted_count:
+                return
+            progress.deleted_count += deleted_count
+            logger.info(f'Deleting project {progress.project_id} from the graph: {progress.deleted_count} edges deleted '
+                        f'({progress.current_namespace if progress.current_namespace else "remaining edges"}).')
+
+
+class SharedDriverStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.created_time = None
+        self.sessions_opened = 0
+        self.sessions_open = 0
+        self.max_sessions_open = 0
+
+    def session_opened(self):
+        with self.lock:
+            self.sessions_opened += 1
+            self.sessions_open += 1
+            self.max_sessions_open = max(self.max_sessions_open, self.sessions_open)
+
+    def session_closed(self):
+        with self.lock:
+            self.sessions_open -= 1
+
+
+class GraphQueryStats(object):
+    """
+    Timings for every query run through RagsGraphDB, by query name.
+
+    available_after is how long the server took before the first result was ready, that includes planning,
+    so it drops once a query's plan is cached. A query name with many distinct query texts means values are
+    being put in the query text instead of parameters and every call is planned again.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.query_count = defaultdict(int)
+        self.total_seconds = defaultdict(float)
+        self.total_available_after = defaultdict(int)
+        self.total_consumed_after = defaultdict(int)
+        self.first_available_after = {}
+        self.query_texts = defaultdict(set)
+
+    def record(self, query_name: str, query: str, seconds: float, available_after: int, consumed_after: int):
+        query_hash = blake2b(query.encode('utf-8'), digest_size=8).digest()
+        with self.lock:
+            self.query_count[query_name] += 1
+            self.total_seconds[query_name] += seconds
+            self.total_available_after[query_name] += available_after or 0
+            self.total_consumed_after[query_name] += consumed_after or 0
+            self.first_available_after.setdefault(query_name, available_after)
+            self.query_texts[query_name].add(query_hash)
+
+    def get_stats(self):
+        with self.lock:
+            return {query_name: {'count': query_count,
+                                 'total_ms': round(self.total_seconds[query_name] * 1000, 1),
+                                 'avg_ms': round(self.total_seconds[query_name] * 1000 / query_count, 1),
+                                 'first_available_after_ms': self.first_available_after[query_name],
+                                 'avg_available_after_ms': round(self.total_available_after[query_name] / query_count, 1),
+                                 'avg_consumed_after_ms': round(self.total_consumed_after[query_name] / query_count, 1),
+                                 'distinct_query_texts': len(self.query_texts[query_name])}
+                    for query_name, query_count in self.query_count.items()}
+
+
+shared_driver = None
+shared_driver_lock = threading.Lock()
+shared_driver_stats = SharedDriverStats()
+graph_query_stats = GraphQueryStats()
+
+
+def get_driver_config():
+    return {'max_connection_pool_size': int(os.environ.get('NEO4J_MAX_CONNECTION_POOL_SIZE', 100)),
+            'connection_acquisition_timeout': float(os.environ.get('NEO4J_CONNECTION_ACQUISITION_TIMEOUT', 60)),
+            'max_connection_lifetime': float(os.environ.get('NEO4J_MAX_CONNECTION_LIFETIME', 3600)),
+            'connection_timeout': float(os.environ.get('NEO4J_CONNECTION_TIMEOUT', 30))}
+
+
+def open_shared_driver():
+    """
+    Create the process wide driver if it doesn't exist yet. The app calls this at startup,
+    otherwise it happens the first time a RagsGraphDB is created.
+    """
+    global shared_driver
+    with shared_driver_lock:
+        if shared_driver is None:
+            driver_config = get_driver_config()
+            try:
+                shared_driver = GraphDatabase.driver(f"bolt://{os.environ['NEO4J_HOST']}:{os.environ['NEO4J_BOLT_PORT']}",
+                                                     auth=("neo4j", os.environ['NEO4J_PASSWORD']),
+                                                     **driver_config)
+            except ServiceUnavailable as e:
+                raise RagsGraphDBConnectionError(e)
+            except ValueError as e:
+                raise RagsGraphDBConnectionError(e)
+            shared_driver_stats.created_time = time.time()
+            logger.info(f'Created the shared graph db driver: {driver_config}')
+        return shared_driver
+
+
+def get_shared_driver():
+    return shared_driver if shared_driver is not None else open_shared_driver()
+
+
+def close_shared_driver():
+    global shared_driver
+    with shared_driver_lock:
+        if shared_driver is not None:
+            shared_driver.close()
+            shared_driver = None
+            logger.info(f'Closed the shared graph db driver.')
+
+
+def get_shared_driver_stats():
+    """
+    :return: a dictionary of the shared driver's configured limits and the sessions RagsGraphDB has open on it
+
+    The driver doesn't expose its connection pool, but every open session holds at most one connection,
+    sessions_open close to max_connection_pool_size means requests are waiting on connections.
+    """
+    with shared_driver_stats.lock:
+        return {'driver_open': shared_driver is not None,
+                'driver_age_seconds': int(time.time() - shared_driver_stats.created_time) if shared_driver else None,
+                'sessions_opened': shared_driver_stats.sessions_opened,
+                'sessions_open': shared_driver_stats.sessions_open,
+                'max_sessions_open': shared_driver_stats.max_sessions_open,
+                **get_driver_config()}
+
+
+def get_query_tag_metadata(query_tag: str):
+    return {QUERY_TAG_METADATA_KEY: query_tag}
+
+
+def get_graph_query_stats():
+    """
+    :return: a dictionary of query name -> timings for every query run in this process
+    """
+    return graph_query_stats.get_stats()
 
 
 def run_query(tx, query):
@@ -87,3 +475,20 @@ def run_query(tx, query):
     return list(results)
 
 
+def run_timed_query(tx, query_name: str, query: str, parameters: dict):
+    start_time = time.time()
+    result = tx.run(query, parameters)
+    records = list(result)
+    summary = result.consume()
+    graph_query_stats.record(query_name, query, time.time() - start_time,
+                             summary.result_available_after, summary.result_consumed_after)
+    return records
+
+
+def run_delete_query(tx, query_name: str, query: str, parameters: dict):
+    start_time = time.time()
+    deleted_count = tx.run(query, parameters).single()['deleted_count']
+    graph_query_stats.record(query_name, query, time.time() - start_time, None, None)
+    return deleted_count
+
+
@@ -0,0 +1,123 @@
+from rags_src.rags_core import ROOT_ENTITY, SEQUENCE_VARIANT, CHEMICAL_SUBSTANCE, RAGS_ANNOTATED_PROPERTY
+
+from dataclasses import dataclass
+
+# the association predicate RAGs writes, unless edge normalization says otherwise
+DEFAULT_ASSOCIATION_PREDICATE = 'biolink:correlated_with'
+NEARBY_VARIANT_PREDICATE = 'biolink:is_nearby_variant_of'
+
+# relationship types can't be query parameters, query templates use this placeholder for the association predicate
+PREDICATE_PLACEHOLDER = '{predicate}'
+
+# queries are tagged with this transaction metadata key so they can be found (and stopped) in dbms.listQueries
+QUERY_TAG_METADATA_KEY = 'rags_query_tag'
+
+# named graph queries
+PROJECT_VARIANTS_QUERY = 'project_variants'
+PROJECT_METABOLITES_QUERY = 'project_metabolites'
+VARIANT_CHEMICAL_GENE_BRIDGES_QUERY = 'variant_chemical_gene_bridges'
+PROJECT_VARIANT_ASSOCIATIONS_QUERY = 'project_variant_associations'
+PROJECT_METABOLITE_ASSOCIATIONS_QUERY = 'project_metabolite_associations'
+VARIANTS_FOR_ANNOTATION_QUERY = 'variants_for_annotation'
+MARK_VARIANTS_ANNOTATED_QUERY = 'mark_variants_annotated'
+BACKFILL_ANNOTATION_STATE_QUERY = 'backfill_annotation_state'
+PROJECT_ASSOCIATION_COUNTS_QUERY = 'project_association_counts'
+DELETE_NAMESPACE_EDGES_QUERY = 'delete_namespace_edges'
+DELETE_PROJECT_EDGES_QUERY = 'delete_project_edges'
+KILL_TAGGED_QUERIES_QUERY = 'kill_tagged_queries'
+# anything run through custom_read_query or custom_write_query
+CUSTOM_QUERY = 'custom'
+
+
+@dataclass(frozen=True)
+class RagsGraphQuery:
+    """
+    A graph query with fixed text, values are always passed as parameters so Neo4j can reuse the query plan.
+
+    A keyset paged query (the annotation query) orders its results by page_keys and starts each page after
+    the last row of the one before ($last_<page key>), first_page_key sorts before any real value.
+    """
+    name: str
+    template: str
+    page_keys: tuple = ()
+    first_page_key: tuple = ()
+
+    def get_text(self, predicate: str = DEFAULT_ASSOCIATION_PREDICATE):
+        return self.template.replace(PREDICATE_PLACEHOLDER, predicate)
+
+
+RAGS_GRAPH_QUERIES = {graph_query.name: graph_query for graph_query in [
+    RagsGraphQuery(PROJECT_VARIANTS_QUERY,
+                   f'MATCH (s:`{SEQUENCE_VARIANT}`)<-[r:`{{predicate}}` {{project_id: $project_id}}]-(b) '
+                   f'RETURN DISTINCT s.id, r.input_id, r.namespace, b.id, r.p_value ORDER BY r.p_value SKIP $skip LIMIT $limit'),
+    RagsGraphQuery(PROJECT_METABOLITES_QUERY,
+                   f'MATCH (c:`{CHEMICAL_SUBSTANCE}`)<-[r:`{{predicate}}` {{project_id: $project_id}}]-(b) '
+                   f'RETURN DISTINCT c.id, r.input_id, r.namespace, b.id, r.p_value ORDER BY r.p_value SKIP $skip LIMIT $limit'),
+    # genes that link variants and chemicals, for the (variant, chemical) pairs in $pairs
+    RagsGraphQuery(VARIANT_CHEMICAL_GENE_BRIDGES_QUERY,
+                   f'UNWIND $pairs as pair '
+                   f'MATCH (s:`{SEQUENCE_VARIANT}` {{id: pair[0]}})-[r4]-(g:gene)-[r3]-(c:`{CHEMICAL_SUBSTANCE}` {{id: pair[1]}}) '
+                   f'RETURN s.id as variant_id, c.id as chemical_id, type(r3) as chemical_gene_relationship, '
+                   f'g.id as gene_id, type(r4) as gene_variant_relationship'),
+    # every association for a project in p value order (missing p values last), streamed for exports,
+    # there's no index to page on p values with so they're sorted once and read in a single transaction
+    RagsGraphQuery(PROJECT_VARIANT_ASSOCIATIONS_QUERY,
+                   f'MATCH (s:`{SEQUENCE_VARIANT}`)<-[r:`{{predicate}}` {{project_id: $project_id}}]-(b) '
+                   f'RETURN s.id as variant_id, r.input_id as original_id, r.namespace as study, b.id as associated_with, '
+                   f'r.p_value as p_value, id(r) as edge_id ORDER BY p_value, edge_id'),
+    RagsGraphQuery(PROJECT_METABOLITE_ASSOCIATIONS_QUERY,
+                   f'MATCH (c:`{CHEMICAL_SUBSTANCE}`)<-[r:`{{predicate}}` {{project_id: $project_id}}]-(b) '
+                   f'RETURN c.id as metabolite_id, r.input_id as original_id, r.namespace as study, b.id as associated_with, '
+                   f'r.p_value as p_value, id(r) as edge_id ORDER BY p_value, edge_id'),
+    # variants that haven't been annotated, in id order a page at a time so annotation can work through them in chunks
+    # only RAGs association targets are ever marked false, so the variants waiting for annotation stay a small set
+    RagsGraphQuery(VARIANTS_FOR_ANNOTATION_QUERY,
+                   f'MATCH (v:`{SEQUENCE_VARIANT}`) WHERE v.{RAGS_ANNOTATED_PROPERTY} = false AND v.id > $last_id '
+                   f'AND (v)<-[:`{PREDICATE_PLACEHOLDER}`]-() '
+                   f'RETURN v.id as id, v.name as name, v.equivalent_identifiers as equivalent_identifiers '
+                   f'ORDER BY id LIMIT $page_size',
+                   page_keys=('id',),
+                   first_page_key=('',)),
+    RagsGraphQuery(MARK_VARIANTS_ANNOTATED_QUERY,
+                   f'UNWIND $variant_ids as variant_id MATCH (v:`{SEQUENCE_VARIANT}` {{id: variant_id}}) '
+                   f'SET v.{RAGS_ANNOTATED_PROPERTY} = true'),
+    # variants written before annotation state was tracked, the ones with nearby genes were already annotated,
+    # checks a batch of RAGs association targets in id order and only writes the ones without an annotation state,
+    # variants from the base graph are left alone
+    RagsGraphQuery(BACKFILL_ANNOTATION_STATE_QUERY,
+                   f'MATCH (v:`{SEQUENCE_VARIANT}`) WHERE v.id > $last_id AND (v)<-[:`{PREDICATE_PLACEHOLDER}`]-() '
+                   f'WITH v ORDER BY v.id LIMIT $batch_size '
+                   f'WITH v, v.{RAGS_ANNOTATED_PROPERTY} IS NULL as unmarked '
+                   f'FOREACH (unmarked_variant IN CASE WHEN unmarked THEN [v] ELSE [] END | '
+                   f'SET unmarked_variant.{RAGS_ANNOTATED_PROPERTY} = '
+                   f'size((unmarked_variant)-[:`{NEARBY_VARIANT_PREDICATE}`]-()) > 0) '
+                   f'RETURN count(v) as checked_count, sum(CASE WHEN unmarked THEN 1 ELSE 0 END) as updated_count, '
+                   f'max(v.id) as last_id'),
+    # association counts for every study in a project, starting from each study's trait node
+    RagsGraphQuery(PROJECT_ASSOCIATION_COUNTS_QUERY,
+                   f'UNWIND $study_traits as study_trait '
+                   f'MATCH (:`{ROOT_ENTITY}` {{id: study_trait.trait_id}})-[r {{project_id: $project_id, namespace: study_trait.namespace}}]->(s) '
+                   f'RETURN r.namespace as namespace, type(r) as predicate, count(DISTINCT s) as association_count'),
+    RagsGraphQuery(DELETE_NAMESPACE_EDGES_QUERY,
+                   f'MATCH (:`{ROOT_ENTITY}` {{id: $trait_id}})-[r {{project_id: $project_id, namespace: $namespace}}]->() '
+                   f'WITH r LIMIT $batch_size DELETE r RETURN count(r) as deleted_count'),
+    # only association edges, matching every relationship in the graph on an unindexed property would scan them all
+    RagsGraphQuery(DELETE_PROJECT_EDGES_QUERY,
+                   'MATCH ()-[r:`{predicate}` {project_id: $project_id}]->() '
+                   'WITH r LIMIT $batch_size DELETE r RETURN count(r) as deleted_count'),
+    RagsGraphQuery(KILL_TAGGED_QUERIES_QUERY,
+                   f'CALL dbms.listQueries() YIELD queryId, metaData '
+                   f'WITH queryId, metaData WHERE metaData.{QUERY_TAG_METADATA_KEY} = $query_tag '
+                   f'CALL dbms.killQuery(queryId) YIELD message '
+                   f'RETURN count(*) as killed_count')
+]}
+
+
+def get_graph_query(query_name: str):
+    if query_name not in RAGS_GRAPH_QUERIES:
+        raise ValueError(f'Graph query not supported: {query_name}')
+    return RAGS_GRAPH_QUERIES[query_name]
+
+
+def get_graph_query_text(query_name: str, predicate: str = DEFAULT_ASSOCIATION_PREDICATE):
+    return get_graph_query(query_name).get_text(predicate)
@@ -0,0 +1,120 @@
+from rags_src.rags_core import ROOT_ENTITY, SEQUENCE_VARIANT, RAGS_ANNOTATED_PROPERTY
+
+from dataclasses import dataclass
+
+# index states
+INDEX_ONLINE = 'ONLINE'
+INDEX_POPULATING = 'POPULATING'
+INDEX_FAILED = 'FAILED'
+INDEX_MISSING = 'MISSING'
+INDEX_UNSUPPORTED = 'UNSUPPORTED'
+# a plain index where a uniqueness constraint is required, lookups are indexed but duplicates aren't prevented
+INDEX_NOT_UNIQUE = 'NOT_UNIQUE'
+
+# relationship property indexes were added in Neo4j 4.3
+RELATIONSHIP_INDEX_MIN_VERSION = (4, 3)
+# and IF NOT EXISTS in 4.1
+IF_NOT_EXISTS_MIN_VERSION = (4, 1)
+
+
+@dataclass(frozen=True)
+class RagsGraphIndex:
+    """
+    A single property index, or with unique a uniqueness constraint (which comes with its own index).
+    """
+    label: str
+    property: str
+    relationship: bool = False
+    unique: bool = False
+
+    @property
+    def name(self):
+        label = ''.join([character if character.isalnum() else '_' for character in self.label])
+        return f'rags_{label}_{self.property}'
+
+    def get_create_query(self, neo4j_version: tuple):
+        if_not_exists = ' IF NOT EXISTS' if neo4j_version >= IF_NOT_EXISTS_MIN_VERSION else ''
+        if self.unique:
+            if neo4j_version >= (4, 0):
+                return f'CREATE CONSTRAINT {self.name}{if_not_exists} ON (n:`{self.label}`) ASSERT n.{self.property} IS UNIQUE'
+            return f'CREATE CONSTRAINT ON (n:`{self.label}`) ASSERT n.{self.property} IS UNIQUE'
+        if self.relationship:
+            return f'CREATE INDEX {self.name}{if_not_exists} FOR ()-[r:`{self.label}`]-() ON (r.{self.property})'
+        if neo4j_version >= (4, 0):
+            return f'CREATE INDEX {self.name}{if_not_exists} FOR (n:`{self.label}`) ON (n.{self.property})'
+        return f'CREATE INDEX ON :`{self.label}`({self.property})'
+
+    def is_supported(self, neo4j_version: tuple):
+        return not self.relationship or neo4j_version >= RELATIONSHIP_INDEX_MIN_VERSION
+
+
+# every node MERGE and edge MATCH in the graph writer looks nodes up by id, annotation finds its variants by annotation state,
+# node ids are also constrained to be unique so concurrent MERGEs can't create the same node twice
+REQUIRED_NODE_INDEXES = [
+    RagsGraphIndex(ROOT_ENTITY, 'id', unique=True),
+    RagsGraphIndex(SEQUENCE_VARIANT, 'id'),
+    RagsGraphIndex(SEQUENCE_VARIANT, RAGS_ANNOTATED_PROPERTY)
+]
+
+# project queries and project deletes filter association edges on these
+REQUIRED_RELATIONSHIP_PROPERTIES = ['project_id', 'namespace']
+
+
+def get_required_indexes(relationship_types: list = ()):
+    required_indexes = list(REQUIRED_NODE_INDEXES)
+    for relationship_type in relationship_types:
+        for relationship_property in REQUIRED_RELATIONSHIP_PROPERTIES:
+            required_indexes.append(RagsGraphIndex(relationship_type, relationship_property, relationship=True))
+    return required_indexes
+
+
+def parse_neo4j_version(version: str):
+    version_numbers = []
+    for part in version.split('.')[:2]:
+        digits = ''.join([character for character in part if character.isdigit()])
+        version_numbers.append(int(digits) if digits else 0)
+    return tuple(version_numbers)
+
+
+def parse_index_records(index_records: list):
+    """
+    Read the results of db.indexes(), the columns differ between Neo4j versions.
+    Indexes that back a uniqueness constraint are in there too.
+    :return: a dictionary of (label or relationship type, property, is relationship) -> (index state, is unique)
+    """
+    index_states = {}
+    for index_record in index_records:
+        labels = index_record.get('labelsOrTypes') or index_record.get('tokenNames') or index_record.get('label')
+        properties = index_record.get('properties')
+        if not labels or not properties:
+            continue
+        if isinstance(labels, str):
+            labels = [labels]
+        # single property indexes only
+        if len(labels) != 1 or len(properties) != 1:
+            continue
+        relationship = index_record.get('entityType') == 'RELATIONSHIP'
+        # 3.5 has type node_unique_property, 4.x has a uniqueness column
+        unique = 'unique' in str(index_record.get('type', '')).lower() or index_record.get('uniqueness') == 'UNIQUE'
+        index_states[(labels[0], properties[0], relationship)] = (index_record.get('state', INDEX_ONLINE).upper(), unique)
+    return index_states
+
+
+def get_index_states(required_indexes: list, existing_index_states: dict, neo4j_version: tuple):
+    """
+    :return: a list of (RagsGraphIndex, state) for the required indexes
+    """
+    index_states = []
+    for index in required_indexes:
+        if not index.is_supported(neo4j_version):
+            index_states.append((index, INDEX_UNSUPPORTED))
+            continue
+        existing_index_state = existing_index_states.get((index.label, index.property, index.relationship))
+        if existing_index_state is None:
+            index_states.append((index, INDEX_MISSING))
+            continue
+        state, unique = existing_index_state
+        if index.unique and not unique and state == INDEX_ONLINE:
+            state = INDEX_NOT_UNIQUE
+        index_states.append((index, state))
+    return index_states
@@ -1,21 +1,42 @@
-from rags_src.rags_core import ROOT_ENTITY, RAGsEdge, RAGsNode
+from rags_src.rags_core import ROOT_ENTITY, SEQUENCE_VARIANT, RAGS_ANNOTATED_PROPERTY, RAGsEdge, RAGsNode
 from rags_src.util import LoggingUtil, Text
 from rags_src.rags_graph_db import RagsGraphDB
+from rags_src.rags_edge_dedup import create_edge_dedup, get_key_fingerprint, EXACT_EDGE_DEDUP
+from rags_src.rags_node_registry import RagsNodeRegistry
+
+from neo4j.exceptions import TransientError
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from hashlib import blake2b
+import json
 import logging
 import os
+import queue
+import random
+import threading
+import time
+import zlib
 
 logger = LoggingUtil.init_logging("rags.rags_graph_writer", logging.INFO,
                                   format='medium',
                                   logFilePath=f'{os.environ["RAGS_HOME"]}/logs/')
 
+# which end of an edge decides its partition in parallel writes
+SUBJECT_PARTITION_KEY = 'subject'
+OBJECT_PARTITION_KEY = 'object'
+
+# the batch key for node batches combined from several label set queues
+MIXED_NODE_TYPES = None
+
 
 class BufferedWriter(object):
     """Buffered writer accepts individual nodes and edges to write to neo4j.
     It doesn't write the node/edge if it has already been written in its lifetime (it maintains a record)
-    It then accumulates nodes/edges by label/type until a buffersize has been reached, at which point it does
-    an intelligent update/write to the batch of nodes and edges.
+    It then accumulates nodes/edges by label/type until that queue's batch size has been reached, at which point it does
+    an intelligent update/write to that batch of nodes or edges. Batch sizes adapt per queue to the payload size
+    and the measured transaction time (see AdaptiveBatchSize).
 
     The correct way to use this is
     with BufferedWriter(rosetta) as writer:
@@ -23,16 +44,86 @@ class BufferedWriter(object):
         ...
 
     Doing this as a context manager will make sure that the different queues all get flushed out.
+
+    Written edges are remembered by a 64 bit fingerprint of their identity key, not the edge itself,
+    so edge payloads are freed once their batch is flushed. For huge builds edge_dedup=BLOOM_EDGE_DEDUP
+    bounds that memory too, at the cost of a small chance (false_positive_rate) of skipping a new edge.
+
+    With background_writers > 0 full batches are committed by writer threads so the caller can keep going.
+    At most max_pending_batches wait to be written before write_node/write_edge block. Edge batches wait for
+    any node batches in flight, and flush() waits for everything to be written. An error in a writer thread
+    is raised on the caller's thread by every later write or flush until close(), batches still waiting when it
+    happened aren't written.
+
+    With write_partitions > 1 every batch is split across that many sessions that write in parallel.
+    Nodes are partitioned by id so no two sessions MERGE the same node, edges by subject or object id
+    (edge_partition_key). Transient errors like deadlocks are retried with backoff, and transaction counts
+    and wall time per partition are kept in partition_stats (see log_partition_stats) for tuning.
+    Creating a relationship locks both of its nodes, so edges that share a node wait on each other whatever
+    the partitioning. The associations of a study all share its trait node and are written one partition
+    at a time in practice, partitions speed up node writes and edges without a shared node.
+
+    With edge_sync project edges are upserted on (subject, object, predicate, project_id, namespace) instead of
+    created, and edges whose content hasn't changed (ignoring ctime) are left alone. Wrap a full rewrite of a
+    namespace in start_edge_sync/finish_edge_sync to also delete the edges that weren't written again.
+
+    With a node_registry, nodes already in the graph from earlier builds are skipped without a MERGE.
     """
-    def __init__(self, graph_db: RagsGraphDB):
+    def __init__(self,
+                 graph_db: RagsGraphDB,
+                 edge_dedup: str = EXACT_EDGE_DEDUP,
+                 expected_edges: int = None,
+                 false_positive_rate: float = 0.0001,
+                 background_writers: int = 0,
+                 max_pending_batches: int = 4,
+                 write_partitions: int = 1,
+                 edge_partition_key: str = SUBJECT_PARTITION_KEY,
+                 max_write_attempts: int = 5,
+                 edge_sync: bool = False,
+                 node_registry: RagsNodeRegistry = None):
         self.written_nodes = set()
-        self.written_edges = defaultdict(lambda: defaultdict(set))
+        self.written_edges = create_edge_dedup(edge_dedup, expected_edges, false_positive_rate)
         self.node_queues = defaultdict(list)
         self.edge_queues = defaultdict(list)
+        # the starting batch sizes, each queue adapts its own batch size from there
         self.node_buffer_size = 10000
         self.edge_buffer_size = 10000
+        self.node_batch_sizes = defaultdict(lambda: AdaptiveBatchSize(self.node_buffer_size))
+        self.edge_batch_sizes = defaultdict(lambda: AdaptiveBatchSize(self.edge_buffer_size))
+        self.transaction_count = 0
         self.graph_db = graph_db
 
+        # background writer mode - full batches are handed to writer threads through a bounded queue,
+        # producers block when max_pending_batches are waiting (backpressure when neo4j falls behind)
+        self.background_writers = background_writers
+        self.pending_batches = queue.Queue(maxsize=max_pending_batches) if background_writers else None
+        self.writer_threads = set()
+        self.writer_lock = threading.Lock()
+        self.node_batches_in_flight = 0
+        self.node_batches_done = threading.Condition(self.writer_lock)
+        self.background_error = None
+        self.stop_writers = threading.Event()
+        self.writer_idle_timeout = 5
+        self.writer_poll_seconds = 0.5
+
+        # parallel partitioned writes
+        if edge_partition_key not in (SUBJECT_PARTITION_KEY, OBJECT_PARTITION_KEY):
+            raise ValueError(f'Edge partition key not supported: {edge_partition_key}')
+        self.write_partitions = write_partitions
+        self.edge_partition_key = edge_partition_key
+        self.partition_executor = None
+        self.partition_stats = defaultdict(PartitionStats)
+        self.max_write_attempts = max_write_attempts
+        self.retry_delay = 0.5
+
+        # edge sync mode - (predicate, project_id, namespace) -> fingerprints of the edges written in a full rewrite
+        self.edge_sync = edge_sync
+        self.edge_sync_scopes = {}
+        self.stale_edge_batch_size = 10000
+
+        # optional persistent record of the nodes already in the graph, from earlier builds
+        self.node_registry = node_registry
+
     def __enter__(self):
         return self
 
@@ -41,80 +132,470 @@ class BufferedWriter(object):
             return
 
         self.written_nodes.add(node.id)
+        if self.node_registry and node.id in self.node_registry:
+            return
         node_queue = self.node_queues[node.all_types]
         node_queue.append(node)
-        if len(node_queue) == self.node_buffer_size:
-            self.flush()
+        if len(node_queue) >= self.node_batch_sizes[node.all_types].size:
+            self.flush_node_queue(node.all_types)
 
     def write_edge(self, edge: RAGsEdge):
-        if edge in self.written_edges[edge.subject_id][edge.object_id]:
-            return
-        else:
-            self.written_edges[edge.subject_id][edge.object_id].add(edge)
+        """
+        :return: False if the edge was left out as a duplicate of one already written
+        """
+        if self.edge_sync_scopes:
+            sync_scope = self.edge_sync_scopes.get((edge.predicate, edge.project_id, edge.namespace))
+            if sync_scope is not None:
+                sync_scope.add(get_key_fingerprint(edge.subject_id, edge.object_id))
+
+        if not self.written_edges.add(edge):
+            return False
 
         #predicate = Text.snakify(edge.predicate)
         edge_queue = self.edge_queues[edge.predicate]
         edge_queue.append(edge)
-        if len(edge_queue) >= self.edge_buffer_size:
-            self.flush()
+        if len(edge_queue) >= self.edge_batch_sizes[edge.predicate].size:
+            self.flush_edge_queue(edge.predicate)
+        return True
+
+    def flush_node_queue(self, node_type_set: frozenset):
+        batch_of_nodes = self.node_queues.pop(node_type_set, None)
+        if batch_of_nodes:
+            self.write_batch(write_batch_of_nodes,
+                             batch_of_nodes,
+                             node_type_set,
+                             self.node_batch_sizes[node_type_set],
+                             estimate_node_bytes)
+
+    def flush_edge_queue(self, predicate: str):
+        # edges are matched to existing nodes, so any nodes still waiting in a queue go first
+        self.flush_node_queues()
+        self.wait_for_node_batches()
+        batch_of_edges = self.edge_queues.pop(predicate, None)
+        if batch_of_edges:
+            self.write_batch(sync_batch_of_edges if self.edge_sync else write_batch_of_edges,
+                             batch_of_edges,
+                             predicate,
+                             self.edge_batch_sizes[predicate],
+                             estimate_edge_bytes)
+
+    def flush_node_queues(self):
+        if len(self.node_queues) == 1:
+            self.flush_node_queue(next(iter(self.node_queues)))
+            return
+
+        # combine what's left in the queues so a handful of nodes per label set doesn't cost a transaction each
+        batch_of_nodes = []
+        for node_type_set in list(self.node_queues.keys()):
+            batch_of_nodes.extend(self.node_queues.pop(node_type_set))
+        batch_size = self.node_batch_sizes[MIXED_NODE_TYPES]
+        max_batch_size = batch_size.size
+        for i in range(0, len(batch_of_nodes), max_batch_size):
+            self.write_batch(write_batch_of_nodes,
+                             batch_of_nodes[i: i + max_batch_size],
+                             MIXED_NODE_TYPES,
+                             batch_size,
+                             estimate_node_bytes)
 
     def flush(self):
+        """
+        Write everything that is queued. In background mode this also waits for the writer threads to finish,
+        so it can be used at phase boundaries, and raises any error that happened in the background.
+        """
+        self.flush_node_queues()
+        for predicate in list(self.edge_queues.keys()):
+            self.flush_edge_queue(predicate)
+        if self.pending_batches:
+            self.pending_batches.join()
+            self.raise_background_error()
+
+    def write_batch(self, write_function, batch: list, batch_key, batch_size, estimate_item_bytes):
+        if not self.pending_batches:
+            self.run_batch(write_function, batch, batch_key, batch_size, estimate_item_bytes)
+            return
+
+        self.raise_background_error()
+        if write_function is write_batch_of_nodes:
+            with self.writer_lock:
+                self.node_batches_in_flight += 1
+        # blocks when too many batches are waiting
+        self.pending_batches.put((write_function, batch, batch_key, batch_size, estimate_item_bytes))
+        self.start_writer_threads()
+
+    def run_batch(self, write_function, batch: list, batch_key, batch_size, estimate_item_bytes):
+        start_time = time.time()
+        if self.write_partitions > 1:
+            self.run_partitioned_batch(write_function, batch, batch_key)
+        else:
+            self.run_transaction(write_function, batch, batch_key, 0)
+        if self.node_registry and write_function is write_batch_of_nodes:
+            self.node_registry.add([node.id for node in batch], written=True)
+        batch_size.record(len(batch), estimate_batch_bytes(batch, estimate_item_bytes), time.time() - start_time)
+
+    def run_partitioned_batch(self, write_function, batch: list, batch_key):
+        partitioned_batches = defaultdict(list)
+        for item in batch:
+            partitioned_batches[self.get_partition(item)].append(item)
+
+        with self.writer_lock:
+            if not self.partition_executor:
+                self.partition_executor = ThreadPoolExecutor(max_workers=self.write_partitions)
+        futures = [self.partition_executor.submit(self.run_transaction, write_function, partition_batch, batch_key, partition)
+                   for partition, partition_batch in partitioned_batches.items()]
+        # let every partition finish before raising the first error
+        wait(futures)
+        for future in futures:
+            future.result()
+
+    def get_partition(self, item):
+        if isinstance(item, RAGsNode):
+            partition_id = item.id
+        elif self.edge_partition_key == OBJECT_PARTITION_KEY:
+            partition_id = item.object_id
+        else:
+            partition_id = item.subject_id
+        return zlib.crc32(partition_id.encode('utf-8')) % self.write_partitions
+
+    def run_transaction(self, write_function, batch: list, batch_key, partition: int):
+        start_time = time.time()
+        attempt = 1
+        while True:
+            try:
+                with self.graph_db.get_session() as session:
+                    session.write_transaction(write_function, batch, batch_key)
+                break
+            except TransientError as e:
+                # deadlocks and other transient errors that outlasted the driver's own retries
+                if attempt >= self.max_write_attempts:
+                    raise
+                delay = self.retry_delay * (2 ** (attempt - 1)) * (0.5 + random.random())
+                logger.warning(f'Transient error writing a batch of {len(batch)} ({batch_key}) in partition {partition}, '
+                               f'retrying in {delay:.2f}s (attempt {attempt} of {self.max_write_attempts}): {e}')
+                with self.writer_lock:
+                    self.partition_stats[partition].retries += 1
+                time.sleep(delay)
+                attempt += 1
+        with self.writer_lock:
+            self.transaction_count += 1
+            self.partition_stats[partition].record(len(batch), time.time() - start_time)
+
+    def start_edge_sync(self, predicate: str, project_id: int, namespace: str):
+        """
+        Start a full rewrite of the edges in a namespace, the edges written until finish_edge_sync are the current ones.
+        """
+        self.edge_sync_scopes[(predicate, project_id, namespace)] = set()
+
+    def finish_edge_sync(self, predicate: str, project_id: int, namespace: str):
+        """
+        Write everything that is queued and delete the edges in the namespace that weren't written since start_edge_sync.
+        Duplicates of a current edge (from before edges were synced) are deleted too, only one edge is kept for each.
+        :return: the number of stale edges deleted
+        """
+        current_edges = self.edge_sync_scopes.pop((predicate, project_id, namespace))
+        self.flush()
         with self.graph_db.get_session() as session:
-            for node_type_set in self.node_queues:
-                session.write_transaction(write_batch_of_nodes,
-                                          self.node_queues[node_type_set],
-                                          node_type_set)
-                self.node_queues[node_type_set] = []
-
-            for predicate in self.edge_queues:
-                session.write_transaction(write_batch_of_edges,
-                                          self.edge_queues[predicate],
-                                          predicate)
-                self.edge_queues[predicate] = []
+            stale_edge_ids = session.read_transaction(read_stale_edges, predicate, project_id, namespace, current_edges)
+        for i in range(0, len(stale_edge_ids), self.stale_edge_batch_size):
+            with self.graph_db.get_session() as session:
+                session.write_transaction(delete_edges_by_id, stale_edge_ids[i: i + self.stale_edge_batch_size])
+        if stale_edge_ids:
+            logger.info(f'Deleted {len(stale_edge_ids)} stale {predicate} edges from {namespace} (project {project_id}).')
+        return len(stale_edge_ids)
+
+    def log_partition_stats(self):
+        with self.writer_lock:
+            partition_stats = sorted(self.partition_stats.items())
+        for partition, stats in partition_stats:
+            logger.info(f'Graph writer partition {partition}: {stats.transactions} transactions, {stats.items} items, '
+                        f'{stats.seconds:.1f}s, {stats.retries} retries.')
+
+    def start_writer_threads(self):
+        with self.writer_lock:
+            while len(self.writer_threads) < self.background_writers:
+                writer_thread = threading.Thread(target=self.run_writer_thread, daemon=True)
+                self.writer_threads.add(writer_thread)
+                writer_thread.start()
+
+    def run_writer_thread(self):
+        idle_since = time.time()
+        while not self.stop_writers.is_set():
+            try:
+                pending_batch = self.pending_batches.get(timeout=self.writer_poll_seconds)
+            except queue.Empty:
+                # stop when idle, threads are started again when there is more work
+                if time.time() - idle_since >= self.writer_idle_timeout:
+                    with self.writer_lock:
+                        if self.pending_batches.empty():
+                            self.writer_threads.discard(threading.current_thread())
+                            return
+                continue
+
+            write_function = pending_batch[0]
+            try:
+                # after an error the remaining batches are dropped, the error fails every later write and flush
+                if not self.background_error:
+                    self.run_batch(*pending_batch)
+            except BaseException as e:
+                logger.error(f'Background graph write failed: {e}')
+                with self.writer_lock:
+                    if not self.background_error:
+                        self.background_error = e
+            finally:
+                self.finish_pending_batch(write_function)
+            idle_since = time.time()
+        with self.writer_lock:
+            self.writer_threads.discard(threading.current_thread())
+
+    def finish_pending_batch(self, write_function):
+        if write_function is write_batch_of_nodes:
+            with self.writer_lock:
+                self.node_batches_in_flight -= 1
+                self.node_batches_done.notify_all()
+        self.pending_batches.task_done()
+
+    def wait_for_node_batches(self):
+        if not self.pending_batches:
+            return
+        with self.writer_lock:
+            while self.node_batches_in_flight:
+                self.node_batches_done.wait()
+        self.raise_background_error()
+
+    def raise_background_error(self):
+        # the error stays until close(), the batches dropped after it leave the graph incomplete
+        if self.background_error:
+            raise self.background_error
+
+    def close(self):
+        """
+        Stop any background writer threads and clear a background error. Queued batches are not written, call flush first.
+        """
+        if self.partition_executor:
+            self.partition_executor.shutdown()
+            self.partition_executor = None
+        if not self.pending_batches:
+            return
+        self.stop_writers.set()
+        with self.writer_lock:
+            writer_threads = list(self.writer_threads)
+        for writer_thread in writer_threads:
+            writer_thread.join()
+        # drop the batches that were never written, so a later flush doesn't wait for them
+        while True:
+            try:
+                pending_batch = self.pending_batches.get_nowait()
+            except queue.Empty:
+                break
+            self.finish_pending_batch(pending_batch[0])
+        self.stop_writers.clear()
+        self.background_error = None
 
     def __exit__(self, *args):
-        self.flush()
+        try:
+            self.flush()
+        finally:
+            self.close()
+
+
+@dataclass
+class PartitionStats:
+    transactions: int = 0
+    items: int = 0
+    seconds: float = 0.0
+    retries: int = 0
+
+    def record(self, item_count: int, seconds: float):
+        self.transactions += 1
+        self.items += item_count
+        self.seconds += seconds
+
+
+class AdaptiveBatchSize(object):
+    """
+    Adapts a queue's batch size to its payload size and measured transaction latency.
+
+    After every transaction the size moves toward the number of items that would take target_seconds
+    to write and that would fit in max_payload_bytes, whichever is smaller.
+    """
+    def __init__(self,
+                 initial_size: int = 10000,
+                 min_size: int = 1000,
+                 max_size: int = 50000,
+                 target_seconds: float = 2.0,
+                 max_payload_bytes: int = 16 * 1024 * 1024):
+        self.size = initial_size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_seconds = target_seconds
+        self.max_payload_bytes = max_payload_bytes
+
+    def record(self, batch_size: int, payload_bytes: int, seconds: float):
+        if not batch_size:
+            return
+        target_size = self.max_size
+        if seconds > 0:
+            target_size = min(target_size, batch_size * self.target_seconds / seconds)
+        if payload_bytes > 0:
+            target_size = min(target_size, self.max_payload_bytes * batch_size / payload_bytes)
+        # move half way to the target so one slow transaction doesn't swing the size too far
+        new_size = (self.size + target_size) / 2
+        self.size = int(max(self.min_size, min(self.max_size, new_size)))
+
+
+def estimate_node_bytes(node: RAGsNode):
+    return len(node.id) + len(node.name or '') + sum(len(synonym) for synonym in node.synonyms) + len(str(node.properties))
+
+
+def estimate_edge_bytes(edge: RAGsEdge):
+    return len(edge.subject_id) + len(edge.object_id) + len(edge.original_object_id or '') + len(str(edge.properties))
+
+
+def estimate_batch_bytes(batch: list, estimate_item_bytes, sample_size: int = 50):
+    # estimate from an evenly spaced sample, the items in a queue tend to look alike
+    step = max(1, len(batch) // sample_size)
+    sample = batch[::step]
+    return int(sum(estimate_item_bytes(item) for item in sample) * len(batch) / len(sample))
 
 
 def write_batch_of_edges(tx, batch_of_edges: list, predicate):
+    for edge_constants, edges in group_edges_by_constants(batch_of_edges).items():
+        create_edges(tx, edges, predicate, edge_constants)
+
+
+def sync_batch_of_edges(tx, batch_of_edges: list, predicate):
+    for edge_constants, edges in group_edges_by_constants(batch_of_edges).items():
+        (project_id, project_name, namespace, provided_by, relation) = edge_constants
+        if project_id and namespace:
+            merge_edges(tx, edges, predicate, edge_constants)
+        else:
+            # edges that don't belong to a project namespace have nothing to sync against
+            create_edges(tx, edges, predicate, edge_constants)
+
+
+def group_edges_by_constants(batch_of_edges: list):
+    # values shared by a group of edges (the same for a whole build in practice) are sent once per statement,
+    # only the values that vary go in the rows
+    edge_groups = defaultdict(list)
+    for edge in batch_of_edges:
+        edge_groups[(edge.project_id, edge.project_name, edge.namespace, edge.provided_by, edge.relation)].append(edge)
+    return edge_groups
+
+
+def get_edge_constant_parameters(edge_constants: tuple):
+    (project_id, project_name, namespace, provided_by, relation) = edge_constants
+    return {'project_id': project_id if project_id else None,
+            'project_name': project_name if project_name else None,
+            'namespace': namespace if namespace else None,
+            'edge_source': [provided_by],
+            'source_database': [provided_by.split('.')[0]] if '.' in provided_by else None,
+            'relation': relation}
+
+
+def get_association_target_update(edge_constants: tuple):
+    # variants that become the target of a project association wait for annotation, unless they have a state already,
+    # this also covers variants that were in the graph before (from the base graph or skipped by the node registry)
+    (project_id, project_name, namespace, provided_by, relation) = edge_constants
+    if not project_id:
+        return ''
+    return f"""FOREACH (variant IN CASE WHEN b:`{SEQUENCE_VARIANT}` THEN [b] ELSE [] END |
+                SET variant.{RAGS_ANNOTATED_PROPERTY} = coalesce(variant.{RAGS_ANNOTATED_PROPERTY}, false))"""
+
+
+def create_edges(tx, edges: list, predicate: str, edge_constants: tuple):
 
     cypher = f"""UNWIND $edge_batch as edge
             MATCH (a:`{ROOT_ENTITY}` {{id: edge.subject_id}}),(b:`{ROOT_ENTITY}` {{id: edge.object_id}})
-            CREATE (a)-[r:`{predicate}` {{project_id: edge.project_id, namespace: edge.namespace, input_id: edge.input_id}}]->(b)
-            SET r.project_name = edge.project_name
-            SET r.edge_source=edge.edge_source
-            SET r.source_database=edge.source_database
-            SET r.relation=edge.relation
+            {get_association_target_update(edge_constants)}
+            CREATE (a)-[r:`{predicate}` {{project_id: $project_id, namespace: $namespace, input_id: edge.input_id}}]->(b)
+            SET r.project_name = $project_name
+            SET r.edge_source = $edge_source
+            SET r.source_database = $source_database
+            SET r.relation = $relation
             SET r += edge.properties"""
 
     edges_as_dicts = [{'subject_id': edge.subject_id,
                        'object_id': edge.object_id,
                        'input_id': edge.original_object_id,
-                       'relation': edge.relation,
-                       'edge_source': [edge.provided_by],
-                       'source_database': [edge.provided_by.split('.')[0]] if '.' in edge.provided_by else None,
-                       'namespace': edge.namespace if edge.namespace else None,
-                       'project_id': edge.project_id if edge.project_id else None,
-                       'project_name': edge.project_name if edge.project_name else None,
-                       'properties': edge.properties} for edge in batch_of_edges]
-
-    tx.run(cypher, {'edge_batch': edges_as_dicts})
-
-
-def write_batch_of_nodes(tx, batch_of_nodes, node_type_set):
-
-    cypher = f"""UNWIND $batch AS node
-                MERGE (a:`{ROOT_ENTITY}` {{id: node.id}}) """
-    for node_type in node_type_set:
-        cypher += f"ON CREATE SET a:`{node_type}` "
-    cypher += "ON CREATE SET a += node.properties"
-
-    node_dicts = []
-    for n in batch_of_nodes:
-        n.properties['equivalent_identifiers'] = list(n.synonyms)
-        n.properties['category'] = list(node_type_set)
-        n.properties['name'] = n.name
-        export_node = {'id': n.id,  'properties': n.properties}
-        node_dicts.append(export_node)
-
-    tx.run(cypher, {'batch': node_dicts})
+                       'properties': edge.properties} for edge in edges]
+    tx.run(cypher, {'edge_batch': edges_as_dicts, **get_edge_constant_parameters(edge_constants)})
+
+
+def merge_edges(tx, edges: list, predicate: str, edge_constants: tuple):
+
+    # only edges that are new or changed (by sync_hash) are written to
+    cypher = f"""UNWIND $edge_batch as edge
+            MATCH (a:`{ROOT_ENTITY}` {{id: edge.subject_id}}),(b:`{ROOT_ENTITY}` {{id: edge.object_id}})
+            {get_association_target_update(edge_constants)}
+            MERGE (a)-[r:`{predicate}` {{project_id: $project_id, namespace: $namespace}}]->(b)
+            WITH r, edge WHERE r.sync_hash IS NULL OR r.sync_hash <> edge.sync_hash
+            SET r.input_id = edge.input_id
+            SET r.project_name = $project_name
+            SET r.edge_source = $edge_source
+            SET r.source_database = $source_database
+            SET r.relation = $relation
+            SET r += edge.properties
+            SET r.sync_hash = edge.sync_hash"""
+
+    edges_as_dicts = [{'subject_id': edge.subject_id,
+                       'object_id': edge.object_id,
+                       'input_id': edge.original_object_id,
+                       'properties': edge.properties,
+                       'sync_hash': get_edge_sync_hash(edge)} for edge in edges]
+    tx.run(cypher, {'edge_batch': edges_as_dicts, **get_edge_constant_parameters(edge_constants)})
+
+
+def get_edge_sync_hash(edge: RAGsEdge):
+    """
+    A hash of the edge content that is written to the graph, without the creation time which changes every build.
+    """
+    content = [edge.original_object_id, edge.relation, edge.provided_by, edge.project_name,
+               {key: value for key, value in edge.properties.items() if key != 'ctime'}]
+    return blake2b(json.dumps(content, sort_keys=True, default=str).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def read_stale_edges(tx, predicate: str, project_id: int, namespace: str, current_edges: set):
+    """
+    :return: the ids of the edges in the namespace that aren't current (by key fingerprint) or duplicate a current one
+    """
+    cypher = f"""MATCH (a)-[r:`{predicate}` {{project_id: $project_id, namespace: $namespace}}]->(b)
+            RETURN id(r) as edge_id, a.id as subject_id, b.id as object_id"""
+    result = tx.run(cypher, {'project_id': project_id, 'namespace': namespace})
+    # the records are streamed, only the stale ids and the fingerprints already kept are held
+    kept_edges = set()
+    stale_edge_ids = []
+    for record in result:
+        fingerprint = get_key_fingerprint(record['subject_id'], record['object_id'])
+        if fingerprint in current_edges and fingerprint not in kept_edges:
+            kept_edges.add(fingerprint)
+        else:
+            stale_edge_ids.append(record['edge_id'])
+    return stale_edge_ids
+
+
+def delete_edges_by_id(tx, edge_ids: list):
+    cypher = """UNWIND $edge_ids as edge_id
+            MATCH ()-[r]->() WHERE id(r) = edge_id
+            DELETE r"""
+    tx.run(cypher, {'edge_ids': edge_ids})
+
+
+def write_batch_of_nodes(tx, batch_of_nodes: list, node_type_set):
+
+    # a batch can hold nodes with different label sets, they are written with a statement per label set
+    node_groups = defaultdict(list)
+    for node in batch_of_nodes:
+        node_groups[node.all_types].append(node)
+
+    for node_types, nodes in node_groups.items():
+        cypher = f"""UNWIND $batch AS node
+                    MERGE (a:`{ROOT_ENTITY}` {{id: node.id}}) """
+        for node_type in node_types:
+            cypher += f"ON CREATE SET a:`{node_type}` "
+        cypher += "ON CREATE SET a += node.properties, a.equivalent_identifiers = node.equivalent_identifiers, " \
+                  "a.category = $category, a.name = node.name"
+
+        node_dicts = [{'id': node.id,
+                       'name': node.name,
+                       'equivalent_identifiers': list(node.synonyms),
+                       'properties': node.properties} for node in nodes]
+        tx.run(cypher, {'batch': node_dicts, 'category': list(node_types)})
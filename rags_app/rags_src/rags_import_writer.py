@@ -0,0 +1,211 @@
+from rags_src.rags_core import ROOT_ENTITY, RAGsEdge, RAGsNode
+from rags_src.rags_edge_dedup import create_edge_dedup, EXACT_EDGE_DEDUP
+from rags_src.rags_graph_writer import get_edge_sync_hash
+from rags_src.util import LoggingUtil
+
+import csv
+import logging
+import os
+
+logger = LoggingUtil.init_logging("rags.rags_import_writer", logging.INFO,
+                                  format='medium',
+                                  logFilePath=f'{os.environ["RAGS_HOME"]}/logs/')
+
+# must match the --array-delimiter passed to neo4j-admin import (see rags_graph/scripts/import.sh)
+IMPORT_ARRAY_DELIMITER = '|'
+
+
+class ImportFileWriter(object):
+    """
+    A drop in replacement for BufferedWriter that writes neo4j-admin import CSV files instead of writing to the graph.
+
+    For first time builds of very large projects, loading these with neo4j-admin import is much faster than
+    transactional writes. Nodes go to a file per label set and edges to a file per predicate, every file has
+    a neo4j-admin import header. Nodes and edges are deduplicated as they're written.
+
+    with ImportFileWriter(export_directory) as writer:
+        writer.write_node(node)
+        ...
+
+    The files can only be imported into an empty database, see rags_graph/scripts/import.sh.
+    Later builds of the same project append to the files, duplicate nodes are skipped by the import.
+    Nodes written with write_node_update go to updated_nodes_ files that are imported first, so they win over
+    the rows written for the same nodes before.
+    Property columns are taken from the first node or edge written to each file, properties that show up
+    later and aren't in the header are left out (with a warning).
+    """
+    def __init__(self,
+                 export_directory: str,
+                 edge_dedup: str = EXACT_EDGE_DEDUP,
+                 expected_edges: int = None,
+                 false_positive_rate: float = 0.0001):
+        self.export_directory = export_directory
+        os.makedirs(export_directory, exist_ok=True)
+        self.written_nodes = set()
+        self.updated_nodes = set()
+        self.written_edges = create_edge_dedup(edge_dedup, expected_edges, false_positive_rate)
+        # file name -> ImportFile
+        self.import_files = {}
+        self.node_count = 0
+        self.edge_count = 0
+
+    def __enter__(self):
+        return self
+
+    def write_node(self, node: RAGsNode):
+        if not node or node.id in self.written_nodes:
+            return
+        self.written_nodes.add(node.id)
+        self.write_node_row(node, 'nodes')
+
+    def write_node_update(self, node: RAGsNode):
+        """
+        Write a node that replaces whatever was written for it before, eg. to change a property of an exported node.
+        """
+        if not node or node.id in self.updated_nodes:
+            return
+        self.updated_nodes.add(node.id)
+        self.written_nodes.add(node.id)
+        self.write_node_row(node, 'updated_nodes')
+
+    def write_node_row(self, node: RAGsNode, file_prefix: str):
+        labels = sorted(node.all_types | {ROOT_ENTITY})
+        import_file = self.get_import_file(f'{file_prefix}_{get_file_name_part(labels)}.csv',
+                                           ['id:ID', 'name', 'equivalent_identifiers:string[]', 'category:string[]'],
+                                           node.properties,
+                                           ':LABEL')
+        import_file.write_row([node.id,
+                               node.name,
+                               format_array(node.synonyms),
+                               format_array(node.all_types)],
+                              node.properties,
+                              format_array(labels))
+        self.node_count += 1
+
+    def write_edge(self, edge: RAGsEdge):
+        """
+        :return: False if the edge was left out as a duplicate of one already written
+        """
+        if not self.written_edges.add(edge):
+            return False
+
+        import_file = self.get_import_file(f'edges_{get_file_name_part([edge.predicate])}.csv',
+                                           [':START_ID', ':END_ID', 'project_id:long', 'project_name', 'namespace',
+                                            'input_id', 'edge_source:string[]', 'source_database:string[]',
+                                            'relation', 'sync_hash'],
+                                           edge.properties,
+                                           ':TYPE')
+        import_file.write_row([edge.subject_id,
+                               edge.object_id,
+                               edge.project_id,
+                               edge.project_name,
+                               edge.namespace,
+                               edge.original_object_id,
+                               edge.provided_by,
+                               edge.provided_by.split('.')[0] if '.' in edge.provided_by else None,
+                               edge.relation,
+                               # so a later sync of the imported graph can skip unchanged edges
+                               get_edge_sync_hash(edge) if edge.project_id and edge.namespace else None],
+                              edge.properties,
+                              edge.predicate)
+        self.edge_count += 1
+        return True
+
+    def get_import_file(self, file_name: str, columns: list, properties: dict, type_column: str):
+        if file_name not in self.import_files:
+            self.import_files[file_name] = ImportFile(os.path.join(self.export_directory, file_name),
+                                                      columns,
+                                                      properties,
+                                                      type_column)
+        return self.import_files[file_name]
+
+    def flush(self):
+        for import_file in self.import_files.values():
+            import_file.flush()
+
+    def start_edge_sync(self, predicate: str, project_id: int, namespace: str):
+        # an import is always into an empty graph, there is nothing to sync against
+        pass
+
+    def finish_edge_sync(self, predicate: str, project_id: int, namespace: str):
+        self.flush()
+        return 0
+
+    def log_partition_stats(self):
+        logger.info(f'Exported {self.node_count} nodes and {self.edge_count} edges to {self.export_directory}.')
+
+    def close(self):
+        # the files are opened again (and appended to) if anything else is written
+        for import_file in self.import_files.values():
+            import_file.close()
+        self.import_files = {}
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ImportFile(object):
+    """
+    One neo4j-admin import CSV file. Files from an earlier export are appended to, using their existing header.
+    """
+    def __init__(self, file_path: str, columns: list, properties: dict, type_column: str):
+        self.file_path = file_path
+        self.missing_property_names = set()
+        if os.path.exists(file_path) and os.path.getsize(file_path):
+            with open(file_path, newline='') as existing_file:
+                header = next(csv.reader(existing_file))
+            self.property_names = [column.split(':')[0] for column in header[len(columns):-1]]
+            self.file = open(file_path, 'a', newline='')
+            self.csv_writer = csv.writer(self.file)
+        else:
+            self.property_names = sorted(properties.keys())
+            self.file = open(file_path, 'w', newline='')
+            self.csv_writer = csv.writer(self.file)
+            self.csv_writer.writerow(columns +
+                                     [f'{name}{get_column_type(properties[name])}' for name in self.property_names] +
+                                     [type_column])
+
+    def write_row(self, values: list, properties: dict, type_value: str):
+        missing_property_names = properties.keys() - self.property_names - self.missing_property_names
+        if missing_property_names:
+            logger.warning(f'Properties missing from the header of {self.file_path} are left out: {missing_property_names}')
+            self.missing_property_names.update(missing_property_names)
+        self.csv_writer.writerow([format_value(value) for value in values] +
+                                 [format_value(properties.get(name)) for name in self.property_names] +
+                                 [type_value])
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def get_file_name_part(labels: list):
+    return '_'.join([''.join([character if character.isalnum() else '_' for character in label]) for label in labels])
+
+
+def get_column_type(value):
+    if isinstance(value, bool):
+        return ':boolean'
+    elif isinstance(value, int):
+        return ':long'
+    elif isinstance(value, float):
+        return ':double'
+    elif isinstance(value, (list, set, frozenset, tuple)):
+        return ':string[]'
+    return ''
+
+
+def format_array(values):
+    return IMPORT_ARRAY_DELIMITER.join(sorted([str(value) for value in values]))
+
+
+def format_value(value):
+    if value is None:
+        return ''
+    elif isinstance(value, bool):
+        return 'true' if value else 'false'
+    elif isinstance(value, (list, set, frozenset, tuple)):
+        return format_array(value)
+    return value
@@ -0,0 +1,228 @@
+from rags_src.rags_core import ROOT_ENTITY
+from rags_src.util import LoggingUtil
+
+import argparse
+import logging
+import os
+import random
+import sqlite3
+import threading
+
+logger = LoggingUtil.init_logging("rags.node_registry", logging.INFO, format='medium', logFilePath=f'{os.environ["RAGS_HOME"]}/logs/')
+
+SEEDED_METADATA_KEY = 'seeded'
+
+# node registry maintenance tasks, they can take a while on a big graph so they run outside of builds and requests
+SEED_REGISTRY_TASK = 'seed'
+RECONCILE_REGISTRY_TASK = 'reconcile'
+
+
+class RagsNodeRegistry(object):
+    """
+    A persistent record of the node ids that are already in the graph, stored in a SQLite sidecar file.
+
+    The graph writer skips nodes that are in the registry instead of sending another MERGE for them,
+    and adds nodes to it once they're written.
+
+    The registry is seeded from the graph with seed(). If the graph is reloaded from a dump the registry can drift,
+    check_sample() looks up a sample of the registry in the graph and reconcile() removes ids that are missing.
+    Ids added by RAGs writes are also kept in their own table, a dump taken before a build loses exactly those
+    and a sample of the whole registry (mostly the base graph) would rarely catch it.
+    Seeding and reconciling read the whole graph, run them with run_maintenance (one at a time) instead of during a build.
+    """
+    def __init__(self, registry_path: str):
+        self.registry_path = registry_path
+        self.connection = sqlite3.connect(registry_path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            # a rowid table, so check_sample can pick random rows without sorting the table
+            self.connection.execute('CREATE TABLE IF NOT EXISTS node_ids (id TEXT PRIMARY KEY)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS written_node_ids (id TEXT PRIMARY KEY)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT)')
+        self.lock = threading.Lock()
+        # the maintenance task that's running, if any
+        self.maintenance_task = None
+
+    def __contains__(self, node_id: str):
+        with self.lock:
+            return self.connection.execute('SELECT 1 FROM node_ids WHERE id = ?', (node_id,)).fetchone() is not None
+
+    def add(self, node_ids: list, written: bool = False):
+        """
+        :param written: the nodes were just written by RAGs, rather than found in the graph
+        """
+        node_id_rows = [(node_id,) for node_id in node_ids]
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR IGNORE INTO node_ids (id) VALUES (?)', node_id_rows)
+            if written:
+                self.connection.executemany('INSERT OR IGNORE INTO written_node_ids (id) VALUES (?)', node_id_rows)
+
+    def remove(self, node_ids: list):
+        node_id_rows = [(node_id,) for node_id in node_ids]
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM node_ids WHERE id = ?', node_id_rows)
+            self.connection.executemany('DELETE FROM written_node_ids WHERE id = ?', node_id_rows)
+
+    def get_node_count(self):
+        with self.lock:
+            return self.connection.execute('SELECT count(*) FROM node_ids').fetchone()[0]
+
+    def is_seeded(self):
+        with self.lock:
+            return self.connection.execute('SELECT value FROM metadata WHERE key = ?',
+                                           (SEEDED_METADATA_KEY,)).fetchone() is not None
+
+    def get_status(self):
+        return {'registry_path': self.registry_path,
+                'node_ids': self.get_node_count(),
+                'seeded': self.is_seeded(),
+                'maintenance_task': self.maintenance_task}
+
+    def start_maintenance(self, task: str):
+        """
+        Claim the registry for a maintenance task.
+        :return: False if another task is already running
+        """
+        with self.lock:
+            if self.maintenance_task:
+                return False
+            self.maintenance_task = task
+            return True
+
+    def run_maintenance(self, task: str, graph_db):
+        """
+        Run a maintenance task claimed with start_maintenance, and release the registry when it's done.
+        """
+        try:
+            if task == SEED_REGISTRY_TASK:
+                self.seed(graph_db)
+            elif task == RECONCILE_REGISTRY_TASK:
+                self.reconcile(graph_db)
+            else:
+                raise ValueError(f'Unknown node registry task: {task}')
+        finally:
+            with self.lock:
+                self.maintenance_task = None
+
+    def iterate_node_ids(self, batch_size: int):
+        last_id = ''
+        while True:
+            with self.lock:
+                rows = self.connection.execute('SELECT id FROM node_ids WHERE id > ? ORDER BY id LIMIT ?',
+                                               (last_id, batch_size)).fetchall()
+            if not rows:
+                return
+            node_ids = [row[0] for row in rows]
+            yield node_ids
+            last_id = node_ids[-1]
+
+    def seed(self, graph_db, page_size: int = 100000):
+        """
+        Add every node id in the graph, paging through them in id order.
+        """
+        query = f'MATCH (n:`{ROOT_ENTITY}`) WHERE n.id > $last_id RETURN n.id as id ORDER BY n.id LIMIT $page_size'
+        last_id = ''
+        seeded_count = 0
+        while True:
+            with graph_db.get_session() as session:
+                node_ids = session.read_transaction(read_node_ids, query, {'last_id': last_id, 'page_size': page_size})
+            if not node_ids:
+                break
+            self.add(node_ids)
+            seeded_count += len(node_ids)
+            last_id = node_ids[-1]
+            logger.info(f'Seeding the node registry: {seeded_count} node ids added.')
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)',
+                                    (SEEDED_METADATA_KEY, str(seeded_count)))
+        return seeded_count
+
+    def find_missing(self, graph_db, node_ids: list):
+        """
+        :return: the node ids that aren't in the graph
+        """
+        query = f'UNWIND $ids as node_id OPTIONAL MATCH (n:`{ROOT_ENTITY}` {{id: node_id}}) ' \
+                f'WITH node_id, n WHERE n IS NULL RETURN node_id as id'
+        with graph_db.get_session() as session:
+            return session.read_transaction(read_node_ids, query, {'ids': node_ids})
+
+    def check_sample(self, graph_db, sample_size: int = 100):
+        """
+        Look up a random sample of the registry in the graph, sample_size ids from the whole registry
+        and sample_size from the ids added by RAGs writes.
+
+        Samples are picked by random rowid, each is an index lookup. Rowids left unused by removed ids make the sample
+        favor the ids after them, which doesn't matter for spotting a registry that drifted from the graph.
+        :return: the number of sampled ids that are missing from the graph
+        """
+        with self.lock:
+            sample_ids = self.sample_table('node_ids', sample_size) | self.sample_table('written_node_ids', sample_size)
+        if not sample_ids:
+            return 0
+        return len(self.find_missing(graph_db, list(sample_ids)))
+
+    def sample_table(self, table_name: str, sample_size: int):
+        max_rowid = self.connection.execute(f'SELECT max(rowid) FROM {table_name}').fetchone()[0]
+        if not max_rowid:
+            return set()
+        sample_ids = set()
+        for sample_rowid in random.sample(range(1, max_rowid + 1), min(sample_size, max_rowid)):
+            row = self.connection.execute(f'SELECT id FROM {table_name} WHERE rowid >= ? ORDER BY rowid LIMIT 1',
+                                          (sample_rowid,)).fetchone()
+            if row:
+                sample_ids.add(row[0])
+        return sample_ids
+
+    def reconcile(self, graph_db, batch_size: int = 10000):
+        """
+        Remove the ids that are no longer in the graph.
+        :return: the number of ids removed
+        """
+        removed_count = 0
+        checked_count = 0
+        for node_ids in self.iterate_node_ids(batch_size):
+            missing_ids = self.find_missing(graph_db, node_ids)
+            if missing_ids:
+                self.remove(missing_ids)
+                removed_count += len(missing_ids)
+            checked_count += len(node_ids)
+            logger.info(f'Reconciling the node registry: {checked_count} checked, {removed_count} removed.')
+        return removed_count
+
+    def close(self):
+        self.connection.close()
+
+
+def read_node_ids(tx, query: str, parameters: dict):
+    return [record['id'] for record in tx.run(query, parameters)]
+
+
+# one registry per file is shared by every builder in the process
+shared_node_registries = {}
+
+
+def get_shared_node_registry(registry_path: str):
+    if registry_path not in shared_node_registries:
+        shared_node_registries[registry_path] = RagsNodeRegistry(registry_path)
+        logger.info(f'Using node registry: {registry_path}')
+    return shared_node_registries[registry_path]
+
+
+if __name__ == '__main__':
+    from rags_src.rags_graph_db import RagsGraphDB
+
+    parser = argparse.ArgumentParser(description='Seed or reconcile a RAGs node registry against the graph.')
+    parser.add_argument('registry_path', help='path to the node registry file (created if it does not exist)')
+    parser.add_argument('--seed', action='store_true', help='add every node id in the graph')
+    parser.add_argument('--reconcile', action='store_true', help='remove ids that are no longer in the graph')
+    args = parser.parse_args()
+
+    node_registry = RagsNodeRegistry(args.registry_path)
+    rags_graph_db = RagsGraphDB()
+    if args.reconcile:
+        node_registry.reconcile(rags_graph_db)
+    if args.seed:
+        node_registry.seed(rags_graph_db)
+    logger.info(f'Node registry {args.registry_path} has {node_registry.get_node_count()} node ids.')
+    node_registry.close()
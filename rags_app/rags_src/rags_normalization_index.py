@@ -0,0 +1,208 @@
+from rags_src.rags_core import ROOT_ENTITY
+from rags_src.util import LoggingUtil
+
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+logger = LoggingUtil.init_logging("rags.normalization_index", logging.INFO, format='medium', logFilePath=f'{os.environ["RAGS_HOME"]}/logs/')
+
+
+class RagsNormalizationIndexError(Exception):
+    def __init__(self, error_message: str):
+        self.message = error_message
+
+
+class RagsNormalizationIndex(object):
+    """
+    A local key-value index of node normalization cliques stored in SQLite.
+
+    The index is built from a snapshot of normalization compendia (JSONL files, one clique per line)
+    and answers lookups with the same response shape as the node normalization service, so results
+    can be handed to RagsNormalizer.parse_normalization_json directly.
+
+    Two line formats are supported:
+      compendia format: {"type": "biolink:Disease", "identifiers": [{"i": "MONDO:1", "l": "label"}, ...]}
+      service format:   {"id": {...}, "equivalent_identifiers": [{"identifier": ..., "label": ...}, ...], "type": [...]}
+
+    Loading is incremental - each file's progress is recorded, so an interrupted load resumes where it stopped
+    and files that were already loaded are skipped.
+    """
+    def __init__(self, index_path: str, read_only: bool = False):
+        self.index_path = index_path
+        if read_only:
+            if not os.path.exists(index_path):
+                raise RagsNormalizationIndexError(f'Normalization index not found: {index_path}')
+            self.connection = sqlite3.connect(f'file:{index_path}?mode=ro', uri=True, check_same_thread=False)
+        else:
+            self.connection = sqlite3.connect(index_path, check_same_thread=False)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.create_tables()
+        self.lock = threading.Lock()
+
+    def create_tables(self):
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS cliques '
+                                    '(clique_id INTEGER PRIMARY KEY, normalization TEXT NOT NULL, file_path TEXT)')
+            # indexes built before cliques recorded the file they came from
+            clique_columns = [row[1] for row in self.connection.execute('PRAGMA table_info(cliques)')]
+            if 'file_path' not in clique_columns:
+                self.connection.execute('ALTER TABLE cliques ADD COLUMN file_path TEXT')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS cliques_file_path ON cliques (file_path)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS curies '
+                                    '(curie TEXT PRIMARY KEY, clique_id INTEGER NOT NULL) WITHOUT ROWID')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS loaded_files '
+                                    '(file_path TEXT PRIMARY KEY, file_size INTEGER, lines_loaded INTEGER, complete INTEGER)')
+
+    def load_compendia(self, file_paths: list, batch_size: int = 10000):
+        """
+        Load one or more compendia JSONL files into the index.
+        :param file_paths: a list of JSONL file paths
+        :param batch_size: how many cliques to insert per transaction
+        :return: the number of cliques loaded
+        """
+        total_loaded = 0
+        for file_path in file_paths:
+            total_loaded += self.load_compendia_file(file_path, batch_size)
+        return total_loaded
+
+    def load_compendia_file(self, file_path: str, batch_size: int = 10000):
+        file_size = os.path.getsize(file_path)
+        progress = self.connection.execute('SELECT file_size, lines_loaded, complete FROM loaded_files WHERE file_path = ?',
+                                           (file_path,)).fetchone()
+        lines_to_skip = 0
+        if progress:
+            previous_size, lines_loaded, complete = progress
+            if previous_size == file_size:
+                if complete:
+                    logger.info(f'Normalization index already contains {file_path}, skipping.')
+                    return 0
+                lines_to_skip = lines_loaded
+                logger.info(f'Resuming normalization index load of {file_path} after line {lines_to_skip}.')
+            else:
+                logger.info(f'{file_path} changed since it was loaded, replacing its cliques.')
+                self.delete_file_cliques(file_path)
+
+        cliques_loaded = 0
+        lines_read = 0
+        batch = []
+        with open(file_path) as compendia_file:
+            for line in compendia_file:
+                lines_read += 1
+                if lines_read <= lines_to_skip:
+                    continue
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    normalization = convert_clique_to_normalization(json.loads(line))
+                except (ValueError, KeyError, IndexError, TypeError) as e:
+                    logger.warning(f'Skipping malformed compendia line {lines_read} in {file_path}: {e}')
+                    continue
+                batch.append(normalization)
+                if len(batch) >= batch_size:
+                    self.insert_batch(batch, file_path, file_size, lines_read)
+                    cliques_loaded += len(batch)
+                    batch = []
+
+        self.insert_batch(batch, file_path, file_size, lines_read, complete=True)
+        cliques_loaded += len(batch)
+        logger.info(f'Loaded {cliques_loaded} cliques from {file_path} into the normalization index.')
+        return cliques_loaded
+
+    def delete_file_cliques(self, file_path: str):
+        """
+        Remove the cliques loaded from a file, and the curies that still point to them.
+        """
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM curies WHERE clique_id IN '
+                                    '(SELECT clique_id FROM cliques WHERE file_path = ?)', (file_path,))
+            self.connection.execute('DELETE FROM cliques WHERE file_path = ?', (file_path,))
+            self.connection.execute('DELETE FROM loaded_files WHERE file_path = ?', (file_path,))
+
+    def insert_batch(self, batch: list, file_path: str, file_size: int, lines_read: int, complete: bool = False):
+        with self.lock, self.connection:
+            for normalization in batch:
+                cursor = self.connection.execute('INSERT INTO cliques (normalization, file_path) VALUES (?, ?)',
+                                                 (json.dumps(normalization), file_path))
+                clique_id = cursor.lastrowid
+                self.connection.executemany('INSERT OR REPLACE INTO curies (curie, clique_id) VALUES (?, ?)',
+                                            [(identifier["identifier"], clique_id)
+                                             for identifier in normalization["equivalent_identifiers"]])
+            self.connection.execute('INSERT OR REPLACE INTO loaded_files (file_path, file_size, lines_loaded, complete) '
+                                    'VALUES (?, ?, ?, ?)',
+                                    (file_path, file_size, lines_read, 1 if complete else 0))
+
+    def get_normalization(self, curie: str):
+        """
+        Look up a single curie.
+        :return: the normalization in node normalization service response shape, or None if not found
+        """
+        with self.lock:
+            row = self.connection.execute('SELECT c.normalization FROM curies i JOIN cliques c ON i.clique_id = c.clique_id '
+                                          'WHERE i.curie = ?', (curie,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_normalizations(self, curies: list):
+        """
+        Look up a list of curies.
+        :return: a dictionary of curie -> normalization for the curies that were found in the index
+        """
+        found = {}
+        for curie in curies:
+            normalization = self.get_normalization(curie)
+            if normalization is not None:
+                found[curie] = normalization
+        return found
+
+    def get_clique_count(self):
+        with self.lock:
+            return self.connection.execute('SELECT count(*) FROM cliques').fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+
+def convert_clique_to_normalization(clique: dict):
+    # already in the node normalization service response shape
+    if "equivalent_identifiers" in clique:
+        return {"id": clique["id"],
+                "equivalent_identifiers": clique["equivalent_identifiers"],
+                "type": clique["type"]}
+
+    equivalent_identifiers = []
+    for identifier in clique["identifiers"]:
+        equivalent_identifier = {"identifier": identifier["i"]}
+        if identifier.get("l"):
+            equivalent_identifier["label"] = identifier["l"]
+        equivalent_identifiers.append(equivalent_identifier)
+
+    # the first identifier in a compendia clique is the preferred one
+    best_id = dict(equivalent_identifiers[0])
+    if "label" not in best_id and clique.get("preferred_name"):
+        best_id["label"] = clique["preferred_name"]
+
+    # compendia only list the most specific type, the service also returns ancestors
+    clique_types = clique["type"] if isinstance(clique["type"], list) else [clique["type"]]
+    if ROOT_ENTITY not in clique_types:
+        clique_types = clique_types + [ROOT_ENTITY]
+
+    return {"id": best_id,
+            "equivalent_identifiers": equivalent_identifiers,
+            "type": clique_types}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build a local node normalization index from compendia JSONL files.')
+    parser.add_argument('index_path', help='path of the SQLite index file to create or update')
+    parser.add_argument('compendia_files', nargs='+', help='compendia JSONL files to load')
+    parser.add_argument('--batch_size', type=int, default=10000)
+    args = parser.parse_args()
+    normalization_index = RagsNormalizationIndex(args.index_path)
+    normalization_index.load_compendia(args.compendia_files, batch_size=args.batch_size)
+    logger.info(f'Normalization index contains {normalization_index.get_clique_count()} cliques.')
+    normalization_index.close()
@@ -1,9 +1,12 @@
 from rags_src.rags_core import RAGsNode
+from rags_src.rags_normalization_index import RagsNormalizationIndex
 from rags_src.util import LoggingUtil, Text
 
+from concurrent.futures import Future
 import logging
 import requests
 import os
+import threading
 
 logger = LoggingUtil.init_logging("rags.normalizer", logging.INFO, format='medium', logFilePath=f'{os.environ["RAGS_HOME"]}/logs/')
 
@@ -15,10 +18,15 @@ class RagsNormalizationError(Exception):
 
 class RagsNormalizer(object):
 
-    def __init__(self):
-        self.node_normalization_url = os.environ["NODE_NORMALIZATION_ENDPOINT"]
+    def __init__(self, normalization_index: RagsNormalizationIndex = None):
+        # the node normalization endpoint is optional when a local normalization index is used (air-gapped set ups)
+        self.node_normalization_url = os.environ.get("NODE_NORMALIZATION_ENDPOINT")
         self.edge_normalization_url = os.environ["EDGE_NORMALIZATION_ENDPOINT"]
 
+        if normalization_index is None and os.environ.get("NODE_NORMALIZATION_INDEX"):
+            normalization_index = get_shared_normalization_index(os.environ["NODE_NORMALIZATION_INDEX"])
+        self.normalization_index = normalization_index
+
         self.cached_normalized_nodes = {}
         self.cached_normalized_predicates = {}
 
@@ -66,45 +74,74 @@ class RagsNormalizer(object):
         # filter out previously cached normalizations, remove duplicates
         ids_to_normalize = list(set([node_id for node_id in node_ids if node_id not in self.cached_normalized_nodes]))
 
+        # check the local normalization index first, if there is one
+        if self.normalization_index and ids_to_normalize:
+            index_results = self.normalization_index.get_normalizations(ids_to_normalize)
+            for node_id, normalization_response in index_results.items():
+                self.cached_normalized_nodes[node_id] = self.parse_normalization_json(normalization_response)
+            ids_to_normalize = [node_id for node_id in ids_to_normalize if node_id not in index_results]
+            if not self.node_normalization_url:
+                # without a remote service the index is the only source, anything missing is not found
+                for node_id in ids_to_normalize:
+                    self.cached_normalized_nodes[node_id] = None
+                ids_to_normalize = []
+
+        # claim the ids that aren't already being fetched by another normalizer in this process,
+        # the others will be waited on and shared instead of being requested again
+        ids_to_normalize, in_flight_ids = node_normalization_flights.claim(ids_to_normalize)
+
         # split the remaining node ids into batches of 1000
         batches = [ids_to_normalize[i: i + 1000] for i in range(0, len(ids_to_normalize), 1000)]
 
         # make a request for each batch of ids
-        for batch in batches:
-            # set 'curies' http post parameter to the current batch of node ids
-            payload = {'curies': batch}
-            r = requests.post(self.node_normalization_url, json=payload)
-            if r.status_code == 200:
-                response_json = r.json()
-                # for each node id store the response information or None in cached_normalized_nodes
-                for node_id in batch:
-                    try:
-                        normalization_response = response_json[node_id]
-                    except KeyError:
-                        error_message = f'Node Normalization returned 200 but was missing an entry for {node_id}: {r.url}'
-                        logger.error(error_message)
-                        raise RagsNormalizationError(error_message)
-                    if normalization_response:
-                        #logger.warning(f'found response for {node_id}')
-                        normalized_node = self.parse_normalization_json(normalization_response)
-                        self.cached_normalized_nodes[node_id] = normalized_node
-                    else:
-                        #logger.warning(f'found no norm response for {node_id}')
-                        # if there was no good response, store None instead
-                        self.cached_normalized_nodes[node_id] = None
-            elif r.status_code == 404:
-                # 404 means none of them were found - store None for all of them
+        try:
+            for batch in batches:
+                self.request_node_normalizations(batch)
                 for node_id in batch:
-                    logger.warning(f'found no norm response for {node_id}')
-                    self.cached_normalized_nodes[node_id] = None
-            else:
-                # this is an abnormal response, bail
-                error_message = f'Node Normalization returned a non-200 response({r.status_code}) for {len(batch)} nodes.. {r.json()}'
-                logger.error(error_message)
-                raise RagsNormalizationError(error_message)
+                    node_normalization_flights.resolve(node_id, self.cached_normalized_nodes[node_id])
+        except BaseException as e:
+            # make sure anyone waiting on these ids gets the error too
+            node_normalization_flights.fail(ids_to_normalize, e)
+            raise
+
+        for node_id, in_flight_result in in_flight_ids.items():
+            self.cached_normalized_nodes[node_id] = in_flight_result.result()
 
         return self.cached_normalized_nodes
 
+    def request_node_normalizations(self, batch: list):
+        # set 'curies' http post parameter to the current batch of node ids
+        payload = {'curies': batch}
+        r = requests.post(self.node_normalization_url, json=payload)
+        if r.status_code == 200:
+            response_json = r.json()
+            # for each node id store the response information or None in cached_normalized_nodes
+            for node_id in batch:
+                try:
+                    normalization_response = response_json[node_id]
+                except KeyError:
+                    error_message = f'Node Normalization returned 200 but was missing an entry for {node_id}: {r.url}'
+                    logger.error(error_message)
+                    raise RagsNormalizationError(error_message)
+                if normalization_response:
+                    #logger.warning(f'found response for {node_id}')
+                    normalized_node = self.parse_normalization_json(normalization_response)
+                    self.cached_normalized_nodes[node_id] = normalized_node
+                else:
+                    #logger.warning(f'found no norm response for {node_id}')
+                    # if there was no good response, store None instead
+                    self.cached_normalized_nodes[node_id] = None
+        elif r.status_code == 404:
+            # 404 means none of them were found - store None for all of them
+            for node_id in batch:
+                logger.warning(f'found no norm response for {node_id}')
+                self.cached_normalized_nodes[node_id] = None
+        else:
+            # this is an abnormal response, bail
+            error_message = f'Node Normalization returned a non-200 response({r.status_code}) for {len(batch)} nodes.. {r.json()}'
+            logger.error(error_message)
+            raise RagsNormalizationError(error_message)
+
     def parse_normalization_json(self, normalization_result):
         best_id = normalization_result["id"]
         normalized_id = best_id["identifier"]
@@ -131,3 +168,56 @@ class RagsNormalizer(object):
                                    all_types=normalized_types)
         return normalized_node
 
+
+# normalization indexes are read-only after they're built, so they can be shared by every normalizer in the process
+shared_normalization_indexes = {}
+
+
+def get_shared_normalization_index(index_path: str):
+    if index_path not in shared_normalization_indexes:
+        shared_normalization_indexes[index_path] = RagsNormalizationIndex(index_path, read_only=True)
+        logger.info(f'Using local node normalization index: {index_path}')
+    return shared_normalization_indexes[index_path]
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent requests for the same keys across the process.
+
+    The first caller to claim a key is responsible for fetching it and resolving (or failing) it,
+    later callers get a Future for the in-flight result instead of sending their own request.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}
+
+    def claim(self, keys: list):
+        """
+        :return: a tuple of (list of keys claimed by the caller, dictionary of key -> Future for keys already in flight)
+        """
+        claimed_keys = []
+        in_flight_keys = {}
+        with self.lock:
+            for key in keys:
+                if key in self.in_flight:
+                    in_flight_keys[key] = self.in_flight[key]
+                else:
+                    self.in_flight[key] = Future()
+                    claimed_keys.append(key)
+        return claimed_keys, in_flight_keys
+
+    def resolve(self, key, result):
+        with self.lock:
+            future = self.in_flight.pop(key, None)
+        if future:
+            future.set_result(result)
+
+    def fail(self, keys: list, exception: BaseException):
+        # keys that were already resolved are ignored
+        with self.lock:
+            futures = [self.in_flight.pop(key) for key in keys if key in self.in_flight]
+        for future in futures:
+            future.set_exception(exception)
+
+
+node_normalization_flights = SingleFlight()
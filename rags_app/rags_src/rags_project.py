@@ -5,7 +5,9 @@ from rags_src.rags_normalizer import RagsNormalizer
 from rags_src.rags_graph_db import RagsGraphDB
 from rags_src.rags_project_db import RagsProjectDB
 from rags_src.util import LoggingUtil
-from rags_src.rags_core import RAGsNode, GWAS, MWAS, ROOT_ENTITY, RAGS_ERROR_SEARCHING, RAGS_ERROR_BUILDING, SEQUENCE_VARIANT
+from rags_src.rags_core import RAGsNode, GWAS, MWAS, ROOT_ENTITY, RAGS_ERROR_SEARCHING, RAGS_ERROR_BUILDING, \
+    RAGS_ERROR_VALIDATION
+from rags_src.rags_graph_queries import VARIANTS_FOR_ANNOTATION_QUERY, get_graph_query
 from dataclasses import dataclass
 import logging
 import os
@@ -14,6 +16,9 @@ logger = LoggingUtil.init_logging("rags.projects", logging.INFO, format='medium'
 
 validation_logger = LoggingUtil.init_logging("rags.project_validation", logging.INFO, format='medium', logFilePath=f'{os.environ["RAGS_HOME"]}/logs/')
 
+# the number of variants annotated at a time
+DEFAULT_ANNOTATION_CHUNK_SIZE = 10000
+
 
 @dataclass
 class RagsProjectResults:
@@ -37,13 +42,14 @@ class RagsProjectResults:
 
 class RagsProjectManager:
 
-    def __init__(self, project_id: str, project_name: str, project_db: RagsProjectDB):
+    def __init__(self, project_id: str, project_name: str, project_db: RagsProjectDB, rags_graph_db: RagsGraphDB = None):
         self.project_id = project_id
         self.project_name = project_name
         self.project_db = project_db
 
         self.rags_normalizer = RagsNormalizer()
-        self.rags_graph_db = RagsGraphDB()
+        self.rags_graph_db = rags_graph_db if rags_graph_db else RagsGraphDB()
+        self.annotation_chunk_size = int(os.environ.get("RAGS_ANNOTATION_CHUNK_SIZE", DEFAULT_ANNOTATION_CHUNK_SIZE))
 
         rags_data_directory = os.environ["RAGS_DATA_DIR"]
 
@@ -138,12 +144,19 @@ class RagsProjectManager:
 
         results = RagsProjectResults()
 
-        logger.info('Normalizing and writing hits to the graph...')
-        self.build_hits(force_rebuild)
+        try:
+            logger.info('Normalizing and writing hits to the graph...')
+            for warning_message in self.build_hits(force_rebuild):
+                results.set_warning_message(warning_message)
 
-        # next go into the files and find/write the associations
-        logger.info('Writing associations to the graph...')
-        self.build_associations(force_rebuild)
+            # next go into the files and find/write the associations
+            logger.info('Writing associations to the graph...')
+            self.build_associations(force_rebuild)
+        finally:
+            # closes the export files or stops the background writer threads
+            self.rags_builder.writer.close()
+            # even a failed build may have changed the graph, cached query results are out of date either way
+            self.project_db.bump_build_generation(self.project_id)
 
         logger.info(f'Building RAGs complete for project: {self.project_id}')
 
@@ -153,8 +166,11 @@ class RagsProjectManager:
         return results
 
     def build_hits(self, force_rebuild: bool = False):
-        # Normalize and process everything needed for the sequence variants.
-        # Write all of that to the graph.
+        """
+        Normalize and process everything needed for the sequence variants and metabolites, and write it to the graph.
+        :return: a list of warning messages
+        """
+        warning_messages = []
         if force_rebuild:
             unprocessed_gwas_hits = self.project_db.get_all_gwas_hits(self.project_id)
         else:
@@ -162,7 +178,9 @@ class RagsProjectManager:
 
         if unprocessed_gwas_hits:
             logger.debug('About to process sequence variants!')
-            self.rags_builder.process_gwas_variants(unprocessed_gwas_hits)
+            variant_results = self.rags_builder.process_gwas_variants(unprocessed_gwas_hits)
+            # hits in chunks that failed normalization stay unprocessed, the next build tries them again
+            warning_messages.extend(variant_results.error_messages)
             logger.debug(f'{len(unprocessed_gwas_hits)} new sequence variants processed and added to the graph.')
             # the process_gwas_variants function may change GWASHit ORM objects which would be committed to the DB here
             self.project_db.commit_orm_transactions()
@@ -184,6 +202,7 @@ class RagsProjectManager:
             self.project_db.commit_orm_transactions()
         else:
             logger.debug(f'No unprocessed metabolites found for {self.project_id}.')
+        return warning_messages
 
     def build_associations(self, force_rebuild: bool = False):
         all_studies = self.project_db.get_all_studies(self.project_id)
@@ -203,7 +222,7 @@ class RagsProjectManager:
                         # otherwise write all of the associations
                         if all_mwas_hits is None:
                             all_mwas_hits = self.project_db.get_all_mwas_hits(self.project_id)
-                        self.rags_builder.process_mwas_associations(study, all_mwas_hits)
+                        self.rags_builder.process_mwas_associations(study, all_mwas_hits, full_rewrite=True)
 
                 elif study.study_type == GWAS:
                     if study.written and not force_rebuild:
@@ -213,10 +232,16 @@ class RagsProjectManager:
                         # otherwise write all of the associations
                         if all_gwas_hits is None:
                             all_gwas_hits = self.project_db.get_all_gwas_hits(self.project_id)
-                        self.rags_builder.process_gwas_associations(study, all_gwas_hits)
+                        self.rags_builder.process_gwas_associations(study, all_gwas_hits, full_rewrite=True)
+                # keep a copy of the associations for the project queries that are answered from the project db
+                self.project_db.save_associations(study,
+                                                  self.rags_builder.pop_written_associations(),
+                                                  replace_existing=force_rebuild or not study.written,
+                                                  delay_commit=True)
                 study.written = True
             else:
                 logger.info(f'Skipping associations for study: {study.study_name} (due to an error in the search phase)')
+        self.rags_builder.writer.log_partition_stats()
 
         if unwritten_gwas_hits:
             for gwas_hit in unwritten_gwas_hits:
@@ -229,18 +254,52 @@ class RagsProjectManager:
         self.project_db.commit_orm_transactions()
 
     def annotate_hits(self):
+        """
+        Find genes for the variants that haven't been annotated yet, a chunk of variants at a time.
 
+        Each chunk is looked up, normalized and written before the next one is read, so memory use depends on the
+        chunk size and not on the number of variants. The last variant of every finished chunk is saved as a checkpoint,
+        an annotation that was interrupted picks up after it the next time it runs.
+        """
         results = RagsProjectResults()
 
-        normalized_association_predicate = self.rags_builder.normalized_association_predicate
-        # TODO the variant node type and nearby variant edge type should be normalized dynamically maybe
-        query = f'MATCH (v:`{SEQUENCE_VARIANT}`)<-[:`{normalized_association_predicate}`]-() with distinct v WHERE NOT (v)-[:`biolink:is_nearby_variant_of`]-() return v.id as id, v.equivalent_identifiers as equivalent_identifiers'
-        variants_for_annotation = self.rags_graph_db.custom_read_query(query)
-
-        if variants_for_annotation:
-            logger.info(f'Found {len(variants_for_annotation)} variants that need genes.')
-            self.rags_builder.add_genes_to_variants(variants_for_annotation)
-            results.success_message = f"Annotated {len(variants_for_annotation)} variants."
+        last_variant_id = self.project_db.get_annotation_checkpoint(self.project_id)
+        if last_variant_id:
+            logger.info(f'Resuming annotation after variant {last_variant_id}.')
+        else:
+            last_variant_id = get_graph_query(VARIANTS_FOR_ANNOTATION_QUERY).first_page_key[0]
+
+        annotated_count = 0
+        annotation_started = False
+        try:
+            while True:
+                # TODO the variant node type should be normalized dynamically maybe
+                variants_for_annotation = self.rags_graph_db.run_named_query(VARIANTS_FOR_ANNOTATION_QUERY,
+                                                                             {'last_id': last_variant_id,
+                                                                              'page_size': self.annotation_chunk_size},
+                                                                             predicate=self.rags_builder.normalized_association_predicate)
+                if not variants_for_annotation:
+                    break
+                logger.info(f'Found {len(variants_for_annotation)} variants that need genes '
+                            f'({annotated_count} annotated so far).')
+                annotation_started = True
+                self.rags_builder.add_genes_to_variants(variants_for_annotation)
+                annotated_count += len(variants_for_annotation)
+                last_variant_id = variants_for_annotation[-1]['id']
+                self.project_db.set_annotation_checkpoint(self.project_id, last_variant_id)
+                if len(variants_for_annotation) < self.annotation_chunk_size:
+                    break
+        finally:
+            self.rags_builder.writer.close()
+            if annotation_started:
+                # variants are shared between projects, so annotation changes the results of every project
+                self.project_db.bump_all_build_generations()
+
+        # finished, the next annotation starts from the beginning again
+        self.project_db.set_annotation_checkpoint(self.project_id, None)
+
+        if annotated_count:
+            results.success_message = f"Annotated {annotated_count} variants."
         else:
             logger.info(f'Found no variants that need genes in the graph.')
             results.success_message = f"Found no variants that need genes in the graph."
@@ -249,26 +308,38 @@ class RagsProjectManager:
         results.success = True
         return results
 
-
     def validate_project(self):
+        """
+        Check that the graph has every association the builder wrote, for all of the project's studies in one query.
+        Studies that don't match get a validation error.
+        """
         logger.info(f'Running validation for all builds in {self.project_id}')
+        results = RagsProjectResults()
 
-        if not self.rags_validator:
-            self.rags_validator = RagsValidator(self.rags_graph_db)
-        all_good = True
-        all_rags = self.project_db.get_rags(self.project_id)
-        #num_gwas_hits = self.project_db.get_all_gwas_hits(self.project_id)
-        #num_mwas_hits = self.project_db.get_all_mwas_hits(self.project_id)
-
-        for rag in all_rags:
-            num_associations = rag.num_associations
-            if num_associations:
-                validation_info = self.rags_validator.validate_associations(self.project_id,
-                                                                            rag,
-                                                                            num_associations)
-                if not validation_info['success']:
-                    all_good = False
+        written_studies = [study for study in self.project_db.get_all_studies(self.project_id) if study.written]
+        if not written_studies:
+            results.success = True
+            results.success_message = "No studies have been built yet."
+            return results
+
+        rags_validator = RagsValidator(self.rags_graph_db)
+        validation_results = rags_validator.validate_associations(self.project_id,
+                                                                  written_studies,
+                                                                  self.rags_builder.normalized_association_predicate)
+        failed_count = 0
+        for study, validation_info in zip(written_studies, validation_results):
+            self.project_db.clear_study_errors_by_type(study.id, RAGS_ERROR_VALIDATION, delay_commit=True)
+            if validation_info.success:
+                validation_logger.info(f'{study.study_name}: {validation_info.message}')
             else:
-                logger.info(f'In validation: No associations found for rag {rag.rag_name}.')
+                failed_count += 1
+                validation_logger.warning(f'{study.study_name}: {validation_info.message}')
+                self.project_db.create_study_error(study.id, RAGS_ERROR_VALIDATION, validation_info.message, delay_commit=True)
+        self.project_db.commit_orm_transactions()
 
-        return all_good
+        if failed_count:
+            results.set_error_message(f'Validation failed for {failed_count} of {len(written_studies)} studies.')
+        else:
+            results.success = True
+            results.success_message = f'Validation passed for all {len(written_studies)} studies.'
+        return results
@@ -1,4 +1,5 @@
-from sqlalchemy.orm import Session
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.orm import Session, aliased
 from sqlalchemy.exc import IntegrityError
 
 import rags_src.rags_core as rags_core
@@ -12,6 +13,10 @@ import os
 
 from typing import List
 
+# association triangles are made of associations with these trait types
+PHENOTYPE_TRAIT_TYPES = [rags_core.DISEASE, rags_core.PHENOTYPIC_FEATURE]
+TRIANGLE_SORT_COLUMNS = ['variant_phenotype_p_value', 'phenotype_chemical_p_value', 'chemical_variant_p_value']
+
 logger = LoggingUtil.init_logging("rags.rags_project_db", logging.INFO, format='medium', logFilePath=f'{os.environ["RAGS_HOME"]}/logs/')
 
 
@@ -55,6 +60,35 @@ class RagsProjectDB(object):
     def get_project_by_name(self, project_name: str):
         return self.db.query(rags_db_models.RAGsProject).filter(rags_db_models.RAGsProject.name == project_name).first()
 
+    def get_build_generation(self, project_id: int):
+        project = self.get_project_by_id(project_id)
+        return project.build_generation if project else None
+
+    def bump_build_generation(self, project_id: int, delay_commit: bool = False):
+        self.db.query(rags_db_models.RAGsProject).filter(rags_db_models.RAGsProject.id == project_id).update(
+            {rags_db_models.RAGsProject.build_generation: rags_db_models.RAGsProject.build_generation + 1},
+            synchronize_session=False)
+        if not delay_commit:
+            self.db.commit()
+
+    def bump_all_build_generations(self, delay_commit: bool = False):
+        self.db.query(rags_db_models.RAGsProject).update(
+            {rags_db_models.RAGsProject.build_generation: rags_db_models.RAGsProject.build_generation + 1},
+            synchronize_session=False)
+        if not delay_commit:
+            self.db.commit()
+
+    def get_annotation_checkpoint(self, project_id: int):
+        project = self.get_project_by_id(project_id)
+        return project.annotation_checkpoint if project else None
+
+    def set_annotation_checkpoint(self, project_id: int, variant_id: str, delay_commit: bool = False):
+        self.db.query(rags_db_models.RAGsProject).filter(rags_db_models.RAGsProject.id == project_id).update(
+            {rags_db_models.RAGsProject.annotation_checkpoint: variant_id},
+            synchronize_session=False)
+        if not delay_commit:
+            self.db.commit()
+
     def project_exists_by_id(self, project_id: int):
         if self.db.query(rags_db_models.RAGsProject).filter(rags_db_models.RAGsProject.id == project_id).first():
             return True
@@ -116,6 +150,7 @@ class RagsProjectDB(object):
             self.db.delete(hit)
         for error in db_study.errors:
             self.db.delete(error)
+        self.delete_study_associations(db_study.id)
         self.db.delete(db_study)
         if not delay_commit:
             self.db.commit()
@@ -217,5 +252,161 @@ class RagsProjectDB(object):
             self.db.commit()
         return True
 
+    def save_associations(self,
+                          study: rags_db_models.RAGsStudy,
+                          associations: list,
+                          replace_existing: bool = False,
+                          delay_commit: bool = False):
+        """
+        Record the associations written to the graph for a study and add the association triangles they complete.
+
+        :param associations: a list of (trait id, hit id, p value)
+        :param replace_existing: remove the study's previous associations (and their triangles) first
+        """
+        if replace_existing:
+            self.delete_study_associations(study.id)
+        first_association_id = (self.db.query(func.max(rags_db_models.RAGsAssociationRecord.id)).scalar() or 0) + 1
+        self.db.bulk_insert_mappings(rags_db_models.RAGsAssociationRecord,
+                                     [{'project_id': study.project_id,
+                                       'study_id': study.id,
+                                       'study_type': study.study_type,
+                                       'trait_id': trait_id,
+                                       'trait_type': study.original_trait_type,
+                                       'hit_id': hit_id,
+                                       'p_value': p_value} for (trait_id, hit_id, p_value) in associations])
+        if associations:
+            self.add_association_triangles(study.project_id, first_association_id)
+        if not delay_commit:
+            self.db.commit()
+
+    def delete_study_associations(self, study_id: int):
+        study_association_ids = select([rags_db_models.RAGsAssociationRecord.id]).\
+            where(rags_db_models.RAGsAssociationRecord.study_id == study_id)
+        self.db.query(rags_db_models.RAGsTriangle).filter(
+            or_(rags_db_models.RAGsTriangle.variant_phenotype_association_id.in_(study_association_ids),
+                rags_db_models.RAGsTriangle.phenotype_chemical_association_id.in_(study_association_ids),
+                rags_db_models.RAGsTriangle.chemical_variant_association_id.in_(study_association_ids))).\
+            delete(synchronize_session=False)
+        self.db.query(rags_db_models.RAGsAssociationRecord).\
+            filter(rags_db_models.RAGsAssociationRecord.study_id == study_id).delete(synchronize_session=False)
+
+    def add_association_triangles(self, project_id: int, first_association_id: int):
+        """
+        Add the triangles (variant - phenotype - chemical - variant) that include an association
+        with an id of at least first_association_id, joining on the indexed association table.
+        """
+        variant_phenotype = aliased(rags_db_models.RAGsAssociationRecord)
+        phenotype_chemical = aliased(rags_db_models.RAGsAssociationRecord)
+        chemical_variant = aliased(rags_db_models.RAGsAssociationRecord)
+        triangles = self.db.query(variant_phenotype.project_id,
+                                  variant_phenotype.hit_id,
+                                  variant_phenotype.trait_id,
+                                  phenotype_chemical.hit_id,
+                                  variant_phenotype.p_value,
+                                  phenotype_chemical.p_value,
+                                  chemical_variant.p_value,
+                                  variant_phenotype.id,
+                                  phenotype_chemical.id,
+                                  chemical_variant.id).\
+            filter(variant_phenotype.project_id == project_id,
+                   variant_phenotype.study_type == rags_core.GWAS,
+                   variant_phenotype.trait_type.in_(PHENOTYPE_TRAIT_TYPES)).\
+            filter(phenotype_chemical.project_id == project_id,
+                   phenotype_chemical.study_type == rags_core.MWAS,
+                   phenotype_chemical.trait_id == variant_phenotype.trait_id).\
+            filter(chemical_variant.project_id == project_id,
+                   chemical_variant.study_type == rags_core.GWAS,
+                   chemical_variant.trait_type == rags_core.CHEMICAL_SUBSTANCE,
+                   chemical_variant.trait_id == phenotype_chemical.hit_id,
+                   chemical_variant.hit_id == variant_phenotype.hit_id)
+        triangle_table = rags_db_models.RAGsTriangle.__table__
+        triangle_columns = [triangle_table.c.project_id,
+                            triangle_table.c.variant_id,
+                            triangle_table.c.phenotype_id,
+                            triangle_table.c.chemical_id,
+                            triangle_table.c.variant_phenotype_p_value,
+                            triangle_table.c.phenotype_chemical_p_value,
+                            triangle_table.c.chemical_variant_p_value,
+                            triangle_table.c.variant_phenotype_association_id,
+                            triangle_table.c.phenotype_chemical_association_id,
+                            triangle_table.c.chemical_variant_association_id]
+        # one pass per corner so each one can use an index, triangles found twice are ignored
+        for new_association in (variant_phenotype, phenotype_chemical, chemical_variant):
+            new_triangles = triangles.filter(new_association.id >= first_association_id)
+            self.db.execute(triangle_table.insert().prefix_with('OR IGNORE').from_select(triangle_columns,
+                                                                                         new_triangles.statement))
+
+    def has_associations(self, project_id: int):
+        return self.db.query(rags_db_models.RAGsAssociationRecord.id).\
+            filter(rags_db_models.RAGsAssociationRecord.project_id == project_id).first() is not None
+
+    def get_association_triangles(self,
+                                  project_id: int,
+                                  sort_by: str = 'variant_phenotype_p_value',
+                                  skip: int = 0,
+                                  limit: int = 150):
+        """
+        :return: (variant, variant-phenotype p value, phenotype, phenotype-chemical p value, chemical, chemical-variant p value) rows
+        """
+        if sort_by not in TRIANGLE_SORT_COLUMNS:
+            raise ValueError(f'Triangles can not be sorted by {sort_by}')
+        triangle = rags_db_models.RAGsTriangle
+        return self.db.query(triangle.variant_id,
+                             triangle.variant_phenotype_p_value,
+                             triangle.phenotype_id,
+                             triangle.phenotype_chemical_p_value,
+                             triangle.chemical_id,
+                             triangle.chemical_variant_p_value).\
+            filter(triangle.project_id == project_id).\
+            order_by(getattr(triangle, sort_by), triangle.id).offset(skip).limit(limit).all()
+
+    def iterate_phenotype_paths(self,
+                                project_id: int,
+                                p_value_cutoff: float,
+                                page_size: int = 1000,
+                                after_path_key: tuple = None):
+        """
+        Yield pages of variants and chemicals associated with the same phenotype, both below the p value cutoff.
+
+        Paths come in path key order, each page picks up after the last path key of the one before,
+        and with after_path_key the first page starts after that path.
+        :return: (variant, variant-phenotype p value, phenotype, phenotype-chemical p value, chemical,
+        variant-phenotype association id, phenotype-chemical association id) rows, the last two are the path key
+        """
+        variant_phenotype = aliased(rags_db_models.RAGsAssociationRecord)
+        phenotype_chemical = aliased(rags_db_models.RAGsAssociationRecord)
+        paths = self.db.query(variant_phenotype.hit_id,
+                              variant_phenotype.p_value,
+                              variant_phenotype.trait_id,
+                              phenotype_chemical.p_value,
+                              phenotype_chemical.hit_id,
+                              variant_phenotype.id,
+                              phenotype_chemical.id).\
+            filter(variant_phenotype.project_id == project_id,
+                   variant_phenotype.study_type == rags_core.GWAS,
+                   variant_phenotype.trait_type.in_(PHENOTYPE_TRAIT_TYPES),
+                   variant_phenotype.p_value < p_value_cutoff).\
+            filter(phenotype_chemical.project_id == project_id,
+                   phenotype_chemical.study_type == rags_core.MWAS,
+                   phenotype_chemical.trait_id == variant_phenotype.trait_id,
+                   phenotype_chemical.p_value < p_value_cutoff).\
+            order_by(variant_phenotype.id, phenotype_chemical.id)
+        while True:
+            if after_path_key:
+                page = paths.filter(or_(variant_phenotype.id > after_path_key[0],
+                                        and_(variant_phenotype.id == after_path_key[0],
+                                             phenotype_chemical.id > after_path_key[1]))).limit(page_size).all()
+            else:
+                page = paths.limit(page_size).all()
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            after_path_key = tuple(page[-1][-2:])
+
     def commit_orm_transactions(self):
         self.db.commit()
+
+    def expire_orm_objects(self):
+        # objects loaded before another session changed them are read again on next access
+        self.db.expire_all()
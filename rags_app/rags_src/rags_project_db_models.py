@@ -1,4 +1,4 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Float
+from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Float, Index, UniqueConstraint, inspect
 from sqlalchemy.orm import relationship
 
 from app_database import Base
@@ -8,6 +8,8 @@ RAGS_STUDY_TABLE_NAME = "r_studies"
 RAGS_ERRORS_TABLE_NAME = "r_errors"
 GWAS_HITS_TABLE_NAME = "gwas_hits"
 MWAS_HITS_TABLE_NAME = "mwas_hits"
+RAGS_ASSOCIATIONS_TABLE_NAME = "r_associations"
+RAGS_TRIANGLES_TABLE_NAME = "r_association_triangles"
 
 
 class RAGsProject(Base):
@@ -16,6 +18,11 @@ class RAGsProject(Base):
     name = Column(String, index=True, unique=True)
     studies = relationship("RAGsStudy")
 
+    # goes up every time the project's part of the graph changes (build, annotate, delete)
+    build_generation = Column(Integer, default=0, nullable=False, server_default='0')
+    # the last variant id of the last annotation chunk written, set while an annotation is running or was interrupted
+    annotation_checkpoint = Column(String, nullable=True)
+
 
 class RAGsStudy(Base):
     __tablename__ = RAGS_STUDY_TABLE_NAME
@@ -92,3 +99,64 @@ class MWASHit(Base):
     project_id = Column(Integer, ForeignKey(f'{RAGS_PROJECTS_TABLE_NAME}.id'))
     study_id = Column(Integer, ForeignKey(f'{RAGS_STUDY_TABLE_NAME}.id'))
     written = Column(Boolean, default=False)
+
+
+class RAGsAssociationRecord(Base):
+    # a copy of every association edge the builder writes to the graph, so project queries can join them in SQL
+    __tablename__ = RAGS_ASSOCIATIONS_TABLE_NAME
+    id = Column(Integer, primary_key=True, index=True)
+    project_id = Column(Integer, ForeignKey(f'{RAGS_PROJECTS_TABLE_NAME}.id'))
+    study_id = Column(Integer, ForeignKey(f'{RAGS_STUDY_TABLE_NAME}.id'), index=True)
+    study_type = Column(String)
+    # the normalized trait id and its type (the edge subject)
+    trait_id = Column(String)
+    trait_type = Column(String)
+    # the normalized variant or metabolite id (the edge object)
+    hit_id = Column(String)
+    p_value = Column(Float)
+
+    __table_args__ = (Index('ix_r_associations_project_trait', 'project_id', 'trait_id'),
+                      Index('ix_r_associations_project_hit', 'project_id', 'hit_id'))
+
+
+class RAGsTriangle(Base):
+    # a variant associated with a phenotype, the phenotype with a chemical and the chemical with the variant
+    __tablename__ = RAGS_TRIANGLES_TABLE_NAME
+    id = Column(Integer, primary_key=True, index=True)
+    project_id = Column(Integer, ForeignKey(f'{RAGS_PROJECTS_TABLE_NAME}.id'))
+    variant_id = Column(String)
+    phenotype_id = Column(String)
+    chemical_id = Column(String)
+    variant_phenotype_p_value = Column(Float)
+    phenotype_chemical_p_value = Column(Float)
+    chemical_variant_p_value = Column(Float)
+    variant_phenotype_association_id = Column(Integer, ForeignKey(f'{RAGS_ASSOCIATIONS_TABLE_NAME}.id'), index=True)
+    phenotype_chemical_association_id = Column(Integer, ForeignKey(f'{RAGS_ASSOCIATIONS_TABLE_NAME}.id'), index=True)
+    chemical_variant_association_id = Column(Integer, ForeignKey(f'{RAGS_ASSOCIATIONS_TABLE_NAME}.id'), index=True)
+
+    __table_args__ = (UniqueConstraint('variant_phenotype_association_id',
+                                       'phenotype_chemical_association_id',
+                                       'chemical_variant_association_id'),
+                      Index('ix_r_association_triangles_variant_phenotype_p_value', 'project_id', 'variant_phenotype_p_value'),
+                      Index('ix_r_association_triangles_phenotype_chemical_p_value', 'project_id', 'phenotype_chemical_p_value'),
+                      Index('ix_r_association_triangles_chemical_variant_p_value', 'project_id', 'chemical_variant_p_value'))
+
+
+def add_missing_columns(engine):
+    """
+    create_all only creates missing tables, add any columns that were added to existing tables since they were created.
+    """
+    inspector = inspect(engine)
+    existing_tables = inspector.get_table_names()
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                default = f' DEFAULT {column.server_default.arg}' if column.server_default is not None else ''
+                not_null = ' NOT NULL' if not column.nullable and default else ''
+                connection.execute(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}{not_null}{default}')
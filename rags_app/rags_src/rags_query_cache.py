@@ -0,0 +1,51 @@
+from collections import OrderedDict
+import threading
+
+
+class RagsQueryCache(object):
+    """
+    A bounded, least recently used cache of project query results.
+
+    Keys start with the project id and include the project's build generation, which goes up whenever
+    a build, annotation or delete changes the graph, so results from before the change are never served.
+    Those stale entries are never looked up again and fall off the end as new results are cached.
+    """
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: tuple):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: tuple, value):
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate_project(self, project_id: int):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == project_id]:
+                del self.entries[key]
+
+    def get_stats(self):
+        with self.lock:
+            return {'entries': len(self.entries),
+                    'max_entries': self.max_entries,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
@@ -1,14 +1,16 @@
 
-from rags_src.rags_core import RAGsNode
 from rags_src.rags_graph_db import RagsGraphDB
+from rags_src.rags_graph_queries import PROJECT_ASSOCIATION_COUNTS_QUERY, DEFAULT_ASSOCIATION_PREDICATE
 from rags_src.rags_project_db_models import RAGsStudy
-from typing import NamedTuple
+from typing import List, NamedTuple
 
 
-class GWASValidationInfo(NamedTuple):
+class StudyValidationInfo(NamedTuple):
+    study_id: int
     success: bool
     message: str
-    details: str = None
+    expected_associations: int
+    found_associations: int
 
 
 class RagsValidator(object):
@@ -16,23 +18,43 @@ class RagsValidator(object):
     def __init__(self, graph_db: RagsGraphDB):
         self.graph_db = graph_db
 
+    def get_association_counts(self, project_id: int, studies: List[RAGsStudy]):
+        """
+        Count the association edges for every study in one query.
+        :return: a dictionary of (namespace, predicate) -> number of associated nodes
+        """
+        study_traits = [{'namespace': study.study_name,
+                         'trait_id': study.normalized_trait_id if study.normalized_trait_id else study.original_trait_id}
+                        for study in studies]
+        association_counts = self.graph_db.run_named_query(PROJECT_ASSOCIATION_COUNTS_QUERY,
+                                                           {'project_id': int(project_id), 'study_traits': study_traits})
+        return {(record['namespace'], record['predicate']): record['association_count']
+                for record in association_counts}
+
     def validate_associations(self,
-                              project_id: str,
-                              study: RAGsStudy,
-                              num_expected_associations: int):
-
-        associated_node = RAGsNode(study.normalized_trait_id,
-                                   name=study.normalized_trait_label,
-                                   type=study.trait_type)
-
-        custom_query = f"match ({{id: '{associated_node.id}' }})-[:correlated_with {{project_id: '{project_id}', namespace: '{study.study_name}'}}]-(s) return count(distinct s)"
-        var_list = self.graph_db.custom_read_query(custom_query)
-        if var_list:
-            association_count = int(var_list[0][0])
-            if association_count == num_expected_associations:
-                return {"success": True, "success_message": f"{num_total_hits} associations found in graph.", "num_associations": association_count}
+                              project_id: int,
+                              studies: List[RAGsStudy],
+                              predicate: str = DEFAULT_ASSOCIATION_PREDICATE) -> List[StudyValidationInfo]:
+        """
+        Compare the associations in the graph with the number the builder wrote for each study.
+        """
+        association_counts = self.get_association_counts(project_id, studies)
+        validation_results = []
+        for study in studies:
+            expected_count = study.num_associations if study.num_associations else 0
+            found_count = association_counts.get((study.study_name, predicate), 0)
+            if found_count == expected_count:
+                validation_results.append(StudyValidationInfo(study.id, True,
+                                                              f'{found_count} associations found in graph.',
+                                                              expected_count, found_count))
+            elif found_count < expected_count:
+                validation_results.append(StudyValidationInfo(study.id, False,
+                                                              f'Failed. Missing {expected_count - found_count} '
+                                                              f'associations of {expected_count}!',
+                                                              expected_count, found_count))
             else:
-                missing_associations = num_expected_associations - association_count
-                return {"success": False, "error_message": f'Failed. Missing {missing_associations} associations of {num_total_hits}!'}
-        else:
-            return {"success": False, "error_message": f'Failed. No associations found.'}
+                validation_results.append(StudyValidationInfo(study.id, False,
+                                                              f'Failed. Found {found_count} associations but '
+                                                              f'expected {expected_count}!',
+                                                              expected_count, found_count))
+        return validation_results
@@ -0,0 +1,166 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import json
+import os
+import random
+import threading
+import time
+
+FIXTURES_PATH = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    'sample_data',
+    'normalization_fixtures.json'
+    )
+
+NODE_NORMALIZATION_PATH = '/get_normalized_nodes'
+EDGE_NORMALIZATION_PATH = '/resolve_predicate'
+
+
+class MockNormalizationService(object):
+    """
+    A local stand-in for the node and edge normalization services.
+
+    Responses use the same shapes as get_normalized_nodes and resolve_predicate and come from fixture data.
+    Curies with the synthetic prefix are normalized to themselves so large benchmarks don't need large fixtures.
+
+    Latency, error rates and 404 behaviour are configurable so performance work can be compared run to run:
+
+    with MockNormalizationService(latency=0.05, error_rate=0.01) as mock_service:
+        os.environ["NODE_NORMALIZATION_ENDPOINT"] = mock_service.node_normalization_url
+        ...
+    """
+    def __init__(self,
+                 fixtures_path: str = FIXTURES_PATH,
+                 latency: float = 0.0,
+                 latency_jitter: float = 0.0,
+                 error_rate: float = 0.0,
+                 not_found_status: int = 404,
+                 synthetic_prefix: str = 'SYNTHETIC',
+                 synthetic_type: str = 'biolink:ChemicalSubstance',
+                 port: int = 0):
+        with open(fixtures_path) as fixtures_file:
+            fixtures = json.load(fixtures_file)
+        self.nodes = fixtures["nodes"]
+        self.predicates = fixtures["predicates"]
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        # the status code returned when none of the requested curies are found (404 like the real service, or 200)
+        self.not_found_status = not_found_status
+        self.synthetic_prefix = synthetic_prefix
+        self.synthetic_type = synthetic_type
+
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.error_count = 0
+        self.curies_requested = 0
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self.create_request_handler())
+        self.server.daemon_threads = True
+        self.server_thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address
+        return f'http://{host}:{port}'
+
+    @property
+    def node_normalization_url(self):
+        return f'{self.base_url}{NODE_NORMALIZATION_PATH}'
+
+    @property
+    def edge_normalization_url(self):
+        return f'{self.base_url}{EDGE_NORMALIZATION_PATH}'
+
+    def start(self):
+        self.server_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def reset_counters(self):
+        with self.lock:
+            self.request_count = 0
+            self.error_count = 0
+            self.curies_requested = 0
+
+    def get_node_normalization(self, curie: str):
+        if curie in self.nodes:
+            return self.nodes[curie]
+        if curie.startswith(f'{self.synthetic_prefix}:'):
+            return {"id": {"identifier": curie, "label": f'Synthetic {curie.split(":", 1)[1]}'},
+                    "equivalent_identifiers": [{"identifier": curie}],
+                    "type": [self.synthetic_type, "biolink:NamedThing"]}
+        return None
+
+    def simulate_request(self, num_curies: int):
+        """
+        Count the request, wait for the configured latency and decide whether this request fails.
+        :return: True if the request should return an error
+        """
+        with self.lock:
+            self.request_count += 1
+            self.curies_requested += num_curies
+            failed = random.random() < self.error_rate
+            if failed:
+                self.error_count += 1
+        delay = self.latency + random.uniform(0, self.latency_jitter)
+        if delay > 0:
+            time.sleep(delay)
+        return failed
+
+    def create_request_handler(self):
+        mock_service = self
+
+        class MockNormalizationRequestHandler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                if urlparse(self.path).path != NODE_NORMALIZATION_PATH:
+                    self.send_json(404, {"detail": "Not Found"})
+                    return
+                content_length = int(self.headers.get('Content-Length', 0))
+                curies = json.loads(self.rfile.read(content_length))["curies"]
+                self.send_normalizations(curies, mock_service.get_node_normalization)
+
+            def do_GET(self):
+                parsed_url = urlparse(self.path)
+                query = parse_qs(parsed_url.query)
+                if parsed_url.path == NODE_NORMALIZATION_PATH:
+                    self.send_normalizations(query.get('curie', []), mock_service.get_node_normalization)
+                elif parsed_url.path == EDGE_NORMALIZATION_PATH:
+                    self.send_normalizations(query.get('predicate', []), mock_service.predicates.get)
+                else:
+                    self.send_json(404, {"detail": "Not Found"})
+
+            def send_normalizations(self, keys: list, lookup):
+                if mock_service.simulate_request(len(keys)):
+                    self.send_json(500, {"detail": "Simulated normalization service error"})
+                    return
+                response = {key: lookup(key) for key in keys}
+                if mock_service.not_found_status == 404 and not any(response.values()):
+                    self.send_json(404, {"detail": "None of the provided identifiers were found"})
+                else:
+                    self.send_json(200, response)
+
+            def send_json(self, status_code: int, response: dict):
+                body = json.dumps(response).encode('utf-8')
+                self.send_response(status_code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # keep test and benchmark output quiet
+                pass
+
+        return MockNormalizationRequestHandler
@@ -0,0 +1,51 @@
+from rags_src.rags_annotation_store import RagsAnnotationStore
+
+from robokop_genetics.simple_graph_components import SimpleEdge, SimpleNode
+
+
+def test_annotation_store(tmp_path):
+    store_path = str(tmp_path / 'annotation_store.db')
+    store = RagsAnnotationStore(store_path, annotation_version='testing 1')
+
+    edge = SimpleEdge(source_id='CAID:CA1',
+                      target_id='HGNC:1100',
+                      provided_by='testing',
+                      input_id='CAID:CA1',
+                      predicate_id='GAMMA:0000102',
+                      predicate_label='nearby_variant_of',
+                      ctime=1,
+                      properties={'distance': 10})
+    gene = SimpleNode(id='HGNC:1100', type='biolink:Gene', name='BRCA1')
+    # variant 2 has no genes, that's stored too
+    store.set_results({'CAID:CA1': [(edge, gene)], 'CAID:CA2': []})
+    stored_results = store.get_results(['CAID:CA1', 'CAID:CA2', 'CAID:CA3'])
+    assert stored_results['CAID:CA2'] == []
+    assert 'CAID:CA3' not in stored_results
+    stored_edge, stored_gene = stored_results['CAID:CA1'][0]
+    assert stored_edge == edge
+    assert stored_gene.id == 'HGNC:1100'
+    stats = store.get_stats()
+    assert (stats['annotations'], stats['hits'], stats['misses'], stats['expired']) == (2, 2, 1, 0)
+
+    # the store persists on disk, but only for the same annotation version
+    store.close()
+    store = RagsAnnotationStore(store_path, annotation_version='testing 1')
+    assert len(store.get_results(['CAID:CA1', 'CAID:CA2'])) == 2
+    store.close()
+    store = RagsAnnotationStore(store_path, annotation_version='testing 2')
+    assert not store.get_results(['CAID:CA1'])
+    assert store.purge() == 2
+    store.close()
+
+    # expired annotations are looked up again
+    store = RagsAnnotationStore(store_path, annotation_version='testing 1', max_age_seconds=0)
+    store.set_results({'CAID:CA1': [(edge, gene)]})
+    assert not store.get_results(['CAID:CA1'])
+    assert store.get_stats()['expired'] == 1
+    store.close()
+
+    # variants are looked up in batches
+    store = RagsAnnotationStore(store_path, annotation_version='testing 3')
+    store.set_results({f'CAID:CA{i}': [] for i in range(1200)})
+    assert len(store.get_results([f'CAID:CA{i}' for i in range(1300)])) == 1200
+    assert store.get_stats()['misses'] == 100
@@ -1,5 +1,9 @@
+import json
+
 from fastapi.testclient import TestClient
-from main import app
+from neo4j.exceptions import TransientError
+
+from main import app, end_export_on_error, get_gene_bridged_paths, parse_path_key, format_path_key
 
 client = TestClient(app)
 
@@ -8,3 +12,58 @@ def test_landing_page():
     response = client.get("/")
     assert response.status_code == 200
 
+
+
+def test_graph_db_stats():
+    response = client.get("/graph_db_stats/")
+    assert response.status_code == 200
+    assert "max_connection_pool_size" in response.json()
+
+
+def test_graph_query_stats():
+    response = client.get("/graph_query_stats/")
+    assert response.status_code == 200
+
+
+def test_export_error():
+    def failing_rows():
+        yield 'variant_id,p_value\n'
+        raise TransientError('The transaction has been terminated.')
+
+    csv_rows = list(end_export_on_error(failing_rows(), 'csv', 'testing'))
+    assert csv_rows[0] == 'variant_id,p_value\n'
+    assert csv_rows[1].startswith('# Export incomplete')
+    jsonl_rows = list(end_export_on_error(failing_rows(), 'jsonl', 'testing'))
+    assert 'Export incomplete' in json.loads(jsonl_rows[1])['error']
+
+
+class PathProjectDB:
+    # paths 1-1, 1-2, 2-1 ... with variant n and chemical n, in pages of 2
+    def __init__(self, path_count: int):
+        self.paths = [(f'TEST:variant_{i}', 1e-8, 'TEST:disease', 1e-7, f'TEST:chemical_{i}', i // 2, i % 2)
+                      for i in range(path_count)]
+
+    def iterate_phenotype_paths(self, project_id: int, p_value_cutoff: float, after_path_key: tuple = None):
+        paths = [path for path in self.paths if not after_path_key or path[-2:] > after_path_key]
+        for i in range(0, len(paths), 2):
+            yield paths[i:i + 2]
+
+
+class BridgeGraphDB:
+    # every pair has two genes
+    def run_named_query(self, query_name: str, parameters: dict):
+        return [{"variant_id": variant_id, "chemical_id": chemical_id, "chemical_gene_relationship": "affects",
+                 "gene_id": gene_id, "gene_variant_relationship": "nearby"}
+                for (variant_id, chemical_id) in parameters["pairs"] for gene_id in ("TEST:gene_1", "TEST:gene_2")]
+
+
+def test_gene_bridged_paths():
+    project_db = PathProjectDB(5)
+    results, next_path_key = get_gene_bridged_paths(BridgeGraphDB(), project_db, 1, None, 3)
+    # the page finishes the path it's on
+    assert [result[0] for result in results] == ['TEST:variant_0'] * 2 + ['TEST:variant_1'] * 2
+    assert next_path_key == (0, 1)
+    results, next_path_key = get_gene_bridged_paths(BridgeGraphDB(), project_db, 1, parse_path_key(format_path_key(next_path_key)), 6)
+    assert [result[0] for result in results][::2] == ['TEST:variant_2', 'TEST:variant_3', 'TEST:variant_4']
+    assert next_path_key is None
+    assert parse_path_key('not a key') is None
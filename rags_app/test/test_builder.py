@@ -1,9 +1,24 @@
+import csv
 import pytest
 
-from rags_src.rags_graph_db import RagsGraphDB
+from neo4j import READ_ACCESS, WRITE_ACCESS
+from neo4j.exceptions import TransientError
+
+from rags_src.rags_graph_db import RagsGraphDB, RagsGraphDBConnectionError, RagsGraphDeleteProgress, \
+    RagsGraphQueryCancelled, RagsGraphSchemaError, get_query_tag_metadata, get_shared_driver_stats
 from rags_src.rags_core import RAGsNode, RAGsEdge
-from rags_src.rags_graph_writer import BufferedWriter
-from rags_src.rags_core import SEQUENCE_VARIANT, ROOT_ENTITY, TESTING_NODE
+from rags_src.rags_graph_writer import BufferedWriter, AdaptiveBatchSize, write_batch_of_nodes, write_batch_of_edges, \
+    sync_batch_of_edges, get_edge_sync_hash, OBJECT_PARTITION_KEY
+from rags_src.rags_edge_dedup import EXACT_EDGE_DEDUP, BLOOM_EDGE_DEDUP
+from rags_src.rags_import_writer import ImportFileWriter, get_file_name_part
+from rags_src.rags_project_db_models import RAGsStudy, GWASHit
+from rags_src.rags_graph_builder import RAGsGraphBuilder, RagsVariantNormalizationProgress
+from rags_src.rags_validation import RagsValidator
+from rags_src.rags_graph_queries import get_graph_query_text, PROJECT_VARIANTS_QUERY, PROJECT_VARIANT_ASSOCIATIONS_QUERY, \
+    QUERY_TAG_METADATA_KEY, VARIANTS_FOR_ANNOTATION_QUERY, DEFAULT_ASSOCIATION_PREDICATE
+from rags_src.rags_graph_schema import RagsGraphIndex, get_required_indexes, get_index_states, parse_index_records, \
+    INDEX_ONLINE, INDEX_POPULATING, INDEX_MISSING, INDEX_UNSUPPORTED, INDEX_NOT_UNIQUE
+from rags_src.rags_core import SEQUENCE_VARIANT, ROOT_ENTITY, TESTING_NODE, RAGS_ANNOTATED_PROPERTY
 
 
 @pytest.fixture()
@@ -87,6 +102,761 @@ def test_edge_writer(graph_db):
     graph_db.custom_write_query(f'match (a:`{TESTING_NODE}`) detach delete a')
 
 
+@pytest.mark.parametrize('edge_dedup', [EXACT_EDGE_DEDUP, BLOOM_EDGE_DEDUP])
+def test_edge_writer_dedup(edge_dedup):
+    writer = BufferedWriter(None, edge_dedup=edge_dedup, expected_edges=1000)
+    for repeat in range(2):
+        for i in range(1, 11):
+            test_edge = RAGsEdge(id=None,
+                                 subject_id=f'TESTING:{i}',
+                                 object_id='TESTING:0',
+                                 original_object_id='TESTING:0_input',
+                                 predicate='TESTING:test_predicate',
+                                 relation='TESTING:test_relation',
+                                 provided_by='RAGS_Testing',
+                                 namespace='fake_namespace',
+                                 project_id=99999,
+                                 properties={'repeat': repeat})
+            # only the first of each is written
+            assert writer.write_edge(test_edge) == (repeat == 0)
+
+    assert len(writer.edge_queues['TESTING:test_predicate']) == 10
+    assert len(writer.written_edges) == 10
+
+    # the same variant to gene relationship from two services keeps both sources
+    for provided_by in ['MyVariant.variant_to_gene', 'Ensembl.variant_to_gene', 'MyVariant.variant_to_gene']:
+        writer.write_edge(RAGsEdge(id=None,
+                                   subject_id='TESTING:1',
+                                   object_id='TESTING:gene',
+                                   original_object_id='TESTING:gene',
+                                   predicate='TESTING:gene_predicate',
+                                   relation='TESTING:gene_relation',
+                                   provided_by=provided_by))
+    assert [edge.provided_by for edge in writer.edge_queues['TESTING:gene_predicate']] == \
+        ['MyVariant.variant_to_gene', 'Ensembl.variant_to_gene']
+
+
+class RecordingSession:
+    def __init__(self, transactions: list):
+        self.transactions = transactions
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def write_transaction(self, write_function, batch, batch_key):
+        self.transactions.append((write_function.__name__, batch_key, len(batch)))
+
+
+class RecordingGraphDB:
+    def __init__(self):
+        self.transactions = []
+
+    def get_session(self):
+        return RecordingSession(self.transactions)
+
+
+def test_writer_flushes_only_full_queues():
+    graph_db = RecordingGraphDB()
+    with BufferedWriter(graph_db) as writer:
+        writer.node_batch_sizes[frozenset([TESTING_NODE])].size = 10
+        for i in range(10):
+            writer.write_node(RAGsNode(f'TESTING:{i}', TESTING_NODE, all_types=frozenset([TESTING_NODE])))
+            writer.write_node(RAGsNode(f'TESTING:other_{i // 5}', TESTING_NODE, all_types=frozenset([ROOT_ENTITY])))
+        # only the full queue was written, the other one is still waiting
+        assert graph_db.transactions == [('write_batch_of_nodes', frozenset([TESTING_NODE]), 10)]
+        assert len(writer.node_queues[frozenset([ROOT_ENTITY])]) == 2
+
+    # the rest is drained on exit
+    assert graph_db.transactions[1] == ('write_batch_of_nodes', frozenset([ROOT_ENTITY]), 2)
+    assert not writer.node_queues
+
+
+def test_mixed_node_queues_share_a_transaction():
+    graph_db = RecordingGraphDB()
+    with BufferedWriter(graph_db) as writer:
+        for i in range(3):
+            writer.write_node(RAGsNode(f'TESTING:{i}', TESTING_NODE, all_types=frozenset([TESTING_NODE])))
+            writer.write_node(RAGsNode(f'TESTING:other_{i}', TESTING_NODE, all_types=frozenset([ROOT_ENTITY])))
+    assert graph_db.transactions == [('write_batch_of_nodes', None, 6)]
+
+
+class RecordingTransaction:
+    def __init__(self):
+        self.statements = []
+
+    def run(self, cypher, parameters):
+        self.statements.append((cypher, parameters))
+
+
+def test_compact_batch_payloads():
+    tx = RecordingTransaction()
+    nodes = [RAGsNode(f'TESTING:{i}', TESTING_NODE, name=f'Fake Name {i}', all_types=frozenset([TESTING_NODE]),
+                      synonyms={f'ALT_FAKE_CURIE:{i}'}) for i in range(3)]
+    nodes.append(RAGsNode('TESTING:other', TESTING_NODE, all_types=frozenset([ROOT_ENTITY])))
+    write_batch_of_nodes(tx, nodes, None)
+    # a statement per label set, the node objects aren't changed
+    assert len(tx.statements) == 2
+    assert tx.statements[0][1]['category'] == [TESTING_NODE]
+    assert tx.statements[0][1]['batch'][0]['equivalent_identifiers'] == ['ALT_FAKE_CURIE:0']
+    assert not nodes[0].properties
+
+    tx = RecordingTransaction()
+    edges = [RAGsEdge(id=None,
+                      subject_id=f'TESTING:{i}',
+                      object_id='TESTING:0',
+                      original_object_id='TESTING:0_input',
+                      predicate='TESTING:test_predicate',
+                      relation='TESTING:test_relation',
+                      provided_by='RAGS_Testing.test',
+                      namespace='fake_namespace',
+                      project_id=99999,
+                      project_name='Fake Project') for i in range(1, 11)]
+    write_batch_of_edges(tx, edges, 'TESTING:test_predicate')
+    # the values shared by every edge are sent once
+    assert len(tx.statements) == 1
+    parameters = tx.statements[0][1]
+    assert parameters['project_id'] == 99999
+    assert parameters['source_database'] == ['RAGS_Testing']
+    assert set(parameters['edge_batch'][0].keys()) == {'subject_id', 'object_id', 'input_id', 'properties'}
+    # project association targets that are variants get an annotation state if they don't have one
+    assert f'coalesce(variant.{RAGS_ANNOTATED_PROPERTY}, false)' in tx.statements[0][0]
+
+    tx = RecordingTransaction()
+    for edge in edges:
+        edge.project_id = None
+    write_batch_of_edges(tx, edges, 'TESTING:test_predicate')
+    assert RAGS_ANNOTATED_PROPERTY not in tx.statements[0][0]
+
+
+def get_sync_test_edge(subject_id: str, p_value: float, ctime: int = 1):
+    return RAGsEdge(id=None,
+                    subject_id=subject_id,
+                    object_id='TESTING:0',
+                    original_object_id='TESTING:0_input',
+                    predicate='TESTING:test_predicate',
+                    relation='TESTING:test_relation',
+                    provided_by='RAGS_Testing',
+                    namespace='fake_namespace',
+                    project_id=99999,
+                    properties={'p_value': p_value, 'ctime': ctime})
+
+
+class SyncTransaction:
+    def __init__(self, graph_edges: list):
+        self.graph_edges = graph_edges
+
+    def run(self, cypher, parameters):
+        return iter([{'edge_id': edge_id, 'subject_id': subject_id, 'object_id': object_id}
+                     for (edge_id, subject_id, object_id) in self.graph_edges])
+
+
+class SyncSession(RecordingSession):
+    def __init__(self, transactions: list, graph_edges: list):
+        super().__init__(transactions)
+        self.graph_edges = graph_edges
+
+    def read_transaction(self, read_function, *args):
+        return read_function(SyncTransaction(self.graph_edges), *args)
+
+    def write_transaction(self, write_function, batch, *args):
+        self.transactions.append((write_function.__name__, batch))
+
+
+class SyncGraphDB(RecordingGraphDB):
+    def __init__(self, graph_edges: list):
+        super().__init__()
+        self.graph_edges = graph_edges
+
+    def get_session(self):
+        return SyncSession(self.transactions, self.graph_edges)
+
+
+def test_edge_sync():
+    # unchanged content hashes the same regardless of the build time
+    assert get_edge_sync_hash(get_sync_test_edge('TESTING:1', 0.01, ctime=1)) == \
+        get_edge_sync_hash(get_sync_test_edge('TESTING:1', 0.01, ctime=2))
+    assert get_edge_sync_hash(get_sync_test_edge('TESTING:1', 0.01)) != \
+        get_edge_sync_hash(get_sync_test_edge('TESTING:1', 0.02))
+
+    tx = RecordingTransaction()
+    sync_batch_of_edges(tx, [get_sync_test_edge('TESTING:1', 0.01)], 'TESTING:test_predicate')
+    assert 'MERGE' in tx.statements[0][0]
+    assert 'sync_hash' in tx.statements[0][1]['edge_batch'][0]
+
+    # a full rewrite only deletes the edges that weren't written again
+    # and duplicates of a current edge written before edges were synced
+    graph_db = SyncGraphDB(graph_edges=[(1, 'TESTING:1', 'TESTING:0'),
+                                        (2, 'TESTING:2', 'TESTING:0'),
+                                        (3, 'TESTING:1', 'TESTING:0')])
+    writer = BufferedWriter(graph_db, edge_sync=True)
+    writer.start_edge_sync('TESTING:test_predicate', 99999, 'fake_namespace')
+    writer.write_edge(get_sync_test_edge('TESTING:1', 0.01))
+    assert writer.finish_edge_sync('TESTING:test_predicate', 99999, 'fake_namespace') == 2
+    assert graph_db.transactions[0][0] == 'sync_batch_of_edges'
+    assert graph_db.transactions[-1] == ('delete_edges_by_id', [2, 3])
+
+
+class FailingGraphDB(RecordingGraphDB):
+    def get_session(self):
+        raise RagsGraphDBConnectionError('Testing background write errors.')
+
+
+def test_background_writer():
+    graph_db = RecordingGraphDB()
+    with BufferedWriter(graph_db, background_writers=2, max_pending_batches=2) as writer:
+        writer.node_batch_sizes[frozenset([TESTING_NODE])].size = 5
+        for i in range(20):
+            writer.write_node(RAGsNode(f'TESTING:{i}', TESTING_NODE, all_types=frozenset([TESTING_NODE])))
+        writer.write_edge(RAGsEdge(id=None,
+                                   subject_id='TESTING:0',
+                                   object_id='TESTING:1',
+                                   original_object_id='TESTING:1',
+                                   predicate='TESTING:test_predicate',
+                                   relation='TESTING:test_relation',
+                                   provided_by='RAGS_Testing',
+                                   namespace='fake_namespace',
+                                   project_id=99999))
+        writer.flush()
+        # every node batch was committed before the edges that depend on them
+        assert sum([batch_length for (write_function, batch_key, batch_length) in graph_db.transactions[:-1]]) == 20
+        assert graph_db.transactions[-1] == ('write_batch_of_edges', 'TESTING:test_predicate', 1)
+    assert not writer.writer_threads
+
+    # errors in a writer thread are raised on the caller's thread, by every write and flush until the writer is closed
+    writer = BufferedWriter(FailingGraphDB(), background_writers=1)
+    writer.write_node(RAGsNode('TESTING:0', TESTING_NODE, all_types=frozenset([TESTING_NODE])))
+    with pytest.raises(RagsGraphDBConnectionError):
+        writer.flush()
+    with pytest.raises(RagsGraphDBConnectionError):
+        writer.flush()
+    writer.write_node(RAGsNode('TESTING:1', TESTING_NODE, all_types=frozenset([TESTING_NODE])))
+    with pytest.raises(RagsGraphDBConnectionError):
+        writer.flush()
+    writer.close()
+    assert not writer.writer_threads and writer.background_error is None
+
+    # closing stops writer threads that are still waiting for work
+    writer = BufferedWriter(RecordingGraphDB(), background_writers=2)
+    writer.writer_idle_timeout = 60
+    writer.write_node(RAGsNode('TESTING:0', TESTING_NODE, all_types=frozenset([TESTING_NODE])))
+    writer.flush()
+    assert writer.writer_threads
+    writer.close()
+    assert not writer.writer_threads and writer.pending_batches.empty()
+
+
+class DeadlockSession(RecordingSession):
+    def __init__(self, graph_db):
+        super().__init__(graph_db.transactions)
+        self.graph_db = graph_db
+
+    def write_transaction(self, write_function, batch, batch_key):
+        if self.graph_db.deadlocks < 2:
+            self.graph_db.deadlocks += 1
+            raise TransientError('Testing deadlock retries.')
+        super().write_transaction(write_function, batch, batch_key)
+
+
+class DeadlockGraphDB(RecordingGraphDB):
+    def __init__(self):
+        super().__init__()
+        # the first two writes deadlock
+        self.deadlocks = 0
+
+    def get_session(self):
+        return DeadlockSession(self)
+
+
+def test_partitioned_writer():
+    graph_db = RecordingGraphDB()
+    with BufferedWriter(graph_db, write_partitions=4) as writer:
+        for i in range(100):
+            writer.write_node(RAGsNode(f'TESTING:{i}', TESTING_NODE, all_types=frozenset([TESTING_NODE])))
+    # one transaction per partition, every node written exactly once
+    assert len(graph_db.transactions) == len(writer.partition_stats) <= 4
+    assert sum([stats.items for stats in writer.partition_stats.values()]) == 100
+
+    # a repeated id always lands in the same partition
+    assert writer.get_partition(RAGsNode('TESTING:1', TESTING_NODE)) == writer.get_partition(RAGsNode('TESTING:1', TESTING_NODE))
+
+    # associations share their subject, partitioned by object they are spread across the partitions
+    writer = BufferedWriter(RecordingGraphDB(), write_partitions=4, edge_partition_key=OBJECT_PARTITION_KEY)
+    associations = [get_sync_test_edge('TESTING:trait', 0.01) for i in range(20)]
+    for i, association in enumerate(associations):
+        association.object_id = f'TESTING:{i}'
+    assert len(set(writer.get_partition(association) for association in associations)) > 1
+
+    # deadlocks are retried
+    graph_db = DeadlockGraphDB()
+    with BufferedWriter(graph_db, write_partitions=2) as writer:
+        writer.retry_delay = 0.01
+        writer.write_node(RAGsNode('TESTING:0', TESTING_NODE, all_types=frozenset([TESTING_NODE])))
+    assert len(graph_db.transactions) == 1
+    assert sum([stats.retries for stats in writer.partition_stats.values()]) == 2
+
+
+def test_adaptive_batch_size():
+    batch_size = AdaptiveBatchSize(initial_size=10000, min_size=100, max_size=50000, target_seconds=1.0)
+    # slow transactions shrink the batch size
+    batch_size.record(10000, 1000000, 10.0)
+    assert batch_size.size < 10000
+    # large payloads are capped by bytes
+    batch_size = AdaptiveBatchSize(initial_size=10000, max_payload_bytes=1000000)
+    batch_size.record(10000, 10000000, 0.1)
+    assert batch_size.size < 10000
+    # fast small transactions grow it
+    batch_size = AdaptiveBatchSize(initial_size=10000)
+    batch_size.record(10000, 1000, 0.1)
+    assert batch_size.size > 10000
+
+
+def test_graph_schema_states():
+    # db.indexes() columns from Neo4j 3.5
+    index_records = [{'description': f'INDEX ON :`{ROOT_ENTITY}`(id)', 'tokenNames': [ROOT_ENTITY], 'properties': ['id'],
+                      'state': 'ONLINE', 'type': 'node_unique_property'},
+                     {'description': f'INDEX ON :`{SEQUENCE_VARIANT}`(id)', 'tokenNames': [SEQUENCE_VARIANT],
+                      'properties': ['id'], 'state': 'POPULATING', 'type': 'node_label_property'}]
+    required_indexes = get_required_indexes(relationship_types=['biolink:correlated_with'])
+    index_states = dict(get_index_states(required_indexes, parse_index_records(index_records), (3, 5)))
+    assert index_states[RagsGraphIndex(ROOT_ENTITY, 'id', unique=True)] == INDEX_ONLINE
+    assert index_states[RagsGraphIndex(SEQUENCE_VARIANT, 'id')] == INDEX_POPULATING
+    # relationship property indexes need Neo4j 4.3
+    assert index_states[RagsGraphIndex('biolink:correlated_with', 'project_id', relationship=True)] == INDEX_UNSUPPORTED
+    index_states = dict(get_index_states(required_indexes, parse_index_records(index_records), (4, 3)))
+    assert index_states[RagsGraphIndex('biolink:correlated_with', 'project_id', relationship=True)] == INDEX_MISSING
+
+    # an index without the uniqueness constraint still serves lookups
+    index_records[0]['type'] = 'node_label_property'
+    index_states = dict(get_index_states(required_indexes, parse_index_records(index_records), (3, 5)))
+    assert index_states[RagsGraphIndex(ROOT_ENTITY, 'id', unique=True)] == INDEX_NOT_UNIQUE
+
+    assert RagsGraphIndex(ROOT_ENTITY, 'id').get_create_query((3, 5)) == f'CREATE INDEX ON :`{ROOT_ENTITY}`(id)'
+    assert RagsGraphIndex(ROOT_ENTITY, 'id', unique=True).get_create_query((3, 5)) == \
+        f'CREATE CONSTRAINT ON (n:`{ROOT_ENTITY}`) ASSERT n.id IS UNIQUE'
+    # IF NOT EXISTS came in 4.1
+    assert 'IF NOT EXISTS' not in RagsGraphIndex(SEQUENCE_VARIANT, 'id').get_create_query((4, 0))
+    assert 'IF NOT EXISTS' in RagsGraphIndex(SEQUENCE_VARIANT, 'id').get_create_query((4, 1))
+
+
+def test_graph_schema(graph_db):
+    schema_report = graph_db.ensure_schema()
+    for (index, state) in schema_report:
+        assert state in (INDEX_ONLINE, INDEX_UNSUPPORTED)
+    assert not graph_db.get_missing_indexes()
+
+
+class ScriptedResult(list):
+    def single(self):
+        return self[0]
+
+    def consume(self):
+        return QuerySummary()
+
+
+class QuerySummary:
+    result_available_after = 2
+    result_consumed_after = 1
+
+
+class ScriptedSession:
+    def __init__(self, driver):
+        self.driver = driver
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def read_transaction(self, transaction_function, *args):
+        return self.run_transaction(transaction_function, *args)
+
+    def write_transaction(self, transaction_function, *args):
+        return self.run_transaction(transaction_function, *args)
+
+    def run_transaction(self, transaction_function, *args):
+        # unit_of_work puts the transaction timeout and metadata on the function
+        self.driver.transaction_configs.append((getattr(transaction_function, 'timeout', None),
+                                                getattr(transaction_function, 'metadata', None)))
+        if self.driver.error:
+            raise self.driver.error
+        return transaction_function(self, *args)
+
+    def run(self, query, parameters=None):
+        parameters = dict(parameters) if parameters else {}
+        self.driver.queries.append((query, parameters))
+        return ScriptedResult(self.driver.respond(query, parameters))
+
+    def begin_transaction(self, metadata=None, timeout=None):
+        self.driver.transaction_configs.append((timeout, metadata))
+        if self.driver.error:
+            raise self.driver.error
+        return ScriptedTransaction(self)
+
+
+class ScriptedTransaction:
+    def __init__(self, session):
+        self.session = session
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def run(self, query, parameters=None):
+        return self.session.run(query, parameters)
+
+
+class ScriptedDriver:
+    """
+    A stand in for the Neo4j driver, every query is recorded and answered with respond(query, parameters) -> rows.
+    Transactions raise error, if there is one.
+    """
+    def __init__(self, respond=None, error: Exception = None):
+        self.respond = respond if respond else lambda query, parameters: []
+        self.error = error
+        self.queries = []
+        self.transaction_configs = []
+        self.access_modes = []
+
+    def session(self, default_access_mode=WRITE_ACCESS):
+        self.access_modes.append(default_access_mode)
+        return ScriptedSession(self)
+
+    def close(self):
+        pass
+
+
+def create_scripted_graph_db(respond=None, error: Exception = None, **graph_db_arguments):
+    return RagsGraphDB(driver=ScriptedDriver(respond, error), **graph_db_arguments)
+
+
+def respond_with_counts(count_name: str, counts: list):
+    return lambda query, parameters: [{count_name: counts.pop(0)}]
+
+
+def test_chunked_project_delete():
+    graph_db = create_scripted_graph_db(respond_with_counts('deleted_count', [3, 3, 1, 0, 2, 0]))
+    queries = graph_db.graph_db_driver.queries
+    progress = RagsGraphDeleteProgress(99999)
+    deleted_count = graph_db.delete_project(99999,
+                                            study_trait_ids={'fake_namespace': 'TESTING:trait'},
+                                            batch_size=3,
+                                            progress=progress)
+    # batches until the namespace is empty, then whatever is left for the project
+    assert deleted_count == progress.deleted_count == 9
+    assert progress.finished
+    assert len(queries) == 6
+    assert queries[0][1] == {'trait_id': 'TESTING:trait', 'project_id': 99999, 'namespace': 'fake_namespace', 'batch_size': 3}
+    assert queries[-1][1] == {'project_id': 99999, 'batch_size': 3}
+    # the project edges left over are only looked for among the association relationships
+    assert f'[r:`{DEFAULT_ASSOCIATION_PREDICATE}`' in queries[-1][0]
+
+
+def test_failed_project_delete():
+    deadlock_error = TransientError('Deadlock detected.')
+    deadlock_error.code = 'Neo.TransientError.Transaction.DeadlockDetected'
+    graph_db = create_scripted_graph_db(error=deadlock_error)
+    progress = RagsGraphDeleteProgress(99999)
+    with pytest.raises(TransientError):
+        graph_db.delete_project(99999, study_trait_ids={'fake_namespace': 'TESTING:trait'}, progress=progress)
+    # not finished, and says why, so the project can be deleted again
+    assert not progress.finished
+    assert 'DeadlockDetected' in progress.error_message
+
+
+def test_session_stats():
+    graph_db = create_scripted_graph_db()
+    sessions_open = get_shared_driver_stats()['sessions_open']
+    with graph_db.get_session():
+        with graph_db.get_session():
+            assert get_shared_driver_stats()['sessions_open'] == sessions_open + 2
+    driver_stats = get_shared_driver_stats()
+    assert driver_stats['sessions_open'] == sessions_open
+    assert driver_stats['max_sessions_open'] >= sessions_open + 2
+
+
+def test_backfill_annotation_state():
+    backfill_batches = [{'checked_count': 2, 'updated_count': 2, 'last_id': 'CAID:CA2'},
+                        {'checked_count': 2, 'updated_count': 0, 'last_id': 'CAID:CA4'},
+                        {'checked_count': 1, 'updated_count': 1, 'last_id': 'CAID:CA5'}]
+    graph_db = create_scripted_graph_db(lambda query, parameters: [backfill_batches.pop(0)])
+    assert graph_db.backfill_annotation_state(batch_size=2) == 3
+    # every variant is checked once, in id order
+    queries = graph_db.graph_db_driver.queries
+    assert [query[1] for query in queries] == [{'last_id': '', 'batch_size': 2},
+                                               {'last_id': 'CAID:CA2', 'batch_size': 2},
+                                               {'last_id': 'CAID:CA4', 'batch_size': 2}]
+    assert 'exists(' not in queries[0][0]
+    # only RAGs association targets, variants from the base graph are left alone
+    assert f'(v)<-[:`{DEFAULT_ASSOCIATION_PREDICATE}`]-()' in queries[0][0]
+
+    # the annotation query finds its variants with the annotation state index and only takes association targets
+    annotation_query = get_graph_query_text(VARIANTS_FOR_ANNOTATION_QUERY, 'TESTING:test_predicate')
+    assert f'v.{RAGS_ANNOTATED_PROPERTY} = false' in annotation_query
+    assert '(v)<-[:`TESTING:test_predicate`]-()' in annotation_query
+    assert RagsGraphIndex(SEQUENCE_VARIANT, RAGS_ANNOTATED_PROPERTY) in get_required_indexes()
+
+
+def test_named_queries():
+    graph_db = create_scripted_graph_db()
+    queries = graph_db.graph_db_driver.queries
+    for project_id in (1, 2):
+        graph_db.run_named_query(PROJECT_VARIANTS_QUERY, {'project_id': project_id, 'limit': 10})
+    graph_db.custom_read_query('MATCH (n) RETURN n', limit=5)
+
+    # values travel as parameters, the query text stays the same
+    assert queries[0][0] == queries[1][0] == get_graph_query_text(PROJECT_VARIANTS_QUERY)
+    assert '$project_id' in queries[0][0] and '$limit' in queries[0][0]
+    assert queries[1][1] == {'project_id': 2, 'limit': 10}
+    assert queries[2] == ('MATCH (n) RETURN n LIMIT $limit', {'limit': 5})
+
+    query_stats = graph_db.get_query_stats()[PROJECT_VARIANTS_QUERY]
+    assert query_stats['count'] >= 2
+    assert query_stats['distinct_query_texts'] == 1
+    assert query_stats['avg_available_after_ms'] == 2
+
+    with pytest.raises(ValueError):
+        get_graph_query_text('not_a_query')
+
+
+def test_cancelled_named_query():
+    terminated_error = TransientError('The transaction has been terminated.')
+    terminated_error.code = 'Neo.TransientError.Transaction.Terminated'
+    graph_db = create_scripted_graph_db(error=terminated_error,
+                                        query_timeout=10,
+                                        query_metadata=get_query_tag_metadata('test_tag'))
+    with pytest.raises(RagsGraphQueryCancelled):
+        graph_db.run_named_query(PROJECT_VARIANTS_QUERY, {'project_id': 1, 'skip': 0, 'limit': 10})
+    # the timeout and tag go to Neo4j with the transaction
+    assert graph_db.graph_db_driver.transaction_configs == [(10, {QUERY_TAG_METADATA_KEY: 'test_tag'})]
+
+
+def test_kill_tagged_queries():
+    graph_db = create_scripted_graph_db(respond_with_counts('killed_count', [2]),
+                                        query_timeout=10,
+                                        query_metadata=get_query_tag_metadata('test_tag'))
+    graph_db.cancel()
+    assert graph_db.kill_queries('test_tag') == 2
+    # the kill query isn't tagged itself, or it would be one of the queries it kills
+    assert graph_db.graph_db_driver.transaction_configs == [(None, None)]
+    assert graph_db.graph_db_driver.queries[0][1] == {'query_tag': 'test_tag'}
+
+    # once cancelled, nothing else runs
+    with pytest.raises(RagsGraphQueryCancelled):
+        graph_db.run_named_query(PROJECT_VARIANTS_QUERY, {'project_id': 1, 'skip': 0, 'limit': 10})
+    assert len(graph_db.graph_db_driver.queries) == 1
+
+
+# p values 0, 0, 0.1, 0.2, ... and a missing one, like the association export queries
+ASSOCIATION_ROWS = [{'p_value': 0.0, 'edge_id': 1}, {'p_value': 0.0, 'edge_id': 2}] + \
+                   [{'p_value': i / 10, 'edge_id': i + 10} for i in range(1, 6)] + [{'p_value': None, 'edge_id': 3}]
+
+
+def test_streaming_named_query():
+    graph_db = create_scripted_graph_db(lambda query, parameters: ASSOCIATION_ROWS,
+                                        query_timeout=600,
+                                        query_metadata=get_query_tag_metadata('test_tag'))
+    queries = graph_db.graph_db_driver.queries
+    records = graph_db.stream_named_query(PROJECT_VARIANT_ASSOCIATIONS_QUERY, {'project_id': 1})
+    assert list(records) == ASSOCIATION_ROWS
+    # a read transaction with the timeout and metadata, like any other query
+    assert graph_db.graph_db_driver.access_modes == [READ_ACCESS]
+    assert graph_db.graph_db_driver.transaction_configs == [(600, get_query_tag_metadata('test_tag'))]
+    # one query, sorted once, nothing that would leave out associations without a p value
+    assert len(queries) == 1
+    assert queries[0][1] == {'project_id': 1}
+    assert 'WHERE' not in queries[0][0] and queries[0][0].endswith('ORDER BY p_value, edge_id')
+
+
+class CountingGraphDB:
+    def __init__(self, association_counts: list):
+        self.association_counts = association_counts
+        self.queries = []
+
+    def run_named_query(self, query_name, parameters=None, predicate=None, write=False):
+        self.queries.append((query_name, parameters))
+        return self.association_counts
+
+
+def test_validate_associations():
+    studies = [RAGsStudy(id=i, study_name=f'study_{i}', original_trait_id=f'TESTING:{i}', num_associations=5)
+               for i in range(3)]
+    graph_db = CountingGraphDB([{'namespace': 'study_0', 'predicate': 'biolink:correlated_with', 'association_count': 5},
+                                {'namespace': 'study_1', 'predicate': 'biolink:correlated_with', 'association_count': 3},
+                                {'namespace': 'study_2', 'predicate': 'biolink:related_to', 'association_count': 5}])
+    validation_results = RagsValidator(graph_db).validate_associations('7', studies, 'biolink:correlated_with')
+    # one query for every study
+    assert len(graph_db.queries) == 1
+    assert graph_db.queries[0][1]['project_id'] == 7
+    assert graph_db.queries[0][1]['study_traits'][2] == {'namespace': 'study_2', 'trait_id': 'TESTING:2'}
+    assert [validation_info.success for validation_info in validation_results] == [True, False, False]
+    assert validation_results[1].found_associations == 3
+    assert validation_results[2].found_associations == 0
+
+
+def test_import_file_writer(tmp_path):
+    with ImportFileWriter(str(tmp_path)) as writer:
+        for i in range(3):
+            writer.write_node(RAGsNode(f'TESTING:{i}', TESTING_NODE, name=f'Fake Name {i}',
+                                       all_types=frozenset([TESTING_NODE]), synonyms={f'ALT_FAKE_CURIE:{i}'}))
+        writer.write_node(RAGsNode('TESTING:0', TESTING_NODE, all_types=frozenset([TESTING_NODE])))
+        for i in range(2):
+            writer.write_edge(get_sync_test_edge(f'TESTING:{i}', 0.01))
+
+    with open(tmp_path / f'nodes_{ROOT_ENTITY.replace(":", "_")}_rags_Testing.csv') as node_file:
+        node_rows = list(csv.reader(node_file))
+    assert node_rows[0] == ['id:ID', 'name', 'equivalent_identifiers:string[]', 'category:string[]', ':LABEL']
+    # duplicate nodes are left out
+    assert len(node_rows) == 4
+    assert node_rows[1] == ['TESTING:0', 'Fake Name 0', 'ALT_FAKE_CURIE:0', TESTING_NODE, f'{ROOT_ENTITY}|{TESTING_NODE}']
+
+    with open(tmp_path / 'edges_TESTING_test_predicate.csv') as edge_file:
+        edge_rows = list(csv.reader(edge_file))
+    assert edge_rows[0][-3:] == ['ctime:long', 'p_value:double', ':TYPE']
+    assert len(edge_rows) == 3
+    assert edge_rows[1][-1] == 'TESTING:test_predicate'
+
+    # writing after close appends to the same files
+    writer.write_edge(get_sync_test_edge('TESTING:2', 0.01))
+    writer.close()
+    with open(tmp_path / 'edges_TESTING_test_predicate.csv') as edge_file:
+        edge_rows = list(csv.reader(edge_file))
+    assert len(edge_rows) == 4 and edge_rows[0][-1] == ':TYPE'
+
+
+class StubRagsNormalizer:
+    def get_normalized_edges(self, predicates: list):
+        return {predicate: 'biolink:correlated_with' for predicate in predicates}
+
+    def get_normalized_nodes(self, node_ids: list):
+        return {}
+
+
+class StubGeneticsNormalizer:
+    """
+    Normalizes TEST:n to CAID:CAn, except TEST:2 and TEST:3 which are the same variant.
+    Chunks with a variant in failing_ids raise an error.
+    """
+    def __init__(self, failing_ids: set = frozenset()):
+        self.failing_ids = failing_ids
+        self.normalized_chunks = []
+
+    def get_sequence_variant_node_types(self):
+        return [ROOT_ENTITY, SEQUENCE_VARIANT]
+
+    def normalize_variants(self, variant_ids: list):
+        if self.failing_ids & set(variant_ids):
+            raise ConnectionError('normalization service unavailable')
+        self.normalized_chunks.append(list(variant_ids))
+        normalizations = {}
+        for variant_id in variant_ids:
+            normalized_id = 'CAID:CA2' if variant_id == 'TEST:3' else variant_id.replace('TEST:', 'CAID:CA')
+            normalizations[variant_id] = [{'id': normalized_id, 'name': variant_id, 'equivalent_identifiers': {variant_id}}]
+        return normalizations
+
+
+class NodeRecordingWriter:
+    def __init__(self):
+        self.nodes = []
+
+    def write_node(self, node: RAGsNode):
+        self.nodes.append(node)
+
+    def flush(self):
+        pass
+
+
+def create_variant_builder(genetics_normalizer: StubGeneticsNormalizer):
+    builder = RAGsGraphBuilder(1, 'Testing Project', '', None,
+                               rags_normalizer=StubRagsNormalizer(),
+                               variant_normalization_chunk_size=2,
+                               variant_normalization_workers=2,
+                               genetics_normalizer=genetics_normalizer)
+    builder.graph_schema_checked = True
+    builder.writer = NodeRecordingWriter()
+    return builder
+
+
+def test_chunked_variant_normalization():
+    genetics_normalizer = StubGeneticsNormalizer()
+    builder = create_variant_builder(genetics_normalizer)
+    # TEST:1 shows up twice, TEST:2 and TEST:3 normalize to the same variant in different chunks
+    gwas_hits = [GWASHit(original_id=f'TEST:{i}', original_name=f'rs{i}') for i in [1, 2, 1, 3, 4, 5]]
+    progress = RagsVariantNormalizationProgress()
+    results = builder.process_gwas_variants(gwas_hits, progress=progress)
+
+    assert results.success and not results.error_messages
+    assert sorted(genetics_normalizer.normalized_chunks) == [['TEST:1', 'TEST:2'], ['TEST:3', 'TEST:4'], ['TEST:5']]
+    assert sorted(node.id for node in builder.writer.nodes) == ['CAID:CA1', 'CAID:CA2', 'CAID:CA4', 'CAID:CA5']
+    assert progress == RagsVariantNormalizationProgress(variant_count=5, chunk_count=3, chunks_done=3,
+                                                        variants_normalized=5, failed_chunks=0)
+    assert all(hit.normalized for hit in gwas_hits)
+    assert gwas_hits[3].normalized_id == 'CAID:CA2'
+
+
+class MissingIndexGraphDB:
+    def get_missing_indexes(self, relationship_types: list = ()):
+        return [(RagsGraphIndex(SEQUENCE_VARIANT, 'id'), 'missing')]
+
+    def ensure_schema(self, relationship_types: list = (), timeout_seconds: int = 300):
+        raise AssertionError('Builds should not create indexes.')
+
+
+def test_build_schema_check(monkeypatch):
+    builder = create_variant_builder(StubGeneticsNormalizer())
+    builder.graph_db = MissingIndexGraphDB()
+    # only a warning by default, without waiting for indexes
+    monkeypatch.delenv('RAGS_REQUIRE_GRAPH_SCHEMA', raising=False)
+    builder.graph_schema_checked = False
+    builder.check_graph_schema()
+    assert builder.graph_schema_checked
+
+    monkeypatch.setenv('RAGS_REQUIRE_GRAPH_SCHEMA', 'true')
+    builder.graph_schema_checked = False
+    with pytest.raises(RagsGraphSchemaError):
+        builder.check_graph_schema()
+
+
+def test_failed_variant_normalization_chunk():
+    genetics_normalizer = StubGeneticsNormalizer(failing_ids={'TEST:3'})
+    builder = create_variant_builder(genetics_normalizer)
+    gwas_hits = [GWASHit(original_id=f'TEST:{i}', original_name=f'rs{i}') for i in range(1, 6)]
+    progress = RagsVariantNormalizationProgress()
+    results = builder.process_gwas_variants(gwas_hits, progress=progress)
+
+    # the other chunks are still written, the failed one is left for the next build
+    assert len(results.error_messages) == 1 and 'normalization service unavailable' in results.error_messages[0]
+    assert sorted(node.id for node in builder.writer.nodes) == ['CAID:CA1', 'CAID:CA2', 'CAID:CA5']
+    assert progress.chunks_done == 3 and progress.failed_chunks == 1 and progress.variants_normalized == 5
+    assert [bool(hit.normalized) for hit in gwas_hits] == [True, True, False, False, True]
+    assert gwas_hits[2].normalized_id is None
+
+
+class NoGeneServices:
+    def get_variant_to_gene(self, services: list, variant_nodes: list):
+        return {}
+
 
+def test_export_annotation(tmp_path, monkeypatch):
+    monkeypatch.delenv('RAGS_ANNOTATION_STORE_PATH', raising=False)
+    builder = create_variant_builder(StubGeneticsNormalizer())
+    builder.genetics_services = NoGeneServices()
+    builder.writer = ImportFileWriter(str(tmp_path))
+    # the variant was exported by the build before it was annotated
+    builder.writer.write_node(RAGsNode('CAID:CA1', SEQUENCE_VARIANT, name='rs1', properties={RAGS_ANNOTATED_PROPERTY: False},
+                                       all_types=frozenset([ROOT_ENTITY, SEQUENCE_VARIANT])))
+    builder.add_genes_to_variants([{'id': 'CAID:CA1', 'name': 'rs1', 'equivalent_identifiers': ['CAID:CA1']}])
+    builder.writer.close()
 
+    # the annotated variant goes to a file that's imported before the first one
+    with open(tmp_path / f'updated_nodes_{get_file_name_part([ROOT_ENTITY, SEQUENCE_VARIANT])}.csv') as node_file:
+        node_rows = list(csv.DictReader(node_file))
+    assert len(node_rows) == 1
+    assert node_rows[0]['id:ID'] == 'CAID:CA1' and node_rows[0]['name'] == 'rs1'
+    assert node_rows[0][f'{RAGS_ANNOTATED_PROPERTY}:boolean'] == 'true'
 
@@ -0,0 +1,41 @@
+from rags_src.rags_genetics_cache import RagsGeneticsCache, NORMALIZATION_CACHE_KEY
+
+from robokop_genetics.simple_graph_components import SimpleEdge, SimpleNode
+
+
+def test_genetics_cache(tmp_path):
+    cache = RagsGeneticsCache(str(tmp_path / 'genetics_cache.db'))
+
+    normalization = [{"id": "CAID:CA1", "name": "rs1", "equivalent_identifiers": ["CAID:CA1", "DBSNP:rs1"], "type": []}]
+    cache.set_batch_normalization({'HGVS:NC_000001.10:g.1A>G': normalization})
+    cached_normalizations = cache.get_batch_normalization(['HGVS:NC_000001.10:g.1A>G', 'HGVS:NC_000001.10:g.2A>G'])
+    assert cached_normalizations == {'HGVS:NC_000001.10:g.1A>G': normalization}
+
+    edge = SimpleEdge(source_id='CAID:CA1',
+                      target_id='HGNC:1100',
+                      provided_by='testing',
+                      input_id='CAID:CA1',
+                      predicate_id='GAMMA:0000102',
+                      predicate_label='nearby_variant_of',
+                      ctime=1,
+                      properties={'distance': 10})
+    gene = SimpleNode(id='HGNC:1100', type='biolink:Gene', name='BRCA1')
+    cache.set_service_results('MyVariant_sequence_variant_to_gene', {'CAID:CA1': [(edge, gene)]})
+    cached_results = cache.get_service_results('MyVariant_sequence_variant_to_gene', ['CAID:CA1', 'CAID:CA2'])
+    assert cached_results[1] is None
+    cached_edge, cached_gene = cached_results[0][0]
+    assert cached_edge == edge
+    assert cached_gene.id == 'HGNC:1100'
+
+    # the cache persists on disk
+    cache.close()
+    cache = RagsGeneticsCache(str(tmp_path / 'genetics_cache.db'))
+    assert cache.get_batch_normalization(['HGVS:NC_000001.10:g.1A>G'])
+    hits, misses, hit_rate = cache.get_hit_rates()[NORMALIZATION_CACHE_KEY]
+    assert (hits, misses, hit_rate) == (1, 0, 1.0)
+
+    # lookups go in batches, results keep the order of the ids asked for
+    cache.set_service_results('Ensembl_sequence_variant_to_gene', {f'CAID:CA{i}': [] for i in range(0, 1200, 2)})
+    cached_results = cache.get_service_results('Ensembl_sequence_variant_to_gene', [f'CAID:CA{i}' for i in range(1200)])
+    assert cached_results[:3] == [[], None, []]
+    assert len([results for results in cached_results if results is not None]) == 600
@@ -0,0 +1,72 @@
+from rags_src.rags_core import RAGsNode, TESTING_NODE
+from rags_src.rags_graph_writer import BufferedWriter
+from rags_src.rags_node_registry import RagsNodeRegistry, SEED_REGISTRY_TASK, RECONCILE_REGISTRY_TASK
+
+
+class FakeGraphSession:
+    def __init__(self, graph_node_ids: list, transactions: list):
+        self.graph_node_ids = graph_node_ids
+        self.transactions = transactions
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def read_transaction(self, read_function, query, parameters):
+        if 'ids' in parameters:
+            return [node_id for node_id in parameters['ids'] if node_id not in self.graph_node_ids]
+        node_ids = sorted([node_id for node_id in self.graph_node_ids if node_id > parameters['last_id']])
+        return node_ids[:parameters['page_size']]
+
+    def write_transaction(self, write_function, batch, batch_key):
+        self.transactions.append([node.id for node in batch])
+
+
+class FakeGraphDB:
+    def __init__(self, graph_node_ids: list):
+        self.graph_node_ids = graph_node_ids
+        self.transactions = []
+
+    def get_session(self):
+        return FakeGraphSession(self.graph_node_ids, self.transactions)
+
+
+def test_node_registry(tmp_path):
+    graph_db = FakeGraphDB([f'TESTING:{i}' for i in range(25)])
+    node_registry = RagsNodeRegistry(str(tmp_path / 'node_registry.db'))
+    assert not node_registry.is_seeded()
+    assert node_registry.seed(graph_db, page_size=10) == 25
+    assert node_registry.is_seeded()
+    assert 'TESTING:3' in node_registry
+    assert 'TESTING:30' not in node_registry
+
+    # nodes in the registry are skipped, new ones are added once they're written
+    with BufferedWriter(graph_db, node_registry=node_registry) as writer:
+        for i in range(20, 30):
+            writer.write_node(RAGsNode(f'TESTING:{i}', TESTING_NODE, all_types=frozenset([TESTING_NODE])))
+    assert graph_db.transactions == [[f'TESTING:{i}' for i in range(25, 30)]]
+    assert 'TESTING:29' in node_registry
+
+    # a graph restored from before the build lost only the nodes RAGs wrote, they're sampled on their own
+    graph_db.graph_node_ids = [f'TESTING:{i}' for i in range(25)]
+    assert node_registry.check_sample(graph_db, sample_size=1) >= 1
+
+    # the graph was reloaded without some of the nodes
+    graph_db.graph_node_ids = [f'TESTING:{i}' for i in range(10)]
+    assert node_registry.check_sample(graph_db, sample_size=100) == 20
+    assert node_registry.reconcile(graph_db, batch_size=7) == 20
+    assert node_registry.get_node_count() == 10
+    assert node_registry.check_sample(graph_db) == 0
+
+    # one maintenance task at a time
+    assert node_registry.start_maintenance(RECONCILE_REGISTRY_TASK)
+    assert not node_registry.start_maintenance(SEED_REGISTRY_TASK)
+    assert node_registry.get_status()['maintenance_task'] == RECONCILE_REGISTRY_TASK
+    graph_db.graph_node_ids = [f'TESTING:{i}' for i in range(5)]
+    node_registry.run_maintenance(RECONCILE_REGISTRY_TASK, graph_db)
+    assert node_registry.get_status() == {'registry_path': str(tmp_path / 'node_registry.db'),
+                                          'node_ids': 5,
+                                          'seeded': True,
+                                          'maintenance_task': None}
@@ -1,8 +1,15 @@
 import pytest
+import json
+import threading
+import time
 
-from rags_src.rags_normalizer import RagsNormalizer
+import rags_src.rags_normalizer as rags_normalizer
+from rags_src.rags_normalizer import RagsNormalizer, RagsNormalizationError
+from rags_src.rags_normalization_index import RagsNormalizationIndex
 from rags_src.rags_core import DISEASE, CHEMICAL_SUBSTANCE, ROOT_ENTITY
 
+from test.mock_normalization_service import MockNormalizationService
+
 @pytest.fixture()
 def normalizer():
     return RagsNormalizer()
@@ -44,6 +51,116 @@ def test_edge_normalization(normalizer):
     assert normalized_predicates['SEMMEDDB:CAUSES'] == 'biolink:causes'
 
 
+def test_node_normalization_from_local_index(tmp_path):
+
+    compendia_path = tmp_path / 'Disease.txt'
+    with open(compendia_path, 'w') as compendia_file:
+        compendia_file.write(json.dumps({"type": DISEASE,
+                                         "identifiers": [{"i": "MONDO:0011122", "l": "obesity disorder"},
+                                                         {"i": "DOID:9970", "l": "obesity"},
+                                                         {"i": "MESH:D009765"}]}) + '\n')
+
+    normalization_index = RagsNormalizationIndex(str(tmp_path / 'index.db'))
+    assert normalization_index.load_compendia([str(compendia_path)]) == 1
+    # loading the same file again is skipped
+    assert normalization_index.load_compendia([str(compendia_path)]) == 0
+
+    normalizer = RagsNormalizer(normalization_index=normalization_index)
+    normalizer.node_normalization_url = None
+    normalized_nodes = normalizer.get_normalized_nodes(['DOID:9970', 'FAKECURIE:1'])
+
+    test_node = normalized_nodes['DOID:9970']
+    assert test_node.id == 'MONDO:0011122'
+    assert test_node.name == 'obesity disorder'
+    assert 'MESH:D009765' in test_node.synonyms
+    assert ROOT_ENTITY in test_node.all_types
+    assert DISEASE in test_node.all_types
+
+    assert normalized_nodes['FAKECURIE:1'] is None
+
+    # a changed file replaces the cliques it loaded before instead of adding to them
+    with open(compendia_path, 'a') as compendia_file:
+        compendia_file.write(json.dumps({"type": DISEASE, "identifiers": [{"i": "MONDO:0005148"}]}) + '\n')
+    assert normalization_index.load_compendia([str(compendia_path)]) == 2
+    assert normalization_index.get_clique_count() == 2
+    assert normalization_index.get_normalization('DOID:9970')['id']['identifier'] == 'MONDO:0011122'
+
+
+class SlowNormalizationResponse:
+    def __init__(self, status_code: int, response_json: dict):
+        self.status_code = status_code
+        self.response_json = response_json
+        self.url = 'slow_normalization_service'
+
+    def json(self):
+        return self.response_json
+
+
+def run_concurrent_normalizations(node_ids: list, num_normalizers: int = 2):
+    results = []
+    errors = []
+
+    def normalize():
+        try:
+            results.append(RagsNormalizer().get_normalized_nodes(node_ids))
+        except RagsNormalizationError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=normalize) for i in range(num_normalizers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+def test_concurrent_node_normalization_is_coalesced(monkeypatch):
+    requested_batches = []
+
+    def slow_post(url, json):
+        requested_batches.append(json['curies'])
+        time.sleep(0.2)
+        return SlowNormalizationResponse(200, {curie: {"id": {"identifier": curie, "label": "Fake"},
+                                                       "equivalent_identifiers": [{"identifier": curie}],
+                                                       "type": [ROOT_ENTITY]} for curie in json['curies']})
+
+    monkeypatch.setattr(rags_normalizer.requests, 'post', slow_post)
+    results, errors = run_concurrent_normalizations(['FAKECURIE:2', 'FAKECURIE:3'])
+    assert not errors
+    assert len(requested_batches) == 1
+    for normalized_nodes in results:
+        assert normalized_nodes['FAKECURIE:2'].name == 'Fake'
+        assert normalized_nodes['FAKECURIE:3'].id == 'FAKECURIE:3'
+
+
+def test_concurrent_node_normalization_errors_propagate(monkeypatch):
+
+    def failing_post(url, json):
+        time.sleep(0.2)
+        return SlowNormalizationResponse(500, {'error': 'fake error'})
+
+    monkeypatch.setattr(rags_normalizer.requests, 'post', failing_post)
+    results, errors = run_concurrent_normalizations(['FAKECURIE:4'])
+    assert not results
+    assert len(errors) == 2
+    assert rags_normalizer.node_normalization_flights.in_flight == {}
+
+
+def test_normalization_against_mock_service(monkeypatch):
+    with MockNormalizationService() as mock_service:
+        monkeypatch.setenv('NODE_NORMALIZATION_ENDPOINT', mock_service.node_normalization_url)
+        monkeypatch.setenv('EDGE_NORMALIZATION_ENDPOINT', mock_service.edge_normalization_url)
 
+        normalizer = RagsNormalizer()
+        normalized_nodes = normalizer.get_normalized_nodes(['CHEBI:27732', 'SYNTHETIC:1'])
+        assert normalized_nodes['CHEBI:27732'].id == 'PUBCHEM.COMPOUND:2519'
+        assert CHEMICAL_SUBSTANCE in normalized_nodes['SYNTHETIC:1'].all_types
 
+        # none of these are found so the mock service returns a 404 like the real one
+        assert normalizer.get_normalized_nodes(['FAKECURIE:5'])['FAKECURIE:5'] is None
+        assert normalizer.get_normalized_edges(['RO:0002610'])['RO:0002610'] == 'biolink:correlated_with'
+        assert mock_service.request_count == 3
 
+        mock_service.error_rate = 1.0
+        with pytest.raises(RagsNormalizationError):
+            normalizer.get_normalized_nodes(['FAKECURIE:6'])
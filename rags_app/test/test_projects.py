@@ -13,6 +13,7 @@ if os.path.exists(TEST_DATABASE_LOCATION):
     os.remove(TEST_DATABASE_LOCATION)
 
 rags_db_models.Base.metadata.create_all(bind=test_database_engine)
+rags_db_models.add_missing_columns(test_database_engine)
 
 SAMPLE_DATA_DIR = os.path.join(
     os.path.dirname(os.path.realpath(__file__)),
@@ -33,6 +34,8 @@ def reset_db(testing_db):
     testing_db.db.execute(f'DELETE FROM  {rags_db_models.RAGS_STUDY_TABLE_NAME}')
     testing_db.db.execute(f'DELETE FROM  {rags_db_models.GWAS_HITS_TABLE_NAME}')
     testing_db.db.execute(f'DELETE FROM  {rags_db_models.MWAS_HITS_TABLE_NAME}')
+    testing_db.db.execute(f'DELETE FROM  {rags_db_models.RAGS_TRIANGLES_TABLE_NAME}')
+    testing_db.db.execute(f'DELETE FROM  {rags_db_models.RAGS_ASSOCIATIONS_TABLE_NAME}')
     testing_db.db.commit()
 
 
@@ -66,6 +69,116 @@ def test_get_projects(testing_db: RagsProjectDB):
         assert 'Test' in p.name
 
 
+def test_association_triangles(testing_db: RagsProjectDB):
+    reset_db(testing_db)
+    testing_db.create_project('Triangle Project')
+    project_id = testing_db.get_project_by_name('Triangle Project').id
+    studies = {}
+    for study_name, study_type, trait_id, trait_type in [('Variant Disease', GWAS, 'TEST:disease', DISEASE),
+                                                         ('Metabolite Disease', MWAS, 'TEST:disease', DISEASE),
+                                                         ('Variant Chemical', GWAS, 'TEST:chemical', CHEMICAL_SUBSTANCE)]:
+        testing_db.create_study(project_id, 'test_file', study_name, study_type, trait_id, trait_type, trait_id, 1e-5, 1)
+        studies[study_name] = testing_db.get_study_by_name(study_name)
+
+    testing_db.save_associations(studies['Variant Disease'], [('TEST:disease', 'TEST:variant_1', 1e-8),
+                                                              ('TEST:disease', 'TEST:variant_2', 1e-6)])
+    testing_db.save_associations(studies['Metabolite Disease'], [('TEST:disease', 'TEST:chemical', 1e-7)])
+    assert not testing_db.get_association_triangles(project_id)
+
+    # the last side of both triangles arrives with a later study
+    testing_db.save_associations(studies['Variant Chemical'], [('TEST:chemical', 'TEST:variant_1', 1e-3),
+                                                               ('TEST:chemical', 'TEST:variant_2', 1e-9)])
+    triangles = testing_db.get_association_triangles(project_id)
+    assert triangles == [('TEST:variant_1', 1e-8, 'TEST:disease', 1e-7, 'TEST:chemical', 1e-3),
+                         ('TEST:variant_2', 1e-6, 'TEST:disease', 1e-7, 'TEST:chemical', 1e-9)]
+    triangles = testing_db.get_association_triangles(project_id, sort_by='chemical_variant_p_value')
+    assert [triangle[0] for triangle in triangles] == ['TEST:variant_2', 'TEST:variant_1']
+
+    # both variants and the chemical share the disease
+    phenotype_paths = [path for page in testing_db.iterate_phenotype_paths(project_id, 1e-5, page_size=1) for path in page]
+    assert [path[0] for path in phenotype_paths] == ['TEST:variant_1', 'TEST:variant_2']
+    # paging picks up after a path key
+    later_paths = [path for page in testing_db.iterate_phenotype_paths(project_id, 1e-5, after_path_key=phenotype_paths[0][-2:])
+                   for path in page]
+    assert later_paths == phenotype_paths[1:]
+
+    # rewriting a study replaces its associations and the triangles they were part of
+    testing_db.save_associations(studies['Variant Disease'], [('TEST:disease', 'TEST:variant_2', 1e-6)], replace_existing=True)
+    assert [triangle[0] for triangle in testing_db.get_association_triangles(project_id)] == ['TEST:variant_2']
+
+    testing_db.delete_study(studies['Metabolite Disease'])
+    assert not testing_db.get_association_triangles(project_id)
+    assert testing_db.has_associations(project_id)
+
+
+class AnnotationGraphDB:
+    def __init__(self, variant_ids: list):
+        self.unannotated_ids = sorted(variant_ids)
+        self.page_parameters = []
+
+    def run_named_query(self, query_name: str, parameters: dict = None, predicate: str = None, write: bool = False):
+        self.page_parameters.append(parameters)
+        return [{'id': variant_id, 'equivalent_identifiers': [variant_id]}
+                for variant_id in self.unannotated_ids if variant_id > parameters['last_id']][:parameters['page_size']]
+
+
+class ClosingWriter:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class AnnotationBuilder:
+    normalized_association_predicate = 'biolink:correlated_with'
+
+    def __init__(self, graph_db: AnnotationGraphDB, fail_on_chunk: int = None):
+        self.graph_db = graph_db
+        self.fail_on_chunk = fail_on_chunk
+        self.chunks = []
+        self.writer = ClosingWriter()
+
+    def add_genes_to_variants(self, variants: list):
+        if len(self.chunks) == self.fail_on_chunk:
+            raise ConnectionError('annotation interrupted')
+        self.chunks.append([variant['id'] for variant in variants])
+        for variant in variants:
+            self.graph_db.unannotated_ids.remove(variant['id'])
+
+
+def test_resumable_annotation(testing_db: RagsProjectDB):
+    reset_db(testing_db)
+    testing_db.create_project('Annotation Project')
+    project_id = testing_db.get_project_by_name('Annotation Project').id
+    graph_db = AnnotationGraphDB([f'TEST:{i}' for i in range(1, 8)])
+    project_manager = RagsProjectManager.__new__(RagsProjectManager)
+    project_manager.project_id = project_id
+    project_manager.project_db = testing_db
+    project_manager.rags_graph_db = graph_db
+    project_manager.rags_builder = AnnotationBuilder(graph_db, fail_on_chunk=2)
+    project_manager.annotation_chunk_size = 2
+
+    with pytest.raises(ConnectionError):
+        project_manager.annotate_hits()
+    assert project_manager.rags_builder.chunks == [['TEST:1', 'TEST:2'], ['TEST:3', 'TEST:4']]
+    assert testing_db.get_annotation_checkpoint(project_id) == 'TEST:4'
+    assert testing_db.get_build_generation(project_id) == 1
+    # the writer is closed even when annotation fails
+    assert project_manager.rags_builder.writer.closed
+
+    # the next run picks up after the last finished chunk
+    project_manager.rags_builder = AnnotationBuilder(graph_db)
+    graph_db.page_parameters = []
+    results = project_manager.annotate_hits()
+    assert results.success and results.success_message == 'Annotated 3 variants.'
+    assert project_manager.rags_builder.chunks == [['TEST:5', 'TEST:6'], ['TEST:7']]
+    assert graph_db.page_parameters[0] == {'last_id': 'TEST:4', 'page_size': 2}
+    assert testing_db.get_annotation_checkpoint(project_id) is None
+    assert testing_db.get_build_generation(project_id) == 2
+    assert project_manager.rags_builder.writer.closed
+
+
 def create_project_with_rags(testing_db: RagsProjectDB):
     testing_db.create_project('Testing Project')
     project_id = testing_db.get_project_by_name('Testing Project').id
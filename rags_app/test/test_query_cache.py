@@ -0,0 +1,35 @@
+from sqlalchemy import create_engine
+
+import rags_src.rags_project_db_models as rags_db_models
+from rags_src.rags_query_cache import RagsQueryCache
+
+
+def test_query_cache_eviction():
+    query_cache = RagsQueryCache(max_entries=2)
+    query_cache.put((1, 1, 0, 0), ['first'])
+    query_cache.put((1, 2, 0, 0), ['second'])
+    # using the first entry makes the second one the least recently used
+    assert query_cache.get((1, 1, 0, 0)) == ['first']
+    query_cache.put((2, 1, 0, 0), ['third'])
+    assert query_cache.get((1, 2, 0, 0)) is None
+    assert query_cache.get((2, 1, 0, 0)) == ['third']
+
+    # a new build generation is a different key
+    assert query_cache.get((1, 1, 1, 0)) is None
+
+    query_cache.invalidate_project(1)
+    assert query_cache.get((1, 1, 0, 0)) is None
+    assert query_cache.get((2, 1, 0, 0)) == ['third']
+    assert query_cache.get_stats()['evictions'] == 1
+
+
+def test_add_missing_columns(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path}/rags_projects.db')
+    # a projects table from before build generations were added
+    engine.execute(f'CREATE TABLE {rags_db_models.RAGS_PROJECTS_TABLE_NAME} (id INTEGER PRIMARY KEY, name VARCHAR)')
+    engine.execute(f"INSERT INTO {rags_db_models.RAGS_PROJECTS_TABLE_NAME} (id, name) VALUES (1, 'Old Project')")
+    rags_db_models.Base.metadata.create_all(bind=engine)
+    rags_db_models.add_missing_columns(engine)
+    assert engine.execute(f'SELECT build_generation FROM {rags_db_models.RAGS_PROJECTS_TABLE_NAME}').scalar() == 0
+    # running it again doesn't change anything
+    rags_db_models.add_missing_columns(engine)
@@ -0,0 +1,62 @@
+#!/bin/bash
+
+function printHelp(){
+    echo "
+        A simple script to take off a running neo4j container and build a new graph from RAGs export files
+        (see RAGS_GRAPH_WRITER=export) with neo4j-admin import, then bring it back up.
+        neo4j-admin import only works on an empty database, move or remove databases/graph.db first.
+        Arguments:
+            -d    directory     export directory, relative to the neo4j data directory eg '-d import/project_1'.
+            -c    compose-file  Path to the docker-compose file to start Neo4j in backup mode.
+            -h    help          display this message.
+
+    "
+}
+
+export_directory='import'
+compose_file_location='docker-compose-backup.yml'
+while getopts :hd:c: opt; do
+    case $opt in
+        h)
+        printHelp
+        exit
+        ;;
+        d)
+        export_directory=$OPTARG
+        ;;
+        c)
+        compose_file_location=$OPTARG
+        ;;
+        \?)
+        echo "Invalid option -$OPTARG"
+        printHelp
+        exit 1
+        ;;
+    esac
+done
+export_directory='/data/'$export_directory
+echo importing "$export_directory"
+if [ $(docker ps -f name=rags_graph -q) ]; then
+    echo "killing graph container..."
+    docker kill $(docker ps -f name=rags_graph -q)
+    echo "graph container down..."
+fi
+
+echo "creating new container for importing..."
+docker-compose -f $compose_file_location up -d
+
+# the export files carry their labels and relationship types in :LABEL and :TYPE columns,
+# and arrays are delimited with | (IMPORT_ARRAY_DELIMITER in rags_import_writer.py)
+# updated nodes go first, with duplicate nodes ignored the first row for a node is the one imported
+echo "importing graph ..."
+docker exec $(docker ps -f name=rags_graph -q) bash -c "
+    import_args=''
+    for node_file in $export_directory/updated_nodes_*.csv; do [ -e \"\$node_file\" ] && import_args=\"\$import_args --nodes=\$node_file\"; done
+    for node_file in $export_directory/nodes_*.csv; do import_args=\"\$import_args --nodes=\$node_file\"; done
+    for edge_file in $export_directory/edges_*.csv; do import_args=\"\$import_args --relationships=\$edge_file\"; done
+    bin/neo4j-admin import --database=graph.db --array-delimiter='|' --ignore-duplicate-nodes=true --ignore-missing-nodes=true \$import_args"
+
+echo "killing graph importing container..."
+docker kill $(docker ps -f name=rags_graph -q)
+
+echo "importing graph complete..."